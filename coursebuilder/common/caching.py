@@ -22,6 +22,7 @@ import datetime
 import logging
 import sys
 import threading
+import types
 import unittest
 
 import appengine_config
@@ -125,12 +126,187 @@ class RequestScopedSingleton(AbstractScopedSingleton):
     CONTAINER = _request_scoped_singleton.__dict__
 
 
+# types whose instances hold no references worth following
+_SCALAR_TYPES = (
+    basestring, bytearray, int, long, float, complex, bool, type(None),
+    datetime.date, datetime.time, datetime.timedelta, datetime.tzinfo,
+    type, types.ClassType, types.ModuleType, types.FunctionType,
+    types.BuiltinFunctionType, types.MethodType)
+
+# {type: function(obj, seen)} computing the size of an instance of a type
+_SIZERS = {}
+
+
+def getsizeof(obj):
+    """Computes the size of an object and of everything it references.
+
+    Unlike sys.getsizeof(), this counts the contents of containers and the
+    attributes of objects; an object referenced more than once is counted
+    once. Classes may define a getsizeof() instance method to compute the
+    size of their instances themselves; it's used instead of the attributes.
+    The function computing the size is looked up once per type.
+
+    Args:
+      obj: Any object.
+    Returns:
+      An approximate number of bytes.
+    """
+    return _getsizeof(obj, set())
+
+
+def _getsizeof(obj, seen):
+    sizer = _SIZERS.get(type(obj))
+    if sizer is None:
+        sizer = _make_sizer(type(obj))
+        _SIZERS[type(obj)] = sizer
+    return sizer(obj, seen)
+
+
+def _make_sizer(klass):
+    if issubclass(klass, _SCALAR_TYPES):
+        return _size_of_scalar
+    if issubclass(klass, dict):
+        return _size_of_dict
+    if issubclass(klass, (list, tuple, set, frozenset, collections.deque)):
+        return _size_of_sequence
+    for base in klass.__mro__:
+        hook = base.__dict__.get('getsizeof')
+        if hook is not None:
+            if isinstance(hook, types.FunctionType):
+                return _size_of_object_with_hook
+            break
+    return _size_of_object
+
+
+def _size_of_scalar(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    return sys.getsizeof(obj)
+
+
+def _size_of_dict(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    for key, value in obj.iteritems():
+        size += _getsizeof(key, seen) + _getsizeof(value, seen)
+    return size
+
+
+def _size_of_sequence(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    for item in obj:
+        size += _getsizeof(item, seen)
+    return size
+
+
+def _size_of_object_with_hook(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    return obj.getsizeof()
+
+
+def _size_of_object(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += _getsizeof(obj.__dict__, seen)
+    slots = getattr(type(obj), '__slots__', ())
+    if isinstance(slots, basestring):
+        slots = [slots]
+    for slot in slots:
+        if hasattr(obj, slot):
+            size += _getsizeof(getattr(obj, slot), seen)
+    return size
+
+
+class UpdatedOnIndex(object):
+    """Tracks entry count and most recent updated_on() for each key prefix.
+
+    Keys must follow the AbstractCacheConnection.make_key() layout, which is
+    '<connection class name>:<namespace>:<entry key>'. The index is kept in
+    sync by LRUCache on put, delete and eviction, so the most recent
+    updated_on() for a namespace can be answered without scanning the whole
+    process-wide cache. When the entry holding the maximum is removed, the
+    maximum is recomputed lazily from the entries of that one prefix only.
+    """
+
+    EPOCH = datetime.datetime.fromtimestamp(0)
+
+    def __init__(self):
+        self._prefixes = {}
+
+    @classmethod
+    def key_prefix(cls, key):
+        parts = key.split(':', 2)
+        if len(parts) < 3:
+            return None
+        return '%s:%s' % (parts[0], parts[1])
+
+    def add(self, key, entry):
+        prefix = self.key_prefix(key)
+        if prefix is None:
+            return
+        stats = self._prefixes.get(prefix)
+        if stats is None:
+            stats = {'updated_ons': {}, 'max': self.EPOCH, 'dirty': False}
+            self._prefixes[prefix] = stats
+        updated_on = None
+        if entry:
+            # old entities may be missing this field
+            updated_on = entry.updated_on() or self.EPOCH
+        stats['updated_ons'][key] = updated_on
+        if (updated_on is not None and not stats['dirty'] and
+            updated_on > stats['max']):
+            stats['max'] = updated_on
+
+    def remove(self, key):
+        prefix = self.key_prefix(key)
+        stats = self._prefixes.get(prefix)
+        if stats is None or key not in stats['updated_ons']:
+            return
+        updated_on = stats['updated_ons'].pop(key)
+        if not stats['updated_ons']:
+            del self._prefixes[prefix]
+            return
+        if updated_on is not None and updated_on >= stats['max']:
+            stats['dirty'] = True
+
+    def get_count(self, prefix):
+        stats = self._prefixes.get(prefix)
+        if stats is None:
+            return 0
+        return len(stats['updated_ons'])
+
+    def get_most_recent_updated_on(self, prefix):
+        """Returns (has_items, max_updated_on) for entries under the prefix."""
+        stats = self._prefixes.get(prefix)
+        if stats is None:
+            return False, self.EPOCH
+        if stats['dirty']:
+            max_updated_on = self.EPOCH
+            for updated_on in stats['updated_ons'].itervalues():
+                if updated_on is not None and updated_on > max_updated_on:
+                    max_updated_on = updated_on
+            stats['max'] = max_updated_on
+            stats['dirty'] = False
+        return True, stats['max']
+
+
 class LRUCache(object):
     """A dict that supports capped size and LRU eviction of items."""
 
     def __init__(
         self, max_item_count=None,
-        max_size_bytes=None, max_item_size_bytes=None):
+        max_size_bytes=None, max_item_size_bytes=None, index=None):
         assert max_item_count or max_size_bytes
         if max_item_count:
             assert max_item_count > 0
@@ -141,16 +317,23 @@ class LRUCache(object):
         self.max_size_bytes = max_size_bytes
         self.max_item_size_bytes = max_item_size_bytes
         self.items = collections.OrderedDict([])
+        self.index = index
+
+        # sizes of entries as computed on put; they are subtracted on removal
+        # so total_size is exact even if get_entry_size() is not stable
+        self.sizes = {}
 
     def get_entry_size(self, key, value):
         """Computes item size. Override and compute properly for your items."""
-        return sys.getsizeof(key) + sys.getsizeof(value)
+        return getsizeof(key) + getsizeof(value)
 
-    def _compute_current_size(self):
-        total = 0
-        for key, item in self.items.iteritems():
-            total += sys.getsizeof(key) + self.get_item_size(item)
-        return total
+    def _remove(self, key):
+        del self.items[key]
+        if self.index:
+            self.index.remove(key)
+        if self.max_size_bytes:
+            self.total_size -= self.sizes.pop(key)
+            assert self.total_size >= 0
 
     def _allocate_space(self, key, value):
         """Remove items in FIFO order until size constraints are met."""
@@ -167,13 +350,11 @@ class LRUCache(object):
             if not (over_count or over_size):
                 if self.max_size_bytes:
                     self.total_size += entry_size
+                    self.sizes[key] = entry_size
                     assert self.total_size < self.max_size_bytes
                 return True
             if self.items:
-                _key, _value = self.items.popitem(last=False)
-                if self.max_size_bytes:
-                    self.total_size -= self.get_entry_size(_key, _value)
-                    assert self.total_size >= 0
+                self._remove(next(iter(self.items)))
             else:
                 break
         return False
@@ -190,7 +371,11 @@ class LRUCache(object):
 
     def put(self, key, value):
         assert key
+        if key in self.items:
+            self._remove(key)
         if self._allocate_space(key, value):
+            if self.index:
+                self.index.add(key, value)
             self.items[key] = value
             return True
         return False
@@ -206,7 +391,7 @@ class LRUCache(object):
     def delete(self, key):
         assert key
         if key in self.items:
-            del self.items[key]
+            self._remove(key)
             return True
         return False
 
@@ -227,7 +412,8 @@ class NoopCacheConnection(object):
 class AbstractCacheEntry(object):
     """Object representation while in cache."""
 
-    # we don't track deletions; deleted item will hang around this long
+    # unless a connection tracks deletions via TOMBSTONE_ENTITY, a deleted item
+    # will hang around this long
     CACHE_ENTRY_TTL_SEC = 5 * 60
 
     @classmethod
@@ -258,6 +444,10 @@ class AbstractCacheConnection(object):
     PERSISTENT_ENTITY = None
     CACHE_ENTRY = None
 
+    # optional entity keyed like PERSISTENT_ENTITY that records the time of
+    # deletion of an object in its 'updated_on' property
+    TOMBSTONE_ENTITY = None
+
     @classmethod
     def init_counters(cls):
         name = cls.__name__
@@ -349,6 +539,13 @@ class AbstractCacheConnection(object):
 
     def _get_most_recent_updated_on(self):
         """Get the most recent item cached. Datastore deletions are missed..."""
+        if self.cache.index:
+            return self.cache.index.get_most_recent_updated_on(
+                self.make_key_prefix(self.namespace))
+        return self._scan_most_recent_updated_on()
+
+    def _scan_most_recent_updated_on(self):
+        """Same as above, but walks all entries of a cache without an index."""
         has_items = False
         max_updated_on = datetime.datetime.fromtimestamp(0)
         prefix = self.make_key_prefix(self.namespace)
@@ -376,8 +573,9 @@ class AbstractCacheConnection(object):
         we have cached so far. This will bring all objects that have changed or
         were created since that time.
 
-        This will NOT bring the notifications about object deletions. Thus cache
-        will continue to serve deleted objects until they expire.
+        Object deletions are only seen if TOMBSTONE_ENTITY is set; they are
+        reported as None updates, which evict the object. Otherwise cache will
+        continue to serve deleted objects until they expire.
 
         Returns:
           a dict of {key: update} objects that represent recent updates
@@ -390,6 +588,12 @@ class AbstractCacheConnection(object):
             q.filter('updated_on > ', updated_on)
         result = {
             entity.key().name(): entity for entity in iter_all(q)}
+        if self.TOMBSTONE_ENTITY:
+            q = self.TOMBSTONE_ENTITY.all()
+            if updated_on:
+                q.filter('updated_on > ', updated_on)
+            for tombstone in iter_all(q):
+                result.setdefault(tombstone.key().name(), None)
         self.CACHE_UPDATE_COUNT.inc(len(result.keys()))
         return result
 
@@ -488,6 +692,158 @@ class LRUCacheTests(unittest.TestCase):
         found, _ = cache.get('a')
         self.assertTrue(found)
 
+    def test_total_size_is_exact_after_replace_and_delete(self):
+        cache = LRUCache(max_size_bytes=5000)
+        self.assertTrue(cache.put('a', bytearray(1000)))
+        self.assertTrue(cache.put('b', bytearray(1000)))
+        self.assertTrue(cache.put('a', bytearray(2000)))
+        self.assertEquals(
+            cache.get_entry_size('a', bytearray(2000)) +
+            cache.get_entry_size('b', bytearray(1000)), cache.total_size)
+        self.assertTrue(cache.delete('a'))
+        self.assertTrue(cache.delete('b'))
+        self.assertEquals(0, cache.total_size)
+
+    def test_size_of_nested_values_is_counted(self):
+        cache = LRUCache(max_size_bytes=5000)
+        self.assertFalse(cache.put('a', {'body': 'x' * 5000}))
+        self.assertTrue(cache.put('a', {'body': 'x' * 1000}))
+        self.assertGreater(cache.total_size, 1000)
+
+
+class GetSizeOfTests(unittest.TestCase):
+
+    def test_scalars(self):
+        for value in [None, 1, 1.5, 'abc', u'abc', datetime.datetime.now()]:
+            self.assertEquals(sys.getsizeof(value), getsizeof(value))
+
+    def test_containers(self):
+        body = 'x' * 10000
+        self.assertGreater(getsizeof({'body': body}), 10000)
+        self.assertGreater(getsizeof([body]), 10000)
+        self.assertGreater(getsizeof((body,)), 10000)
+        self.assertGreater(getsizeof(set([body])), 10000)
+
+    def test_shared_objects_are_counted_once(self):
+        body = 'x' * 10000
+        self.assertLess(getsizeof([body, body, body]), 20000)
+
+        cycle = []
+        cycle.append(cycle)
+        self.assertEquals(sys.getsizeof(cycle), getsizeof(cycle))
+
+    def test_objects(self):
+
+        class Plain(object):
+
+            def __init__(self):
+                self.body = 'x' * 10000
+
+        class Slotted(object):
+            __slots__ = ['body']
+
+            def __init__(self):
+                self.body = 'x' * 10000
+
+        class Hooked(object):
+
+            def getsizeof(self):
+                return 123
+
+        self.assertGreater(getsizeof(Plain()), 10000)
+        self.assertGreater(getsizeof(Slotted()), 10000)
+        self.assertEquals(123, getsizeof(Hooked()))
+        self.assertEquals(
+            123 + sys.getsizeof([None]), getsizeof([Hooked()]))
+
+
+class _TestCacheEntry(AbstractCacheEntry):
+
+    def __init__(self, updated_on):
+        self._updated_on = updated_on
+        self.created_on = datetime.datetime.utcnow()
+
+    def updated_on(self):
+        return self._updated_on
+
+
+class _TestCacheConnection(AbstractCacheConnection):
+
+    def __init__(self, namespace, cache):
+        super(_TestCacheConnection, self).__init__(namespace)
+        self.cache = cache
+
+
+class UpdatedOnIndexTests(unittest.TestCase):
+
+    def _when(self, minutes):
+        return datetime.datetime(2016, 1, 1) + datetime.timedelta(
+            minutes=minutes)
+
+    def _assert_index_matches_scan(self, cache, namespaces):
+        for ns in namespaces:
+            conn = _TestCacheConnection(ns, cache)
+            # pylint: disable=protected-access
+            self.assertEquals(
+                conn._scan_most_recent_updated_on(),
+                conn._get_most_recent_updated_on())
+
+    def test_put_and_delete(self):
+        cache = LRUCache(max_item_count=10, index=UpdatedOnIndex())
+        conn = _TestCacheConnection('ns_a', cache)
+        prefix = conn.make_key_prefix('ns_a')
+        # pylint: disable=protected-access
+        self.assertEquals(
+            (False, UpdatedOnIndex.EPOCH), conn._get_most_recent_updated_on())
+
+        cache.put(conn.make_key('ns_a', 'a'), _TestCacheEntry(self._when(1)))
+        cache.put(conn.make_key('ns_a', 'b'), _TestCacheEntry(self._when(3)))
+        cache.put(conn.make_key('ns_a', 'c'), None)
+        cache.put(conn.make_key('ns_b', 'd'), _TestCacheEntry(self._when(9)))
+        self.assertEquals(3, cache.index.get_count(prefix))
+        self.assertEquals(
+            (True, self._when(3)), conn._get_most_recent_updated_on())
+
+        cache.delete(conn.make_key('ns_a', 'b'))
+        self.assertEquals(
+            (True, self._when(1)), conn._get_most_recent_updated_on())
+
+        cache.put(conn.make_key('ns_a', 'a'), _TestCacheEntry(None))
+        self.assertEquals(
+            (True, UpdatedOnIndex.EPOCH), conn._get_most_recent_updated_on())
+
+        cache.delete(conn.make_key('ns_a', 'a'))
+        cache.delete(conn.make_key('ns_a', 'c'))
+        self.assertEquals(0, cache.index.get_count(prefix))
+        self.assertEquals(
+            (False, UpdatedOnIndex.EPOCH), conn._get_most_recent_updated_on())
+        self._assert_index_matches_scan(cache, ['ns_a', 'ns_b'])
+
+    def test_eviction(self):
+        cache = LRUCache(max_item_count=3, index=UpdatedOnIndex())
+        conn = _TestCacheConnection('ns_a', cache)
+        cache.put(conn.make_key('ns_a', 'a'), _TestCacheEntry(self._when(5)))
+        cache.put(conn.make_key('ns_a', 'b'), _TestCacheEntry(self._when(2)))
+        cache.put(conn.make_key('ns_b', 'c'), _TestCacheEntry(self._when(7)))
+        cache.put(conn.make_key('ns_b', 'd'), _TestCacheEntry(self._when(1)))
+        self.assertFalse(cache.contains(conn.make_key('ns_a', 'a')))
+        # pylint: disable=protected-access
+        self.assertEquals(
+            (True, self._when(2)), conn._get_most_recent_updated_on())
+        self._assert_index_matches_scan(cache, ['ns_a', 'ns_b'])
+
+    def test_matches_scan_under_churn(self):
+        cache = LRUCache(max_item_count=50, index=UpdatedOnIndex())
+        namespaces = ['ns_%s' % i for i in xrange(7)]
+        for i in xrange(500):
+            ns = namespaces[i % len(namespaces)]
+            key = _TestCacheConnection.make_key(ns, 'file_%s' % (i % 13))
+            if i % 5 == 0:
+                cache.delete(key)
+            else:
+                cache.put(key, _TestCacheEntry(self._when((i * 37) % 101)))
+            self._assert_index_matches_scan(cache, namespaces)
+
 
 class SingletonTests(unittest.TestCase):
 
@@ -546,7 +902,9 @@ class SingletonTests(unittest.TestCase):
 def run_all_unit_tests():
     """Runs all unit tests in this module."""
     suites_list = []
-    for test_class in [LRUCacheTests, SingletonTests]:
+    for test_class in [
+            LRUCacheTests, GetSizeOfTests, UpdatedOnIndexTests,
+            SingletonTests]:
         suite = unittest.TestLoader().loadTestsFromTestCase(test_class)
         suites_list.append(suite)
     unittest.TextTestRunner().run(unittest.TestSuite(suites_list))
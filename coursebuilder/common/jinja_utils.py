@@ -17,6 +17,8 @@
 __author__ = 'John Orr (jorr@google.com)'
 
 import sys
+import threading
+import time
 import traceback
 import jinja2
 import safe_dom
@@ -37,6 +39,10 @@ from models.counters import PerfCounter
 # max size for in-process jinja template cache
 MAX_GLOBAL_CACHE_SIZE_BYTES = 8 * 1024 * 1024
 
+# key prefix of bytecode compiled by pooled environments; it is not namespaced
+# because their FileSystemLoader names templates by absolute path
+POOLED_BYTECODE_PREFIX = 'jinja2:bytecode:/'
+
 # this cache used to be memcache based; now it's in-process
 CAN_USE_JINJA2_TEMPLATE_CACHE = config.ConfigProperty(
     'gcb_can_use_jinja2_template_cache', bool,
@@ -151,16 +157,44 @@ JINJA_CACHE_SIZE_BYTES = PerfCounter(
 JINJA_CACHE_LEN.poll_value = ProcessScopedJinjaCache.get_cache_len
 JINJA_CACHE_SIZE_BYTES.poll_value = ProcessScopedJinjaCache.get_cache_size
 
-
-def create_jinja_environment(loader, locale=None, autoescape=True):
+JINJA_ENVIRONMENT_CACHE_HIT = PerfCounter(
+    'gcb-jinja-environment-cache-hit',
+    'A number of times a pooled Jinja environment was reused.')
+JINJA_ENVIRONMENT_CACHE_MISS = PerfCounter(
+    'gcb-jinja-environment-cache-miss',
+    'A number of times a pooled Jinja environment had to be created.')
+JINJA_TEMPLATE_COMPILE_COUNT = PerfCounter(
+    'gcb-jinja-template-compile-count',
+    'A number of times Jinja template source was compiled.')
+JINJA_TEMPLATE_COMPILE_MS = PerfCounter(
+    'gcb-jinja-template-compile-ms',
+    'A total time spent compiling Jinja template source in milliseconds.')
+
+
+class _TimedEnvironment(jinja2.Environment):
+    """Jinja environment that counts and times template compilation."""
+
+    def compile(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super(_TimedEnvironment, self).compile(*args, **kwargs)
+        finally:
+            JINJA_TEMPLATE_COMPILE_COUNT.inc()
+            JINJA_TEMPLATE_COMPILE_MS.inc(
+                increment=int((time.time() - start) * 1000))
+
+
+def create_jinja_environment(
+    loader, locale=None, autoescape=True, bytecode_prefix=None):
     """Create proper jinja environment."""
 
     cache = None
     if CAN_USE_JINJA2_TEMPLATE_CACHE.value:
-        prefix = 'jinja2:bytecode:%s:/' % models.MemcacheManager.get_namespace()
+        prefix = bytecode_prefix or (
+            'jinja2:bytecode:%s:/' % models.MemcacheManager.get_namespace())
         cache = JinjaBytecodeCache(prefix)
 
-    jinja_environment = jinja2.Environment(
+    jinja_environment = _TimedEnvironment(
         autoescape=autoescape, finalize=finalize,
         extensions=['jinja2.ext.i18n'], bytecode_cache=cache, loader=loader)
 
@@ -188,6 +222,81 @@ def create_and_configure_jinja_environment(
     dirs, autoescape=True, handler=None, default_locale='en_US'):
     """Sets up an environment and gets jinja template."""
 
+    locale = _get_current_locale(default_locale)
+    jinja_environment = create_jinja_environment(
+        jinja2.FileSystemLoader(dirs), locale=locale, autoescape=autoescape)
+
+    jinja_environment.filters['gcb_tags'] = get_gcb_tags_filter(handler)
+
+    return jinja_environment
+
+
+# the handler whose gcb_tags filter the templates being rendered should apply
+_render_state = threading.local()
+
+
+def _get_current_gcb_tags_filter():
+    return getattr(_render_state, 'gcb_tags', None) or get_gcb_tags_filter(None)
+
+
+def _pooled_gcb_tags(data):
+    """Applies the gcb_tags filter of the handler the template is bound to."""
+    return _get_current_gcb_tags_filter()(data)
+
+
+class ProcessScopedJinjaEnvironmentPool(caching.ProcessScopedSingleton):
+    """This class holds in-process pool of configured Jinja environments.
+
+    Environments are keyed by (tuple(dirs), locale, autoescape). Reusing them
+    keeps the templates they have loaded, so a template isn't loaded and
+    linked again each time it is rendered. The handler dependent gcb_tags
+    filter is looked up at render time; see HandlerBoundTemplate.
+    """
+
+    def __init__(self):
+        self.environments = {}
+
+    def get(self, dirs, locale, autoescape):
+        key = (tuple(dirs), locale, autoescape)
+        jinja_environment = self.environments.get(key)
+        if jinja_environment is not None:
+            JINJA_ENVIRONMENT_CACHE_HIT.inc()
+            return jinja_environment
+
+        JINJA_ENVIRONMENT_CACHE_MISS.inc()
+        jinja_environment = create_jinja_environment(
+            jinja2.FileSystemLoader(dirs), locale=locale,
+            autoescape=autoescape, bytecode_prefix=POOLED_BYTECODE_PREFIX)
+        jinja_environment.filters['gcb_tags'] = _pooled_gcb_tags
+        self.environments[key] = jinja_environment
+        return jinja_environment
+
+
+class HandlerBoundTemplate(object):
+    """A template from a pooled environment, bound to a request handler.
+
+    The gcb_tags filter of the handler is made current for the duration of
+    render(), including any templates the rendered one includes or imports.
+    Other attributes are delegated to the underlying jinja2.Template.
+    """
+
+    def __init__(self, template, handler):
+        self._template = template
+        self._handler = handler
+
+    def render(self, *args, **kwargs):
+        previous = getattr(_render_state, 'gcb_tags', None)
+        _render_state.gcb_tags = get_gcb_tags_filter(self._handler)
+        try:
+            return self._template.render(*args, **kwargs)
+        finally:
+            _render_state.gcb_tags = previous
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+
+def _get_current_locale(default_locale):
     # Defer to avoid circular import.
     from controllers import sites
 
@@ -199,19 +308,25 @@ def create_and_configure_jinja_environment(
             locale = app_context.default_locale
     if not locale:
         locale = default_locale
+    return locale
 
-    jinja_environment = create_jinja_environment(
-        jinja2.FileSystemLoader(dirs), locale=locale, autoescape=autoescape)
 
-    jinja_environment.filters['gcb_tags'] = get_gcb_tags_filter(handler)
+def get_template(
+    template_name, dirs, autoescape=True, handler=None, default_locale='en_US'):
+    if not CAN_USE_JINJA2_TEMPLATE_CACHE.value:
+        return create_and_configure_jinja_environment(
+            dirs, autoescape, handler, default_locale).get_template(
+                template_name)
 
-    return jinja_environment
+    locale = _get_current_locale(default_locale)
 
+    # Translations are looked up in the i18n of the current request.
+    i18n.get_i18n().set_locale(locale)
 
-def get_template(
-    template_name, dirs, autoescape=True, handler=None, default_locale='en_US'):
-    return create_and_configure_jinja_environment(
-        dirs, autoescape, handler, default_locale).get_template(template_name)
+    jinja_environment = ProcessScopedJinjaEnvironmentPool.instance().get(
+        dirs, locale, autoescape)
+    return HandlerBoundTemplate(
+        jinja_environment.get_template(template_name), handler)
 
 
 def render_partial_template(name, dirs, values, **kwargs):
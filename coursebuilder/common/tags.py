@@ -17,10 +17,12 @@
 __author__ = 'John Orr (jorr@google.com)'
 
 
+import hashlib
 import logging
 import mimetypes
 import os
 import re
+import uuid
 from xml.etree import cElementTree
 
 import html5lib
@@ -29,9 +31,12 @@ import webapp2
 
 import appengine_config
 
+from common import caching
 from common import messages
 from common import schema_fields
 from models import config
+from models import models
+from models.counters import PerfCounter
 
 _LXML_AVAILABLE = False
 try:
@@ -51,6 +56,16 @@ DUPLICATE_INSTANCE_ID_MESSAGE = (
     'Error processing custom HTML tag: duplicate tag id')
 INVALID_HTML_TAG_MESSAGE = 'Invalid HTML tag'
 
+# max size for in-process cache of rendered HTML fragments
+MAX_FRAGMENT_CACHE_SIZE_BYTES = 8 * 1024 * 1024
+
+FRAGMENT_CACHE_HIT = PerfCounter(
+    'gcb-tags-fragment-cache-hit',
+    'A number of times rendered HTML was found in the fragment cache.')
+FRAGMENT_CACHE_MISS = PerfCounter(
+    'gcb-tags-fragment-cache-miss',
+    'A number of times HTML had to be parsed to render custom tags.')
+
 
 class BaseTag(object):
     """Base class for the custom HTML tags."""
@@ -68,6 +83,21 @@ class BaseTag(object):
         """Lists the inputEx modules required by the editor."""
         return []
 
+    @classmethod
+    def is_cacheable(cls):
+        """Whether the output of render() may be cached and reused.
+
+        Return True only if the output depends on nothing but the node, the
+        course and the locale; not on the student, the request or settings
+        which can change while the content stays the same. Rendered output of
+        such tags is cached along with the HTML around them; all other tags
+        are rendered anew on every page view.
+
+        Returns:
+            Boolean.
+        """
+        return False
+
     @classmethod
     def extra_js_files(cls):
         """Returns a list of JS files to be loaded in the editor lightbox."""
@@ -364,81 +394,132 @@ def html_string_to_element_tree(html_string, is_fragment=True):
         return parser.parse(html_string)
 
 
-def html_to_safe_dom(html_string, handler, render_custom_tags=True,
-                     tags_filter=None):
-    """Render HTML text as a tree of safe_dom elements."""
+class _SuppressedTag(BaseTag):
+    """Replaces the tags rejected by the tags_filter of html_to_safe_dom()."""
 
-    tag_bindings = get_tag_bindings()
-    if tags_filter:
+    @classmethod
+    def is_cacheable(cls):
+        return True
 
-        class SuppressedTag(BaseTag):
+    def render(self, node, context):
+        return cElementTree.XML('<div style="display:none;"></div>')
 
-            def render(self, node, context):
-                return cElementTree.XML('<div style="display:none;"></div>')
 
-        for name, cls in tag_bindings.iteritems():
-            if not tags_filter(name, cls):
-                tag_bindings[name] = SuppressedTag
+class _CachedHtml(safe_dom.Node):
+    """HTML which was sanitized by safe_dom before it was cached."""
+
+    def __init__(self, sanitized_html):
+        super(_CachedHtml, self).__init__()
+        self._sanitized = sanitized_html
+
+    @property
+    def sanitized(self):
+        return self._sanitized
+
+
+class _LiveTagPlaceholder(safe_dom.Node):
+    """Marks the place of a tag which has to be rendered on every view."""
+
+    def __init__(self, marker, index):
+        super(_LiveTagPlaceholder, self).__init__()
+        self._marker = marker
+        self._index = index
+
+    @property
+    def sanitized(self):
+        return '<%s-%d>' % (self._marker, self._index)
+
+
+def _generate_error_message_node_list(elt, error_message):
+    """Generates a node_list representing an error message."""
+    logging.error(
+        '[%s, %s]: %s.', elt.tag, dict(**elt.attrib), error_message)
 
     node_list = safe_dom.NodeList()
-    if not html_string:
-        return node_list
+    node_list.append(safe_dom.Element(
+        'span', className='gcb-error-tag'
+    ).add_text(error_message))
 
-    # Set of all instance id's used in this dom tree, used to detect duplication
-    used_instance_ids = set([])
-    # A dictionary of environments, one for each tag type which appears in the
-    # page
-    tag_contexts = {}
+    if elt.tail:
+        node_list.append(safe_dom.Text(elt.tail))
+    return node_list
 
-    def _generate_error_message_node_list(elt, error_message):
-        """Generates a node_list representing an error message."""
-        logging.error(
-            '[%s, %s]: %s.', elt.tag, dict(**elt.attrib), error_message)
 
-        node_list = safe_dom.NodeList()
-        node_list.append(safe_dom.Element(
-            'span', className='gcb-error-tag'
-        ).add_text(error_message))
+def _remove_namespace(tag_name):
+    # Remove any namespacing which html5lib may have introduced. Html5lib
+    # namespacing is of the form, e.g.,
+    #     {http://www.w3.org/2000/svg}svg
+    return re.sub(r'^\{[^\}]+\}', '', tag_name, count=1)
 
-        if elt.tail:
-            node_list.append(safe_dom.Text(elt.tail))
-        return node_list
 
-    def _remove_namespace(tag_name):
-        # Remove any namespacing which html5lib may have introduced. Html5lib
-        # namespacing is of the form, e.g.,
-        #     {http://www.w3.org/2000/svg}svg
-        return re.sub(r'^\{[^\}]+\}', '', tag_name, count=1)
+class _SafeDomBuilder(object):
+    """Converts an HTML element tree into safe_dom, rendering custom tags.
+
+    If defer_live_tags is set, tags which are not cacheable are not rendered;
+    a _LiveTagPlaceholder is put in their place and the tag element itself is
+    serialized to live_tags.
+    """
+
+    def __init__(self, handler, tag_bindings, render_custom_tags=True,
+                 defer_live_tags=False):
+        self._handler = handler
+        self._tag_bindings = tag_bindings
+        self._render_custom_tags = render_custom_tags
+        self._defer_live_tags = defer_live_tags
+        # Set of all instance id's used in this dom tree, used to detect
+        # duplication
+        self._used_instance_ids = set([])
+        # A dictionary of environments, one for each tag type which appears in
+        # the page
+        self._tag_contexts = {}
+        self.marker = 'gcb-live-tag-%s' % uuid.uuid4().hex
+        self.live_tags = []
+
+    def _defer(self, elt):
+        node_list = safe_dom.NodeList()
+        node_list.append(_LiveTagPlaceholder(self.marker, len(self.live_tags)))
+        tail = elt.tail
+        elt.tail = None
+        try:
+            self.live_tags.append(cElementTree.tostring(elt))
+        finally:
+            elt.tail = tail
+        if tail:
+            node_list.append(safe_dom.Text(tail))
+        return node_list
 
-    def _process_html_tree(elt):
+    def process(self, elt):
         """Recursively parses an HTML tree into a safe_dom.NodeList()."""
         # Return immediately with an error message if a duplicate instanceid is
         # detected.
         if 'instanceid' in elt.attrib:
-            if elt.attrib['instanceid'] in used_instance_ids:
+            if elt.attrib['instanceid'] in self._used_instance_ids:
                 return _generate_error_message_node_list(
                     elt, DUPLICATE_INSTANCE_ID_MESSAGE)
 
-            used_instance_ids.add(elt.attrib['instanceid'])
+            self._used_instance_ids.add(elt.attrib['instanceid'])
 
         # Otherwise, attempt to parse this tag and all its child tags.
         original_elt = elt
         try:
-            if render_custom_tags and elt.tag in tag_bindings:
-                tag = tag_bindings[elt.tag]()
+            if self._render_custom_tags and elt.tag in self._tag_bindings:
+                tag_class = self._tag_bindings[elt.tag]
+                if self._defer_live_tags and not tag_class.is_cacheable():
+                    return self._defer(elt)
+                tag = tag_class()
                 if isinstance(tag, ContextAwareTag):
                     # Get or initialize a environment dict for this type of tag.
                     # Each tag type gets a separate environment shared by all
                     # instances of that tag.
-                    context = tag_contexts.get(elt.tag)
+                    context = self._tag_contexts.get(elt.tag)
                     if context is None:
-                        context = ContextAwareTag.Context(handler, {})
-                        tag_contexts[elt.tag] = context
+                        context = ContextAwareTag.Context(self._handler, {})
+                        self._tag_contexts[elt.tag] = context
                     # Render the tag
                     elt = tag.render(elt, context)
                 else:
                     # Render the tag
-                    elt = tag.render(elt, handler)
+                    elt = tag.render(elt, self._handler)
 
             if elt.tag == cElementTree.Comment:
                 out_elt = safe_dom.Comment()
@@ -451,8 +532,7 @@ def html_to_safe_dom(html_string, handler, render_custom_tags=True,
             if elt.text:
                 out_elt.add_text(elt.text)
             for child in elt:
-                out_elt.add_children(
-                    _process_html_tree(child))
+                out_elt.add_children(self.process(child))
 
             node_list = safe_dom.NodeList()
             node_list.append(out_elt)
@@ -465,23 +545,144 @@ def html_to_safe_dom(html_string, handler, render_custom_tags=True,
             return _generate_error_message_node_list(
                 original_elt, '%s: %s' % (INVALID_HTML_TAG_MESSAGE, e))
 
-    root = html_string_to_element_tree(html_string)
-    if root.text:
-        node_list.append(safe_dom.Text(root.text))
+    def rollup(self, node_list):
+        """Adds headers and footers accumulated by context aware tags."""
+        for tag_name, context in self._tag_contexts.items():
+            header, footer = self._tag_bindings[
+                tag_name]().rollup_header_footer(context)
+            node_list.insert(0, self.process(header))
+            node_list.append(self.process(footer))
+
+    def convert(self, html_string):
+        node_list = safe_dom.NodeList()
+        root = html_string_to_element_tree(html_string)
+        if root.text:
+            node_list.append(safe_dom.Text(root.text))
+
+        for child_elt in root:
+            node_list.append(self.process(child_elt))
+
+        # After the page is processed, rollup any global header/footer data
+        # which the environment-aware tags have accumulated in their env's
+        self.rollup(node_list)
+        return node_list
+
+
+class ProcessScopedFragmentCache(caching.ProcessScopedSingleton):
+    """This class holds in-process cache of rendered HTML fragments."""
+
+    def __init__(self):
+        self.cache = caching.LRUCache(
+            max_size_bytes=MAX_FRAGMENT_CACHE_SIZE_BYTES)
 
-    for child_elt in root:
-        node_list.append(_process_html_tree(child_elt))
 
-    # After the page is processed, rollup any global header/footer data which
-    # the environment-aware tags have accumulated in their env's
-    for tag_name, context in tag_contexts.items():
-        header, footer = tag_bindings[tag_name]().rollup_header_footer(context)
-        node_list.insert(0, _process_html_tree(header))
-        node_list.append(_process_html_tree(footer))
+def _get_fragment_key(html_string, handler, tag_bindings):
+    """Makes a key of the content, the tag bindings and the locale."""
+    app_context = getattr(handler, 'app_context', None)
+    locale = app_context.get_current_locale() if app_context else None
+    bindings = sorted(
+        (name, clazz.__module__, clazz.__name__, clazz.is_cacheable())
+        for name, clazz in tag_bindings.iteritems())
+    digest = hashlib.sha1()
+    digest.update(os.environ.get('CURRENT_VERSION_ID', ''))
+    digest.update(repr(bindings))
+    digest.update(repr(locale))
+    if isinstance(html_string, unicode):
+        html_string = html_string.encode('utf-8')
+    digest.update(html_string)
+    return 'tags-fragment:%s' % digest.hexdigest()
 
+
+def _make_fragment(html_string, handler, tag_bindings):
+    """Renders HTML except for live tags, as it's stored in fragment cache.
+
+    Returns:
+        A pair of a list of the rendered HTML segments and an XML string with a
+        root element holding the tags to render between the segments, or None
+        if the tags can't be stored that way.
+    """
+    builder = _SafeDomBuilder(handler, tag_bindings, defer_live_tags=True)
+    parts = re.split(
+        r'<%s-(\d+)>' % builder.marker, builder.convert(html_string).sanitized)
+    segments = parts[0::2]
+    live_tags = [builder.live_tags[int(index)] for index in parts[1::2]]
+    live_xml = '<div>%s</div>' % ''.join(live_tags)
+    try:
+        cElementTree.fromstring(live_xml)
+    except SyntaxError:
+        logging.warning('Unable to cache HTML with tags: %s', live_tags)
+        return None
+    return segments, live_xml
+
+
+def _render_fragment(fragment, handler, tag_bindings):
+    """Renders the live tags of a fragment into the cached HTML."""
+    segments, live_xml = fragment
+    node_list = safe_dom.NodeList()
+    node_list.append(_CachedHtml(segments[0]))
+    if len(segments) == 1:
+        return node_list
+
+    builder = _SafeDomBuilder(handler, tag_bindings)
+    for elt, segment in zip(cElementTree.fromstring(live_xml), segments[1:]):
+        node_list.append(builder.process(elt))
+        node_list.append(_CachedHtml(segment))
+    builder.rollup(node_list)
     return node_list
 
 
+def _get_fragment(html_string, handler, tag_bindings):
+    key = _get_fragment_key(html_string, handler, tag_bindings)
+    namespace = models.MemcacheManager.get_namespace()
+    cache = ProcessScopedFragmentCache.instance().cache
+    found, fragment = cache.get((namespace, key))
+    if not found:
+        fragment = models.MemcacheManager.get(
+            key, namespace=namespace, frozen=True)
+    if fragment is not None:
+        FRAGMENT_CACHE_HIT.inc()
+        if not found:
+            cache.put((namespace, key), fragment)
+        return fragment
+
+    FRAGMENT_CACHE_MISS.inc()
+    fragment = _make_fragment(html_string, handler, tag_bindings)
+    if fragment is not None:
+        cache.put((namespace, key), fragment)
+        models.MemcacheManager.set(
+            key, fragment, namespace=namespace, frozen=True)
+    return fragment
+
+
+def html_to_safe_dom(html_string, handler, render_custom_tags=True,
+                     tags_filter=None):
+    """Render HTML text as a tree of safe_dom elements.
+
+    When custom tags are rendered, the rendered HTML is cached by the content,
+    the tag bindings and the locale. Only the tags which are not cacheable are
+    rendered again when the same content is viewed later; they are kept in the
+    cache as XML, so no HTML parsing is needed.
+    """
+
+    tag_bindings = get_tag_bindings()
+    if tags_filter:
+        for name, cls in tag_bindings.iteritems():
+            if not tags_filter(name, cls):
+                tag_bindings[name] = _SuppressedTag
+
+    if not html_string:
+        return safe_dom.NodeList()
+
+    if render_custom_tags:
+        fragment = _get_fragment(html_string, handler, tag_bindings)
+        if fragment is not None:
+            return _render_fragment(fragment, handler, tag_bindings)
+
+    return _SafeDomBuilder(
+        handler, tag_bindings, render_custom_tags=render_custom_tags
+    ).convert(html_string)
+
+
 def get_components_from_html(html, use_lxml=_LXML_AVAILABLE):
     """Returns a list of dicts representing the components in a lesson.
 
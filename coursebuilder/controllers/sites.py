@@ -648,6 +648,40 @@ class AssetHandler(utils.BaseHandler):
             models.MemcacheManager.end_readonly()
 
 
+class PathTrie(object):
+    """A tree of '/' separated path parts; any node may hold a value.
+
+    Looking up a path walks the tree once, part by part, so the time it takes
+    depends on the number of parts in the path, not on the number of paths
+    in the tree.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.children = {}
+
+    def add(self, parts, value):
+        node = self
+        for part in parts:
+            node = node.children.setdefault(part, PathTrie())
+        node.value = value
+
+    def walk(self, parts):
+        """Yields the root, then nodes matching each part of the path."""
+        node = self
+        yield node
+        for part in parts:
+            node = node.children.get(part)
+            if not node:
+                return
+            yield node
+
+
+# max number of paths for which a course or a handler is remembered; if more
+# paths are looked up, the remembered ones are forgotten
+MAX_MEMOIZED_PATHS = 1000
+
+
 class CourseIndex(object):
     """A list of all application contexts."""
 
@@ -657,7 +691,8 @@ class CourseIndex(object):
     def __init__(self, all_contexts):
         self._all_contexts = all_contexts
         self._namespace2app_context = {}
-        self._slug_parts2app_context = {}
+        self._slug_parts2app_context = PathTrie()
+        self._path2app_context = {}
         self._reindex()
 
     @classmethod
@@ -684,38 +719,24 @@ class CourseIndex(object):
     def _update_slug_parts_index(self, app_context):
         """An index is a tree keyed by slug part."""
         _parts = self._slug_to_parts(app_context.get_slug())
-        _parent = self._slug_parts2app_context
-        while True:
-            if not _parts:
-                _parent[None] = app_context
-                break
-            _part = _parts.pop(0)
-            _node = _parent.get(_part)
-            if not _node:
-                _node = {_part: {}}
-                _parent.update(_node)
-            _parent = _parent[_part]
+        self._slug_parts2app_context.add(_parts or [], app_context)
 
     def _get_course_for_path_via_index(self, path):
+        if path in self._path2app_context:
+            return self._path2app_context[path]
+
         _result = None
         _valid, _parts = self._validate_and_split_path_to_parts(path)
-        if not _valid:
-            return None
-        _parent = self._slug_parts2app_context
-        while True:
-            if not _parts:
-                if _parent:
-                    _result = _parent.get(None)
-                break
-            _part = _parts.pop(0)
-            _node = _parent.get(_part)
-            if not _node:
-                if _parent:
-                    _result = _parent.get(None)
-                break
-            _parent = _node
+        if _valid:
+            # the course is the one at the deepest node matching the path
+            for _node in self._slug_parts2app_context.walk(_parts or []):
+                _result = _node.value
         if not _result:
             debug('No mapping for: %s' % path)
+
+        if len(self._path2app_context) >= MAX_MEMOIZED_PATHS:
+            self._path2app_context = {}
+        self._path2app_context[path] = _result
         return _result
 
     def _reindex(self):
@@ -1340,6 +1361,99 @@ class _Route(object):
         self.handler_method = handler_method
 
 
+def _is_star_route(handler):
+    return isinstance(handler, utils.StarRouteHandlerMixin) or (
+        issubclass(handler, utils.StarRouteHandlerMixin))
+
+
+class UrlsMap(dict):
+    """A map of URLs to handlers, which also picks a handler for a path.
+
+    Star route handlers are compiled into a PathTrie on first use. Any change
+    to the map throws the trie away, along with the handlers remembered for
+    recently seen paths.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(UrlsMap, self).__init__(*args, **kwargs)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._star_routes = None
+        self._path2handler = {}
+
+    def __setitem__(self, key, value):
+        super(UrlsMap, self).__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        super(UrlsMap, self).__delitem__(key)
+        self._invalidate()
+
+    def clear(self):
+        super(UrlsMap, self).clear()
+        self._invalidate()
+
+    def pop(self, *args):
+        value = super(UrlsMap, self).pop(*args)
+        self._invalidate()
+        return value
+
+    def setdefault(self, key, default=None):
+        value = super(UrlsMap, self).setdefault(key, default)
+        self._invalidate()
+        return value
+
+    def update(self, *args, **kwargs):
+        super(UrlsMap, self).update(*args, **kwargs)
+        self._invalidate()
+
+    @classmethod
+    def _split_path(cls, path):
+        return [part for part in path.split('/') if part]
+
+    def _compile_star_routes(self):
+        star_routes = PathTrie()
+        for path, handler in self.iteritems():
+            parts = self._split_path(path)
+            # Partial matches are made of whole parts; e.g. '/a/' never
+            # matches partially, while '/' matches any path.
+            if path == '/' + '/'.join(parts) and _is_star_route(handler):
+                star_routes.add(parts, handler)
+        return star_routes
+
+    def _find_handler(self, path):
+        # Checks if path maps in its entirety.
+        if path in self:
+            return self[path]
+
+        # Check if partial path maps. For now, let only classes of type
+        # utils.StarRouteHandlerMixin handle partial matches. We want to find
+        # the longest possible match if alternatives exist; the root handler
+        # is the least specific of all.
+        star_routes = self._star_routes
+        if star_routes is None:
+            star_routes = self._compile_star_routes()
+            self._star_routes = star_routes
+        candidate = None
+        for node in star_routes.walk(self._split_path(path)):
+            if node.value:
+                candidate = node.value
+        return candidate
+
+    def get_handler_for_path(self, path):
+        """Picks a handler to handle the path."""
+        path2handler = self._path2handler
+        if path in path2handler:
+            return path2handler[path]
+        handler = self._find_handler(path)
+        if len(path2handler) >= MAX_MEMOIZED_PATHS:
+            path2handler = {}
+            self._path2handler = path2handler
+        path2handler[path] = handler
+        return handler
+
+
 class ApplicationRequestHandler(webapp2.RequestHandler):
     """Handles dispatching of all URL's to proper handlers."""
 
@@ -1410,7 +1524,7 @@ class ApplicationRequestHandler(webapp2.RequestHandler):
     def bind(cls, urls):
         urls_map = {}
         cls.bind_to(urls, urls_map)
-        cls.urls_map = urls_map
+        cls.urls_map = UrlsMap(urls_map)
 
     def get_handler(self, verb, path):
         """Finds a course suitable for handling this request."""
@@ -1442,37 +1556,11 @@ class ApplicationRequestHandler(webapp2.RequestHandler):
         return can_handle_course_requests(context)
 
     def is_star_route(self, handler):
-        return isinstance(handler, utils.StarRouteHandlerMixin) or (
-            issubclass(handler, utils.StarRouteHandlerMixin))
+        return _is_star_route(handler)
 
     def _get_handler_factory_for_path(self, path):
         """Picks a handler to handle the path."""
-        # Checks if path maps in its entirety.
-        if path in ApplicationRequestHandler.urls_map:
-            return ApplicationRequestHandler.urls_map[path]
-
-        # Check if partial path maps. For now, let only classes of type
-        # utils.StarRouteHandlerMixin handle partial matches. We want to find
-        # the longest possible match if alternatives exist.
-        parts = path.split('/')
-        candidate = None
-        partial_path = ''
-        for part in parts:
-            if part:
-                partial_path += '/' + part
-                if partial_path in ApplicationRequestHandler.urls_map:
-                    handler = ApplicationRequestHandler.urls_map[partial_path]
-                    if self.is_star_route(handler):
-                        candidate = handler
-
-        # check if root handler exists; it will not be matched above as it's
-        # the least specific of all
-        if not candidate:
-            handler = ApplicationRequestHandler.urls_map.get('/')
-            if handler and self.is_star_route(handler):
-                candidate = handler
-
-        return candidate
+        return ApplicationRequestHandler.urls_map.get_handler_for_path(path)
 
     def get_handler_for_course_type(self, context, path):
         """Gets the right handler for the given context and path."""
@@ -1781,7 +1869,13 @@ class WSGIRouter(webapp2.Router):
         super(WSGIRouter, self).__init__(routes)
 
     def dispatch(self, request, response):
-        result = super(WSGIRouter, self).dispatch(request, response)
+        # Global routes are served without path info, so they do not start
+        # or end a request scope of their own; do it for every request.
+        caching.RequestScopedSingleton.clear_all()
+        try:
+            result = super(WSGIRouter, self).dispatch(request, response)
+        finally:
+            caching.RequestScopedSingleton.clear_all()
         if result:
             response = result
 
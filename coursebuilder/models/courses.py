@@ -19,12 +19,15 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 import collections
 import copy
 from datetime import datetime
+import hashlib
 import logging
 import os
 import pickle
 import re
 import sys
 import threading
+import time
+import counters
 import custom_units
 
 import messages
@@ -37,6 +40,7 @@ import vfs
 import yaml
 
 import appengine_config
+from common import caching
 from common import locales
 from common import safe_dom
 from common import schema_fields
@@ -417,28 +421,17 @@ class AbstractCachedObject(object):
     """Abstract serializable versioned object that can stored in memcache."""
 
     @classmethod
-    def _max_size(cls):
-        # By default, max out at one cache record.
-        return models.MEMCACHE_MAX
-
-    @classmethod
-    def _make_keys(cls):
+    def _make_key(cls):
         # The course content files may change between deployment. To avoid
         # reading old cached values by the new version of the application we
         # add deployment version to the key. Now each version of the
         # application can put/get its own version of the course and the
         # deployment.
 
-        # Generate the maximum number of cache shard keys indicated by the max
-        # allowed size of the derived type.  Not all of these will necessarily
-        # be used, but the number of shards is typically very small (max of 4)
-        # so pre-generating these is not a big burden.
-        num_shards = (
-            (cls._max_size() + models.MEMCACHE_MAX - 1) // models.MEMCACHE_MAX)
-        return [
-            'course:model:pickle:%s:%s:%d' % (
-                cls.VERSION, os.environ.get('CURRENT_VERSION_ID'), shard)
-            for shard in xrange(num_shards)]
+        # Objects larger than models.MEMCACHE_MAX are compressed and sharded
+        # by MemcacheManager as needed.
+        return 'course:model:pickle:%s:%s' % (
+            cls.VERSION, os.environ.get('CURRENT_VERSION_ID'))
 
     @classmethod
     def new_memento(cls):
@@ -458,67 +451,33 @@ class AbstractCachedObject(object):
     @classmethod
     def load(cls, app_context):
         """Loads instance from memcache; does not fail on errors."""
-        shard_keys = cls._make_keys()
-        shard_contents = {}
+        key = cls._make_key()
         try:
-            shard_0 = MemcacheManager.get(
-                shard_keys[0], namespace=app_context.get_namespace_name())
-            if not shard_0:
+            data = MemcacheManager.get(
+                key, namespace=app_context.get_namespace_name())
+            if not data:
                 return None
-
-            num_shards = ord(shard_0[0])
-            shard_contents[shard_keys[0]] = shard_0[1:]
-            if num_shards > 1:
-                shard_contents.update(MemcacheManager.get_multi(
-                    shard_keys[1:], namespace=app_context.get_namespace_name()))
-            if len(shard_contents) != num_shards:
-                return None
-
-            data = []
-            for shard_key in sorted(shard_contents.keys()):
-                data.append(shard_contents[shard_key])
             memento = cls.new_memento()
-            memento.deserialize(''.join(data))
+            memento.deserialize(data)
             return cls.instance_from_memento(app_context, memento)
 
         except Exception as e:  # pylint: disable=broad-except
             logging.error(
-                'Failed to load object \'%s\' from memcache. %s', shard_keys, e)
+                'Failed to load object \'%s\' from memcache. %s', key, e)
         return None
 
     @classmethod
     def save(cls, app_context, instance):
         """Saves instance to memcache."""
-
-        # If item to cache is too large, clear the old cached value for this
-        # item, and don't send the new, too-large item to cache.
-        data_bytes = cls.memento_from_instance(instance).serialize()
-        num_shards_required = (len(data_bytes) // models.MEMCACHE_MAX) + 1
-        data_bytes = chr(num_shards_required) + data_bytes
-        if len(data_bytes) > cls._max_size():
-            logging.warning(
-                'Not sending %d bytes for %s to Memcache; this is more '
-                'than the maximum limit of %d bytes.',
-                len(data_bytes), cls.__name__, cls._max_size())
-            cls.delete(app_context)
-            return
-
-        mapping = {}
-        shard_keys = cls._make_keys()
-        i = 0
-        while i < num_shards_required:
-            mapping[shard_keys[i]] = data_bytes[i * models.MEMCACHE_MAX:
-                                                (i + 1) * models.MEMCACHE_MAX]
-            i += 1
-        MemcacheManager.set_multi(
-            mapping, namespace=app_context.get_namespace_name())
+        MemcacheManager.set(
+            cls._make_key(), cls.memento_from_instance(instance).serialize(),
+            namespace=app_context.get_namespace_name())
 
     @classmethod
     def delete(cls, app_context):
         """Deletes instance from memcache."""
-        MemcacheManager.delete_multi(
-            cls._make_keys(),
-            namespace=app_context.get_namespace_name())
+        MemcacheManager.delete(
+            cls._make_key(), namespace=app_context.get_namespace_name())
 
     def serialize(self):
         """Saves instance to a pickle representation."""
@@ -787,6 +746,12 @@ class CourseModel12(object):
     def get_lessons(self, unit_id):
         return self._unit_id_to_lessons.get(str(unit_id), [])
 
+    def get_lessons_for_all_units(self):
+        lessons = []
+        for unit in self._units:
+            lessons.extend(self.get_lessons(unit.unit_id))
+        return lessons
+
     def find_unit_by_id(self, unit_id):
         """Finds a unit given its id."""
         for unit in self._units:
@@ -797,6 +762,18 @@ class CourseModel12(object):
     def get_parent_unit(self, unused_unit_id):
         return None  # This model does not support any kind of unit relations
 
+    def get_components_from_html(self, unused_key, html, use_lxml=True):
+        return common.tags.get_components_from_html(html, use_lxml)
+
+    def save_component_index(self):
+        pass  # This model does not keep an index of components
+
+    def get_component_locations(self):
+        return None  # This model does not keep an index of components
+
+    def set_component_locations(self, located):
+        return ComponentIndex13.count_locations(located)
+
     def get_review_filename(self, unit_id):
         """Returns the review filename from unit id."""
         return 'assets/js/review-%s.js' % unit_id
@@ -1190,14 +1167,217 @@ class PersistentCourse13(object):
         self._from_dict(adict)
 
 
+class OutlineIndex13(object):
+    """Lookup tables over units and lessons of a course (version 1.3).
+
+    Units and lessons are referred to by their position in the lists of
+    units and lessons of the course, so the index can be pickled along with
+    these lists and shared among copies of the course. The index is never
+    changed; CourseModel13 builds a new one whenever units or lessons are
+    added, removed, moved or reordered. As everywhere in CourseModel13, ids
+    are compared as strings.
+    """
+
+    def __init__(self, units, lessons):
+        self.unit_positions = {}
+        self.parent_unit_positions = {}
+        for position, unit in enumerate(units):
+            self.unit_positions.setdefault(str(unit.unit_id), position)
+            self.parent_unit_positions.setdefault(
+                str(unit.pre_assessment), position)
+            self.parent_unit_positions.setdefault(
+                str(unit.post_assessment), position)
+
+        self.lesson_positions = {}
+        unit_lesson_positions = {}
+        for position, lesson in enumerate(lessons):
+            self.lesson_positions.setdefault(str(lesson.lesson_id), position)
+            unit_lesson_positions.setdefault(
+                str(lesson.unit_id), []).append(position)
+        self.unit_lesson_positions = {
+            unit_id: tuple(positions)
+            for unit_id, positions in unit_lesson_positions.iteritems()}
+
+        # positions of lessons in the order they appear in the syllabus
+        self.syllabus_lesson_positions = tuple(
+            position for unit in units
+            for position in self.unit_lesson_positions.get(
+                str(unit.unit_id), ()))
+
+
+class ComponentIndex13(object):
+    """Components found in the HTML of lessons and assessments (version 1.3).
+
+    Lists of components are keyed by 'lesson:<id>' or 'unit:<id>' and stored
+    with the SHA-1 digest of the HTML they were found in; a list is used only
+    if the digest still matches, so the index never has to be invalidated.
+    One index is shared by the copies of a course in the in-process cache.
+    It is loaded from memcache, next to the cached course, when first used;
+    entries of changed lessons are updated when the course is saved, and the
+    index is written back then and after all lessons were looked up.
+
+    The index also keeps maps from question and question group IDs to the
+    lessons and assessments using them.  They are built by walking the whole
+    course once, and then kept up to date as lessons are saved.
+    """
+
+    # Components whose locations are kept, and the attribute with their ID.
+    LOCATED_COMPONENTS = {'question': 'quid', 'question-group': 'qgid'}
+
+    def __init__(self):
+        self._entries = None
+        self._locations = None
+        self._located = None
+        self._is_dirty = False
+
+    @classmethod
+    def _make_key(cls):
+        return 'course:model:components:%s:%s' % (
+            COURSE_MODEL_VERSION_1_3, os.environ.get('CURRENT_VERSION_ID'))
+
+    def _load(self, app_context):
+        if self._entries is None:
+            index = MemcacheManager.get(
+                self._make_key(), namespace=app_context.get_namespace_name(),
+                frozen=True) or {}
+            self._entries = dict(index.get('entries', {}))
+            # The maps are changed in place, so they can't share the value
+            # frozen in the cache.
+            self._locations = copy.deepcopy(index.get('locations'))
+            self._located = dict(index.get('located', {}))
+
+    @classmethod
+    def _fingerprint(cls, html):
+        # The index is shared through memcache by all instances; hash() is
+        # neither stable across builds nor free of collisions.
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        return hashlib.sha1(html).hexdigest()
+
+    def get(self, app_context, key, html):
+        """Returns the components found in html, or None if not indexed."""
+        self._load(app_context)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != self._fingerprint(html):
+            return None
+        return entry[1]
+
+    def put(self, app_context, key, html, components):
+        if not isinstance(html, basestring):
+            return  # e.g. a translation, which is made anew in each request
+        self._load(app_context)
+        if key in self._located:
+            # The HTML changed without the course being saved, e.g. by an
+            # import; the locations may be stale, so build them anew.
+            self._locations = None
+            self._located = {}
+        self._entries[key] = (
+            self._fingerprint(html),
+            tuple(dict(component) for component in components))
+        self._is_dirty = True
+
+    def remove(self, app_context, key):
+        self._load(app_context)
+        if self._entries.pop(key, None) is not None:
+            self._is_dirty = True
+
+    def get_locations(self, app_context):
+        """Returns the locations of questions and groups, or None if unknown.
+
+        Returns:
+          A 2-tuple of maps from question and question group IDs to their
+          locations, as in Course.get_component_locations(), except that
+          lessons are given as (unit_id, lesson_id) and assessments as
+          unit_id.
+        """
+        self._load(app_context)
+        if self._locations is None:
+            return None
+        return self._locations['question'], self._locations['question-group']
+
+    def set_locations(self, app_context, located):
+        """Replaces all locations of questions and groups.
+
+        Args:
+          app_context: The context of the course.
+          located: A dict with an item for each lesson and assessment of the
+              course.  The key is as for put(); the value is a 2-tuple of the
+              location, ('lessons', (unit_id, lesson_id)) or ('assessments',
+              unit_id), and the list of components found there.
+        """
+        self._load(app_context)
+        self._locations = dict(
+            (cpt_name, {}) for cpt_name in self.LOCATED_COMPONENTS)
+        self._located = {}
+        for key, (where, components) in located.iteritems():
+            self._locate(key, where, components)
+        self._is_dirty = True
+
+    def update_location(self, app_context, key, where, components):
+        """Moves the components counted for key; a where of None drops them."""
+        self._load(app_context)
+        if self._locations is None:
+            return  # they are all found when they are first needed
+        self._count(key, -1)
+        self._located.pop(key, None)
+        if where:
+            self._locate(key, where, components)
+        self._is_dirty = True
+
+    @classmethod
+    def count_locations(cls, located):
+        """Returns what get_locations() would after set_locations(located)."""
+        index = cls()
+        index._entries = {}  # Nothing is loaded or saved.
+        index.set_locations(None, located)
+        return index.get_locations(None)
+
+    def _locate(self, key, where, components):
+        ids = []
+        for component in components:
+            cpt_name = component.get('cpt_name')
+            if cpt_name not in self.LOCATED_COMPONENTS:
+                continue
+            try:
+                ids.append((cpt_name, long(
+                    component.get(self.LOCATED_COMPONENTS[cpt_name]))))
+            except ValueError:
+                logging.exception('Bad component ID found in "%s"', key)
+        self._located[key] = (where, tuple(ids))
+        self._count(key, 1)
+
+    def _count(self, key, delta):
+        if key not in self._located:
+            return
+        (kind, location), ids = self._located[key]
+        for cpt_name, cpt_id in ids:
+            cpt_locations = self._locations[cpt_name].setdefault(
+                cpt_id, {'lessons': {}, 'assessments': {}})
+            counts = cpt_locations[kind]
+            counts[location] = counts.get(location, 0) + delta
+            if not counts[location]:
+                del counts[location]
+                if not any(cpt_locations.values()):
+                    del self._locations[cpt_name][cpt_id]
+
+    def save(self, app_context):
+        if self._is_dirty:
+            MemcacheManager.set(
+                self._make_key(), {
+                    'entries': dict(self._entries),
+                    'locations': copy.deepcopy(self._locations),
+                    'located': dict(self._located)},
+                namespace=app_context.get_namespace_name(), frozen=True)
+            self._is_dirty = False
+
+
 class CachedCourse13(AbstractCachedObject):
     """A representation of a Course13 optimized for storing in memcache."""
 
     VERSION = COURSE_MODEL_VERSION_1_3
 
     def __init__(
-        self, next_id=None, units=None, lessons=None,
-        unit_id_to_lesson_ids=None):
+        self, next_id=None, units=None, lessons=None, outline=None):
 
         self.version = self.VERSION
         self.next_id = next_id
@@ -1208,13 +1388,7 @@ class CachedCourse13(AbstractCachedObject):
         # stores additional indexes used for performance optimizations. There
         # is no need to persist these indexes in durable storage, but it is
         # nice to have them in memcache.
-        self.unit_id_to_lesson_ids = unit_id_to_lesson_ids
-
-    @classmethod
-    def _max_size(cls):
-        # Cap at approximately 4M to avoid 1M single-cache-element limit,
-        # which is too small for larger courses.
-        return models.MEMCACHE_MAX * 4
+        self.outline = outline
 
     @classmethod
     def new_memento(cls):
@@ -1225,14 +1399,90 @@ class CachedCourse13(AbstractCachedObject):
         return CourseModel13(
             app_context, next_id=memento.next_id,
             units=memento.units, lessons=memento.lessons,
-            unit_id_to_lesson_ids=memento.unit_id_to_lesson_ids)
+            outline=memento.outline)
 
     @classmethod
     def memento_from_instance(cls, course):
         return CachedCourse13(
             next_id=course.next_id,
             units=course.units, lessons=course.lessons,
-            unit_id_to_lesson_ids=course.unit_id_to_lesson_ids)
+            outline=course.outline)
+
+
+# max number of deserialized courses kept in-process; one per course namespace
+MAX_PROCESS_CACHED_COURSES = 64
+
+CACHE_HIT_PROCESS = counters.PerfCounter(
+    'gcb-models-courses-cache-hit-process',
+    'A number of times a course was copied from the in-process cache '
+    'instead of being loaded from memcache or the datastore.')
+CACHE_MISS_PROCESS = counters.PerfCounter(
+    'gcb-models-courses-cache-miss-process',
+    'A number of times a course was not found in the in-process cache or '
+    'was found there at a stale version.')
+
+
+def _copy_course_element(element):
+    """Copies a unit or a lesson, including any containers it refers to."""
+    clone = element.__class__.__new__(element.__class__)
+    for name, value in element.__dict__.iteritems():
+        if isinstance(value, (dict, list, set)):
+            value = copy.deepcopy(value)
+        clone.__dict__[name] = value
+    return clone
+
+
+class ProcessScopedCourseCache(caching.ProcessScopedSingleton):
+    """This class holds in-process global cache of deserialized courses.
+
+    Courses are stored under their namespace together with the version read
+    from memcache before they were loaded; CourseModel13.save() and course
+    deletion change the version, which makes all processes ignore their
+    cached copies. Entries also expire after the same time as the course
+    cached in memcache, in case the course changes some other way.
+
+    Cached courses are never handed out; callers get their own copies. They
+    need them: the course is changed in place on almost every load, e.g. the
+    i18n module replaces unit and lesson attributes with translations for
+    the locale of the request, and editors change units and lessons before
+    saving them. Only the units and lessons are copied, which is still much
+    cheaper than unpickling the course; the outline and the component index
+    are shared.
+    """
+
+    @classmethod
+    def get_cache_len(cls):
+        # pylint: disable=protected-access
+        return len(cls.instance()._cache.items)
+
+    def __init__(self):
+        self._cache = caching.LRUCache(
+            max_item_count=MAX_PROCESS_CACHED_COURSES)
+
+    def get(self, app_context, version):
+        found, entry = self._cache.get(app_context.get_namespace_name())
+        if found:
+            created_on, cached_version, course = entry
+            if (cached_version == version and
+                time.time() - created_on < models.DEFAULT_CACHE_TTL_SECS):
+                CACHE_HIT_PROCESS.inc()
+                return course.clone(app_context)
+        CACHE_MISS_PROCESS.inc()
+        return None
+
+    def put(self, app_context, version, course):
+        self._cache.put(
+            app_context.get_namespace_name(),
+            (time.time(), version, course.clone(app_context)))
+
+    def delete(self, namespace_name):
+        self._cache.delete(namespace_name)
+
+
+CACHE_LEN_PROCESS = counters.PerfCounter(
+    'gcb-models-courses-cache-len-process',
+    'A number of courses in the in-process cache.')
+CACHE_LEN_PROCESS.poll_value = ProcessScopedCourseCache.get_cache_len
 
 
 class CourseModel13(object):
@@ -1240,37 +1490,75 @@ class CourseModel13(object):
 
     VERSION = COURSE_MODEL_VERSION_1_3
 
+    @classmethod
+    def _make_version_key(cls):
+        return 'course:model:version:%s:%s' % (
+            cls.VERSION, os.environ.get('CURRENT_VERSION_ID'))
+
+    @classmethod
+    def _get_version(cls, app_context):
+        version = MemcacheManager.get(
+            cls._make_version_key(),
+            namespace=app_context.get_namespace_name())
+        if version is None:
+            # Incrementing by zero adds the key only if it is still missing,
+            # so we never overwrite a version set by a concurrent save.
+            version = MemcacheManager.incr(
+                cls._make_version_key(), 0,
+                namespace=app_context.get_namespace_name(),
+                initial_value=int(time.time() * 1000))
+        return version
+
+    @classmethod
+    def _bump_version(cls, app_context):
+        cls.bump_version(app_context.get_namespace_name())
+
+    @classmethod
+    def bump_version(cls, namespace_name):
+        """Makes all processes drop their in-process copies of the course.
+
+        Called by save(), and by anything else that changes or removes the
+        course in a namespace, e.g. course deletion.
+        """
+        ProcessScopedCourseCache.instance().delete(namespace_name)
+        MemcacheManager.incr(
+            cls._make_version_key(), 1, namespace=namespace_name,
+            initial_value=int(time.time() * 1000))
+
     @classmethod
     def load(cls, app_context):
-        """Loads course from memcache or persistence."""
+        """Loads course from in-process cache, memcache or persistence."""
+
+        # The version is read before the course is loaded; if the course is
+        # saved in between, the copy we cache is already stale.
+        version = cls._get_version(app_context)
+        if version is not None:
+            course = ProcessScopedCourseCache.instance().get(
+                app_context, version)
+            if course:
+                return course
+
         course = CachedCourse13.load(app_context)
         if not course:
             course = PersistentCourse13.load(app_context)
             if course:
                 CachedCourse13.save(app_context, course)
+        if course and version is not None:
+            ProcessScopedCourseCache.instance().put(
+                app_context, version, course)
         return course
 
-    @classmethod
-    def _make_unit_id_to_lessons_lookup_dict(cls, lessons):
-        """Creates an index of unit.unit_id to unit.lessons."""
-        unit_id_to_lesson_ids = {}
-        for lesson in lessons:
-            key = str(lesson.unit_id)
-            if key not in unit_id_to_lesson_ids:
-                unit_id_to_lesson_ids[key] = []
-            unit_id_to_lesson_ids[key].append(str(lesson.lesson_id))
-        return unit_id_to_lesson_ids
-
     def __init__(
         self, app_context, next_id=None, units=None, lessons=None,
-        unit_id_to_lesson_ids=None):
+        outline=None, components=None):
 
         # Init default values.
         self._app_context = app_context
         self._next_id = 1  # a counter for creating sequential entity ids
         self._units = []
         self._lessons = []
-        self._unit_id_to_lesson_ids = {}
+        self._outline = None
+        self._components = components or ComponentIndex13()
 
         # These array keep dirty object in current transaction.
         self._dirty_units = []
@@ -1285,11 +1573,19 @@ class CourseModel13(object):
             self._units = units
         if lessons:
             self._lessons = lessons
-        if unit_id_to_lesson_ids:
-            self._unit_id_to_lesson_ids = unit_id_to_lesson_ids
+        if outline:
+            self._outline = outline
         else:
             self._index()
 
+    def clone(self, app_context):
+        """Makes a copy that can be changed without affecting this one."""
+        return CourseModel13(
+            app_context, next_id=self._next_id,
+            units=[_copy_course_element(unit) for unit in self._units],
+            lessons=[_copy_course_element(lesson) for lesson in self._lessons],
+            outline=self._outline, components=self._components)
+
     @property
     def app_context(self):
         return self._app_context
@@ -1307,8 +1603,8 @@ class CourseModel13(object):
         return self._lessons
 
     @property
-    def unit_id_to_lesson_ids(self):
-        return self._unit_id_to_lesson_ids
+    def outline(self):
+        return self._outline
 
     def _get_next_id(self):
         """Allocates next id in sequence."""
@@ -1318,8 +1614,7 @@ class CourseModel13(object):
 
     def _index(self):
         """Indexes units and lessons."""
-        self._unit_id_to_lesson_ids = self._make_unit_id_to_lessons_lookup_dict(
-            self._lessons)
+        self._outline = OutlineIndex13(self._units, self._lessons)
         index_units_and_lessons(self)
 
     def get_file_content(self, filename):
@@ -1375,18 +1670,17 @@ class CourseModel13(object):
         # To delete an activity/assessment one must look up its filename. This
         # requires a valid unit/lesson. If unit was deleted it's no longer
         # found in _units, same for lesson. So we temporarily install deleted
-        # unit/lesson array instead of actual. We also temporarily empty
-        # so _unit_id_to_lesson_ids is not accidentally used. This is a hack,
-        # and we will improve it as object model gets more complex, but for
-        # now it works fine.
+        # unit/lesson array instead of actual, along with an index of them.
+        # This is a hack, and we will improve it as object model gets more
+        # complex, but for now it works fine.
 
         units = self._units
         lessons = self._lessons
-        unit_id_to_lesson_ids = self._unit_id_to_lesson_ids
+        outline = self._outline
         try:
             self._units = self._deleted_units
             self._lessons = self._deleted_lessons
-            self._unit_id_to_lesson_ids = None
+            self._outline = OutlineIndex13(self._units, self._lessons)
 
             # Delete owned assessments.
             for unit in self._deleted_units:
@@ -1405,7 +1699,7 @@ class CourseModel13(object):
         finally:
             self._units = units
             self._lessons = lessons
-            self._unit_id_to_lesson_ids = unit_id_to_lesson_ids
+            self._outline = outline
 
     def _validate_settings_content(self, content):
         yaml.safe_load(content)
@@ -1417,6 +1711,7 @@ class CourseModel13(object):
             for locale in [None] + self.app_context.get_all_locales()]
         models.MemcacheManager.delete_multi(
             keys, namespace=self.app_context.get_namespace_name())
+        Course.bump_environ_version(self.app_context)
 
         self._app_context.clear_per_request_cache()
 
@@ -1468,6 +1763,7 @@ class CourseModel13(object):
         """Saves course to datastore and memcache."""
         self._flush_deleted_objects()
         self._update_dirty_objects()
+        self._update_component_index()
 
         self._dirty_units = []
         self._dirty_lessons = []
@@ -1477,6 +1773,7 @@ class CourseModel13(object):
         self._index()
         PersistentCourse13.save(self._app_context, self)
         CachedCourse13.delete(self._app_context)
+        self._bump_version(self._app_context)
 
     def get_units(self):
         return self._units[:]
@@ -1485,12 +1782,14 @@ class CourseModel13(object):
         return [x for x in self.get_units() if x.is_assessment()]
 
     def get_lessons(self, unit_id):
-        lesson_ids = self._unit_id_to_lesson_ids.get(str(unit_id))
-        lessons = []
-        if lesson_ids:
-            for lesson_id in lesson_ids:
-                lessons.append(self.find_lesson_by_id(None, lesson_id))
-        return lessons
+        return [
+            self._lessons[position] for position in
+            self._outline.unit_lesson_positions.get(str(unit_id), ())]
+
+    def get_lessons_for_all_units(self):
+        return [
+            self._lessons[position]
+            for position in self._outline.syllabus_lesson_positions]
 
     def get_assessment_filename(self, unit_id):
         """Returns assessment base filename."""
@@ -1514,28 +1813,77 @@ class CourseModel13(object):
 
     def find_unit_by_id(self, unit_id):
         """Finds a unit given its id."""
-        for unit in self._units:
-            if str(unit.unit_id) == str(unit_id):
-                return unit
-        return None
+        position = self._outline.unit_positions.get(str(unit_id))
+        if position is None:
+            return None
+        return self._units[position]
 
     def find_lesson_by_id(self, unused_unit, lesson_id):
         """Finds a lesson given its id."""
-        for lesson in self._lessons:
-            if str(lesson.lesson_id) == str(lesson_id):
-                return lesson
-        return None
+        position = self._outline.lesson_positions.get(str(lesson_id))
+        if position is None:
+            return None
+        return self._lessons[position]
 
     def get_parent_unit(self, unit_id):
         # See if the unit is an assessment being used as a pre/post
-        # unit lesson.
-        for unit in self.get_units():
-            if (str(unit.pre_assessment) == str(unit_id) or
-                str(unit.post_assessment) == str(unit_id)):
-                return unit
+        # unit lesson.  There are no other kinds of parentage.
+        position = self._outline.parent_unit_positions.get(str(unit_id))
+        if position is None:
+            return None
+        return self._units[position]
 
-        # Nope, no other kinds of parentage; no parent.
-        return None
+    def get_components_from_html(self, key, html, use_lxml=True):
+        """Returns the components in html, using the index of components."""
+        components = self._components.get(self._app_context, key, html)
+        if components is None:
+            components = common.tags.get_components_from_html(html, use_lxml)
+            self._components.put(self._app_context, key, html, components)
+        return [dict(component) for component in components]
+
+    def save_component_index(self):
+        self._components.save(self._app_context)
+
+    def get_component_locations(self):
+        return self._components.get_locations(self._app_context)
+
+    def set_component_locations(self, located):
+        self._components.set_locations(self._app_context, located)
+        return self._components.get_locations(self._app_context)
+
+    def _update_component_index(self):
+        """Re-indexes the components of changed lessons and assessments."""
+        for unit in self._dirty_units:
+            key = 'unit:%s' % unit.unit_id
+            unit = self.find_unit_by_id(unit.unit_id)
+            where = None
+            if unit and unit.type == verify.UNIT_TYPE_ASSESSMENT:
+                where = ('assessments', unit.unit_id)
+            self._reindex_components(
+                key, where, getattr(unit, 'html_content', None))
+
+        for lesson in self._dirty_lessons:
+            key = 'lesson:%s' % lesson.lesson_id
+            lesson = self.find_lesson_by_id(None, lesson.lesson_id)
+            unit = self.find_unit_by_id(lesson.unit_id) if lesson else None
+            where = None
+            if unit and unit.type == verify.UNIT_TYPE_UNIT:
+                where = ('lessons', (unit.unit_id, lesson.lesson_id))
+            self._reindex_components(
+                key, where, lesson.objectives if lesson else None)
+        self.save_component_index()
+
+    def _reindex_components(self, key, where, html):
+        # Drop the old location first, or indexing the new HTML is taken for
+        # a change made without saving the course.
+        self._components.update_location(self._app_context, key, None, [])
+        if html:
+            components = self.get_components_from_html(key, html)
+        else:
+            components = []
+            self._components.remove(self._app_context, key)
+        self._components.update_location(
+            self._app_context, key, where, components)
 
     def add_unit(self, unit_type, title, custom_unit_type=None):
         """Adds a brand new unit."""
@@ -1625,6 +1973,7 @@ class CourseModel13(object):
             self._app_context.fs.impl.delete(entity)
         assert not self._app_context.fs.impl.list(appengine_config.BUNDLE_ROOT)
         CachedCourse13.delete(self._app_context)
+        self._bump_version(self._app_context)
 
     def delete_lesson(self, lesson):
         """Delete a lesson."""
@@ -1687,6 +2036,8 @@ class CourseModel13(object):
             existing_unit.html_review_form = unit.html_review_form
             existing_unit.workflow_yaml = unit.workflow_yaml
 
+        self._index()
+
         self._dirty_units.append(existing_unit)
         return existing_unit
 
@@ -2334,6 +2685,65 @@ class Workflow(object):
             return False
 
 
+# max number of course environments kept in-process; there is one for each
+# course, locale and combination of COURSE_ENV_POST_COPY_HOOKS cache keys
+MAX_PROCESS_CACHED_ENVIRONS = 256
+
+ENVIRON_CACHE_HIT = counters.PerfCounter(
+    'gcb-models-courses-environ-cache-hit',
+    'A number of times a course environment was copied from the request or '
+    'in-process cache instead of running COURSE_ENV_POST_COPY_HOOKS.')
+ENVIRON_CACHE_MISS = counters.PerfCounter(
+    'gcb-models-courses-environ-cache-miss',
+    'A number of times COURSE_ENV_POST_COPY_HOOKS were run to compute '
+    'a course environment.')
+
+
+def _copy_environ(value):
+    """Same as copy.deepcopy(), but faster for dicts, lists and scalars."""
+    value_type = type(value)
+    if value_type is dict:
+        return {key: _copy_environ(item) for key, item in value.iteritems()}
+    if value_type is list:
+        return [_copy_environ(item) for item in value]
+    if value_type in (str, unicode, int, long, float, bool, type(None)):
+        return value
+    return copy.deepcopy(value)
+
+
+class RequestScopedEnvironCache(caching.RequestScopedSingleton):
+    """Holds environ versions and environments used during this request."""
+
+    def __init__(self):
+        self.versions = {}
+        self.environs = {}
+
+
+class ProcessScopedEnvironCache(caching.ProcessScopedSingleton):
+    """Holds environments as modified by COURSE_ENV_POST_COPY_HOOKS.
+
+    Entries are keyed by the version of the course settings, so saving the
+    settings makes all processes stop using them. Entries also expire after
+    the same time as the settings cached in memcache, in case course.yaml is
+    changed without invalidating the cached settings.
+    """
+
+    def __init__(self):
+        self._cache = caching.LRUCache(
+            max_item_count=MAX_PROCESS_CACHED_ENVIRONS)
+
+    def get(self, key):
+        found, entry = self._cache.get(key)
+        if found:
+            created_on, env = entry
+            if time.time() - created_on < models.DEFAULT_CACHE_TTL_SECS:
+                return env
+        return None
+
+    def put(self, key, env):
+        self._cache.put(key, (time.time(), env))
+
+
 class Course(object):
     """Manages a course and all of its components."""
 
@@ -2402,6 +2812,16 @@ class Course(object):
     # Return values from callbacks are ignored.
     COURSE_ENV_POST_COPY_HOOKS = []
 
+    # Functions computing what the result of each of the callbacks above
+    # depends on, keyed by the callback.  The environment as modified by the
+    # callbacks is cached, and reused as long as the course settings and the
+    # values returned by these functions stay the same.  If any of the
+    # callbacks has no function here, the callbacks are run every time.
+    #
+    # Functions are passed the current application context and return a
+    # hashable value.
+    COURSE_ENV_POST_COPY_HOOK_CACHE_KEYS = {}
+
     # Holds callback functions which are passed the course env dict after it is
     # saved.
     COURSE_ENV_POST_SAVE_HOOKS = []
@@ -2449,9 +2869,81 @@ class Course(object):
         return 'course:environ:locale:%s:%s' % (
             os.environ.get('CURRENT_VERSION_ID'), locale)
 
+    @classmethod
+    def make_environ_version_key(cls):
+        """Returns key of the settings version, changed when they are saved."""
+        return 'course:environ:version:%s' % os.environ.get(
+            'CURRENT_VERSION_ID')
+
+    @classmethod
+    def _get_environ_version(cls, app_context):
+        versions = RequestScopedEnvironCache.instance().versions
+        namespace = app_context.get_namespace_name()
+        if namespace not in versions:
+            version = models.MemcacheManager.get(
+                cls.make_environ_version_key(), namespace=namespace)
+            if version is None:
+                # Incrementing by zero adds the key only if it is still
+                # missing, so we never overwrite a version set by a save.
+                version = models.MemcacheManager.incr(
+                    cls.make_environ_version_key(), 0, namespace=namespace,
+                    initial_value=int(time.time() * 1000))
+            versions[namespace] = version
+        return versions[namespace]
+
+    @classmethod
+    def bump_environ_version(cls, app_context):
+        """Makes all processes stop using environments cached in-process."""
+        models.MemcacheManager.incr(
+            cls.make_environ_version_key(), 1,
+            namespace=app_context.get_namespace_name(),
+            initial_value=int(time.time() * 1000))
+
+    @classmethod
+    def _make_environ_cache_key(cls, app_context, env):
+        """Makes key of the env as modified by COURSE_ENV_POST_COPY_HOOKS."""
+        hook_keys = []
+        old_get_environ = cls.get_environ
+        try:
+            cls.get_environ = classmethod(lambda cl, ac: env)
+            for hook in cls.COURSE_ENV_POST_COPY_HOOKS:
+                make_key = cls.COURSE_ENV_POST_COPY_HOOK_CACHE_KEYS.get(hook)
+                if not make_key:
+                    return None
+                hook_keys.append(make_key(app_context))
+        finally:
+            # Restore the original method from monkey-patch
+            cls.get_environ = old_get_environ
+        return (
+            app_context.get_namespace_name(),
+            app_context.get_current_locale(),
+            cls._get_environ_version(app_context),
+            tuple(hook_keys))
+
+    @classmethod
+    def _get_cached_environ(cls, key, base_env):
+        # Envs cached for this request are only used while the env they were
+        # made from is in use; it is reloaded if settings are changed.
+        request_cache = RequestScopedEnvironCache.instance()
+        cached_base_env, env = request_cache.environs.get(key, (None, None))
+        if cached_base_env is base_env:
+            return env
+        if key[2] is not None:
+            env = ProcessScopedEnvironCache.instance().get(key)
+            if env is not None:
+                request_cache.environs[key] = (base_env, env)
+                return env
+        return None
+
+    @classmethod
+    def _put_cached_environ(cls, key, base_env, env):
+        RequestScopedEnvironCache.instance().environs[key] = (base_env, env)
+        if key[2] is not None:
+            ProcessScopedEnvironCache.instance().put(key, env)
+
     @classmethod
     def _run_env_post_copy_hooks(cls, app_context, env):
-        env = copy.deepcopy(env)
+        env = _copy_environ(env)
 
         # Monkey patch to defend against infinite recursion. Downstream
         # calls do not reload the env but just return the copy we have here.
@@ -2480,22 +2972,42 @@ class Course(object):
     @classmethod
     def get_environ(cls, app_context):
         """Returns currently defined course settings as a dictionary."""
+        base_env = cls._get_environ_before_post_copy_hooks(app_context)
+
+        # get env as modified by post copy hooks from request or process cache
+        key = cls._make_environ_cache_key(app_context, base_env)
+        if key:
+            env = cls._get_cached_environ(key, base_env)
+            if env is not None:
+                ENVIRON_CACHE_HIT.inc()
+                return _copy_environ(env)
+
+        ENVIRON_CACHE_MISS.inc()
+        env = cls._run_env_post_copy_hooks(app_context, base_env)
+        if key:
+            cls._put_cached_environ(key, base_env, _copy_environ(env))
+        return env
+
+    @classmethod
+    def _get_environ_before_post_copy_hooks(cls, app_context):
+        """Returns env shared by all callers; it must not be modified."""
         # pylint: disable=protected-access
 
         # get from local cache
         env = app_context._cached_environ
         if env:
-            return cls._run_env_post_copy_hooks(app_context, env)
+            return env
 
         # get from global cache
         _locale = app_context.get_current_locale()
         _key = cls.make_locale_environ_key(_locale)
+        # the env is never mutated; the post copy hooks work on a deep copy
         env = models.MemcacheManager.get(
-            _key, namespace=app_context.get_namespace_name())
+            _key, namespace=app_context.get_namespace_name(), frozen=True)
         if env:
             # put into local cache
             app_context._cached_environ = env
-            return cls._run_env_post_copy_hooks(app_context, env)
+            return env
 
         models.MemcacheManager.begin_readonly()
         try:
@@ -2506,11 +3018,12 @@ class Course(object):
             # put into local and global cache
             app_context._cached_environ = env
             models.MemcacheManager.set(
-                _key, env, namespace=app_context.get_namespace_name())
+                _key, env, namespace=app_context.get_namespace_name(),
+                frozen=True)
         finally:
             models.MemcacheManager.end_readonly()
 
-        return cls._run_env_post_copy_hooks(app_context, env)
+        return env
 
 
     @classmethod
@@ -3117,11 +3630,7 @@ class Course(object):
         return self._model.get_lessons(unit_id)
 
     def get_lessons_for_all_units(self):
-        lessons = []
-        for unit in self.get_units():
-            for lesson in self.get_lessons(unit.unit_id):
-                lessons.append(lesson)
-        return lessons
+        return self._model.get_lessons_for_all_units()
 
     def get_unit_for_lesson(self, the_lesson):
         for unit in self.get_units():
@@ -3369,8 +3878,8 @@ class Course(object):
         if not lesson.objectives:
             return []
 
-        return common.tags.get_components_from_html(
-            lesson.objectives, use_lxml)
+        return self._model.get_components_from_html(
+            'lesson:%s' % lesson.lesson_id, lesson.objectives, use_lxml)
 
     def get_content_as_dict_safe(self, unit, errors, kind='assessment'):
         """Validate the assessment or review script and return as a dict."""
@@ -3406,7 +3915,8 @@ class Course(object):
         if not getattr(unit, 'html_content', None):
             return []
 
-        return common.tags.get_components_from_html(unit.html_content)
+        return self._model.get_components_from_html(
+            'unit:%s' % unit.unit_id, unit.html_content)
 
     def get_components_with_name(self, unit_id, lesson_id, component_name):
         """Returns a list of dicts representing this component in a lesson."""
@@ -3458,49 +3968,42 @@ class Course(object):
             ]
         """
 
+        locations = self._model.get_component_locations()
+        if locations is None:
+            located = {}
+            for unit in self.get_units():
+                if unit.type == verify.UNIT_TYPE_ASSESSMENT:
+                    located['unit:%s' % unit.unit_id] = (
+                        ('assessments', unit.unit_id),
+                        self.get_assessment_components(unit.unit_id))
+                elif unit.type == verify.UNIT_TYPE_UNIT:
+                    for lesson in self.get_lessons(unit.unit_id):
+                        located['lesson:%s' % lesson.lesson_id] = (
+                            ('lessons', (unit.unit_id, lesson.lesson_id)),
+                            self.get_components(
+                                unit.unit_id, lesson.lesson_id))
+            locations = self._model.set_component_locations(located)
+
+            # Components of every lesson were looked up, so this is a good
+            # time to share any that were not indexed yet.
+            self._model.save_component_index()
+
+        # The index refers to units and lessons by ID.
         qulocations = {}
         qglocations = {}
-
-        def _add_to_map(component, unit, lesson=None):
-            try:
-                if component.get('cpt_name') == 'question':
-                    compononent_locations = qulocations.setdefault(
-                        long(component.get('quid')),
-                        {'lessons': {}, 'assessments': {}}
-                    )
-                elif component.get('cpt_name') == 'question-group':
-                    compononent_locations = qglocations.setdefault(
-                        long(component.get('qgid')),
-                        {'lessons': {}, 'assessments': {}}
-                    )
-                else:
-                    return
-            except ValueError:
-                title = lesson.title if lesson else unit.title
-                logging.exception('Bad component ID found in "%s"', title)
-                return
-
-            if lesson is not None:
-                lessons = compononent_locations.setdefault(
-                    'lessons', {})
-                lessons[(lesson, unit)] = lessons.get(
-                    (lesson, unit), 0) + 1
-            else:
-                assessments = compononent_locations.setdefault(
-                    'assessments', {})
-                assessments[unit] = assessments.get(unit, 0) + 1
-
-        for unit in self.get_units():
-            if unit.type == verify.UNIT_TYPE_ASSESSMENT:
-                for component in self.get_assessment_components(unit.unit_id):
-                    _add_to_map(component, unit)
-
-            elif unit.type == verify.UNIT_TYPE_UNIT:
-                for lesson in self.get_lessons(unit.unit_id):
-                    for component in self.get_components(
-                            unit.unit_id, lesson.lesson_id):
-                        _add_to_map(component, unit, lesson)
-
+        for id_locations, object_locations in zip(
+                locations, (qulocations, qglocations)):
+            for cpt_id, where in id_locations.iteritems():
+                lessons = {}
+                for (unit_id, lesson_id), count in where['lessons'].iteritems():
+                    unit = self.find_unit_by_id(unit_id)
+                    lessons[(self.find_lesson_by_id(unit, lesson_id),
+                             unit)] = count
+                assessments = {}
+                for unit_id, count in where['assessments'].iteritems():
+                    assessments[self.find_unit_by_id(unit_id)] = count
+                object_locations[cpt_id] = {
+                    'lessons': lessons, 'assessments': assessments}
         return (qulocations, qglocations)
 
     def needs_human_grader(self, unit):
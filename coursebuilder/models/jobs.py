@@ -684,8 +684,8 @@ class MapReduceJob(DurableJobBase):
           of this job's MapReduceEntity
         """
         complete_fn = None
-        if (inspect.getsource(self.combine) !=
-            inspect.getsource(MapReduceJob.combine)):
+        if (inspect.getsource(self.complete) !=
+            inspect.getsource(MapReduceJob.complete)):
             complete_fn = '%s.%s.complete' % (
                 self.__class__.__module__, self.__class__.__name__)
         return {
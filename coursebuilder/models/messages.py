@@ -413,6 +413,13 @@ this setting to "False" so you can see your changes instantaneously. Otherwise,
 keep this setting at "True" to maximize performance.
 """
 
+SITE_SETTINGS_CACHE_CONTENT_RESYNC_INTERVAL = """
+The minimum number of milliseconds between two checks of the datastore for
+changes to cached course content, per course and per frontend instance. Changes
+made through Course Builder are still seen immediately on all instances. Set to
+0 to check on every request.
+"""
+
 SITE_SETTINGS_COURSE_URLS = safe_dom.NodeList().append(
     safe_dom.Element('div').add_text("""
 Specify the URLs for your course(s). Specify only one course per line.""")
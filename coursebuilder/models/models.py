@@ -19,11 +19,14 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 import collections
 import copy
 import datetime
+import hashlib
 import logging
 import os
+import pickle
 import sys
 import time
 import webapp2
+import zlib
 
 import jinja2
 
@@ -31,6 +34,7 @@ import config
 import counters
 from counters import PerfCounter
 from entities import BaseEntity
+from entities import DB_PUT
 from entities import delete
 from entities import get
 from entities import put
@@ -99,10 +103,89 @@ CACHE_MISS_LOCAL = PerfCounter(
     'gcb-models-cache-miss-local',
     'A number of times an object was not found in local memcache.')
 
+# performance counters for values larger than MEMCACHE_MAX
+CACHE_PUT_LARGE = PerfCounter(
+    'gcb-models-cache-put-large',
+    'A number of times a large object was compressed and put into memcache '
+    'in shards.')
+CACHE_PUT_LARGE_RAW_BYTES = PerfCounter(
+    'gcb-models-cache-put-large-raw-bytes',
+    'A total size of large objects put into memcache before compression.')
+CACHE_PUT_LARGE_COMPRESSED_BYTES = PerfCounter(
+    'gcb-models-cache-put-large-compressed-bytes',
+    'A total size of large objects put into memcache after compression.')
+CACHE_PUT_LARGE_COMPRESSION_PERCENT = PerfCounter(
+    'gcb-models-cache-put-large-compression-percent',
+    'A size of large objects put into memcache after compression, as a '
+    'percentage of their size before compression.')
+CACHE_PUT_LARGE_COMPRESSION_PERCENT.poll_value = lambda: (
+    100 * CACHE_PUT_LARGE_COMPRESSED_BYTES.value //
+    CACHE_PUT_LARGE_RAW_BYTES.value if CACHE_PUT_LARGE_RAW_BYTES.value
+    else None)
+CACHE_GET_LARGE = PerfCounter(
+    'gcb-models-cache-get-large',
+    'A number of times a large object was assembled from memcache shards.')
+CACHE_GET_LARGE_FETCH_MSEC = PerfCounter(
+    'gcb-models-cache-get-large-fetch-msec',
+    'A total time in milliseconds spent fetching shards of large objects '
+    'from memcache.')
+CACHE_GET_LARGE_INCONSISTENT = PerfCounter(
+    'gcb-models-cache-get-large-inconsistent',
+    'A number of times a large object was dropped because some of its '
+    'memcache shards were missing or did not match its content hash.')
+
+# performance counters for batched writes of events
+EVENT_BATCH_PUT = PerfCounter(
+    'gcb-models-event-batch-put',
+    'A number of times a batch of events was put into datastore.')
+EVENT_BATCH_PUT_EVENTS = PerfCounter(
+    'gcb-models-event-batch-put-events',
+    'A number of events put into datastore in batches.')
+EVENT_BATCH_PUT_AVERAGE_SIZE = PerfCounter(
+    'gcb-models-event-batch-put-average-size',
+    'An average number of events put into datastore in one batch.')
+EVENT_BATCH_PUT_AVERAGE_SIZE.poll_value = lambda: (
+    EVENT_BATCH_PUT_EVENTS.value // EVENT_BATCH_PUT.value
+    if EVENT_BATCH_PUT.value else None)
+EVENT_BATCH_PUT_MSEC = PerfCounter(
+    'gcb-models-event-batch-put-msec',
+    'A total time in milliseconds spent putting batches of events into '
+    'datastore.')
+EVENT_BUFFERED = PerfCounter(
+    'gcb-models-event-buffered',
+    'A number of events held in the write-behind buffer until the end of '
+    'the request.')
+
+# Max number of events buffered in one namespace before the buffer is
+# flushed without waiting for the end of the request.
+MAX_BUFFERED_EVENTS = 100
+
 # Intent for sending welcome notifications.
 WELCOME_NOTIFICATION_INTENT = 'welcome'
 
 
+class LargeValueManifest(object):
+    """Stored in memcache instead of a value larger than MEMCACHE_MAX.
+
+    The value itself is pickled, compressed and stored in as many shards as
+    needed. Shard keys include the content hash, so a manifest never refers
+    to shards written for some other version of the value.
+    """
+
+    def __init__(self, num_shards, content_hash):
+        self.num_shards = num_shards
+        self.content_hash = content_hash
+
+    @classmethod
+    def make_shard_key(cls, key, content_hash, index):
+        return '%s:large:%s:%d' % (key, content_hash, index)
+
+    def get_shard_keys(self, key):
+        return [
+            self.make_shard_key(key, self.content_hash, index)
+            for index in xrange(self.num_shards)]
+
+
 class MemcacheManager(object):
     """Class that consolidates all memcache operations."""
 
@@ -241,17 +324,32 @@ class MemcacheManager(object):
         return cls.get_namespace()
 
     @classmethod
-    def get(cls, key, namespace=None):
-        """Gets an item from memcache if memcache is enabled."""
+    def get(cls, key, namespace=None, frozen=False):
+        """Gets an item from memcache if memcache is enabled.
+
+        A value fetched from memcache is a fresh object owned by the caller.
+        A value that is also held in the request-local cache is deep-copied,
+        unless the caller passes frozen=True and promises to never mutate the
+        value; such callers all share one reference to the cached value.
+
+        Args:
+          key: A memcache key.
+          namespace: A namespace for the key; defaults to the current one.
+          frozen: Whether the caller treats the value as read-only.
+        Returns:
+          The cached value or None.
+        """
         if not CAN_USE_MEMCACHE.value:
             return None
         _namespace = cls._get_namespace(namespace)
 
         is_cached, value = cls._local_cache_get(key, _namespace)
         if is_cached:
-            return copy.deepcopy(value)
+            return value if frozen else copy.deepcopy(value)
 
         value = memcache.get(key, namespace=_namespace)
+        if isinstance(value, LargeValueManifest):
+            value = cls._get_large(key, value, _namespace)
 
         # We store some objects in memcache that don't evaluate to True, but are
         # real objects, '{}' for example. Count a cache miss only in a case when
@@ -261,8 +359,11 @@ class MemcacheManager(object):
         else:
             CACHE_MISS.inc(context=key)
 
-        cls._local_cache_put(key, _namespace, value)
-        return copy.deepcopy(value)
+        if not cls._IS_READONLY or frozen:
+            cls._local_cache_put(key, _namespace, value)
+            return value
+        cls._local_cache_put(key, _namespace, copy.deepcopy(value))
+        return value
 
     @classmethod
     def get_multi(cls, keys, namespace=None):
@@ -274,10 +375,18 @@ class MemcacheManager(object):
 
         is_cached, values = cls._local_cache_get_multi(keys, _namespace)
         if is_cached:
-            return values
+            # Like memcache.get_multi(), return a dict of the keys found.
+            return {key: copy.deepcopy(value)
+                    for key, value in zip(keys, values) if value is not None}
 
         values = memcache.get_multi(keys, namespace=_namespace)
         for key, value in values.items():
+            if isinstance(value, LargeValueManifest):
+                value = cls._get_large(key, value, _namespace)
+                if value is None:
+                    del values[key]
+                    continue
+                values[key] = value
             if value is not None:
                 CACHE_HIT.inc()
             else:
@@ -289,19 +398,27 @@ class MemcacheManager(object):
 
     @classmethod
     def set(cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None,
-            propagate_exceptions=False):
-        """Sets an item in memcache if memcache is enabled."""
+            propagate_exceptions=False, frozen=False):
+        """Sets an item in memcache if memcache is enabled.
+
+        Memcache stores a serialized snapshot of the value, so the value only
+        needs to be copied when it is also put into the request-local cache.
+        Callers passing frozen=True promise to never mutate the value after
+        this call and skip that copy.
+        """
         # Ensure subsequent mods to value do not affect the cached copy.
-        value = copy.deepcopy(value)
+        if cls._IS_READONLY and not frozen:
+            value = copy.deepcopy(value)
 
         try:
             if CAN_USE_MEMCACHE.value:
-                size = sys.getsizeof(value)
+                size = caching.getsizeof(value)
+                _namespace = cls._get_namespace(namespace)
                 if size > MEMCACHE_MAX:
-                    CACHE_PUT_TOO_BIG.inc()
+                    if cls._set_large(key, value, ttl, _namespace):
+                        cls._local_cache_put(key, _namespace, value)
                 else:
                     CACHE_PUT.inc()
-                    _namespace = cls._get_namespace(namespace)
                     memcache.set(key, value, ttl, namespace=_namespace)
                     cls._local_cache_put(key, _namespace, value)
         except:  # pylint: disable=bare-except
@@ -319,14 +436,26 @@ class MemcacheManager(object):
             if CAN_USE_MEMCACHE.value:
                 if not mapping:
                     return
+                _namespace = cls._get_namespace(namespace)
+                sizes = {
+                    key: caching.getsizeof(value)
+                    for key, value in mapping.iteritems()}
+                for key, size in sizes.iteritems():
+                    if size > MEMCACHE_MAX:
+                        value = mapping[key]
+                        if cls._set_large(key, value, ttl, _namespace):
+                            cls._local_cache_put(key, _namespace, value)
+                mapping = {
+                    key: value for key, value in mapping.iteritems()
+                    if sizes[key] <= MEMCACHE_MAX}
                 size = sum([
-                    sys.getsizeof(key) + sys.getsizeof(value)
-                    for key, value in mapping.items()])
+                    sys.getsizeof(key) + sizes[key] for key in mapping])
+                if not mapping:
+                    return
                 if size > MEMCACHE_MULTI_MAX:
                     CACHE_PUT_TOO_BIG.inc()
                 else:
                     CACHE_PUT.inc()
-                    _namespace = cls._get_namespace(namespace)
                     memcache.set_multi(mapping, time=ttl, namespace=_namespace)
                     cls._local_cache_put_multi(mapping, _namespace)
         except:  # pylint: disable=bare-except
@@ -335,6 +464,65 @@ class MemcacheManager(object):
                 mapping, cls._get_namespace(namespace))
             return None
 
+    @classmethod
+    def _set_large(cls, key, value, ttl, namespace):
+        """Puts a compressed value in shards, followed by its manifest.
+
+        The manifest is put last, so readers never find it before its shards.
+        If the value can't be stored, any old value is deleted instead.
+
+        Args:
+          key: A memcache key.
+          value: A value too large to be put under a single key.
+          ttl: Time to live in seconds.
+          namespace: A namespace for the key.
+        Returns:
+          True if the value was stored, False otherwise.
+        """
+        raw_bytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        data = zlib.compress(raw_bytes)
+        if len(data) > MEMCACHE_MULTI_MAX:
+            CACHE_PUT_TOO_BIG.inc()
+            memcache.delete(key, namespace=namespace)
+            return False
+
+        content_hash = hashlib.sha1(data).hexdigest()
+        num_shards = (len(data) + MEMCACHE_MAX - 1) // MEMCACHE_MAX
+        mapping = {}
+        for index in xrange(num_shards):
+            mapping[LargeValueManifest.make_shard_key(
+                key, content_hash, index)] = data[
+                    index * MEMCACHE_MAX:(index + 1) * MEMCACHE_MAX]
+        if memcache.set_multi(mapping, time=ttl, namespace=namespace):
+            memcache.delete(key, namespace=namespace)
+            return False
+        memcache.set(
+            key, LargeValueManifest(num_shards, content_hash), ttl,
+            namespace=namespace)
+
+        CACHE_PUT_LARGE.inc()
+        CACHE_PUT_LARGE_RAW_BYTES.inc(increment=len(raw_bytes))
+        CACHE_PUT_LARGE_COMPRESSED_BYTES.inc(increment=len(data))
+        return True
+
+    @classmethod
+    def _get_large(cls, key, manifest, namespace):
+        """Assembles a value from its shards; returns None if inconsistent."""
+        shard_keys = manifest.get_shard_keys(key)
+        start = time.time()
+        shards = memcache.get_multi(shard_keys, namespace=namespace)
+        CACHE_GET_LARGE_FETCH_MSEC.inc(
+            increment=int((time.time() - start) * 1000))
+        if len(shards) != len(shard_keys):
+            CACHE_GET_LARGE_INCONSISTENT.inc()
+            return None
+        data = ''.join([shards[shard_key] for shard_key in shard_keys])
+        if hashlib.sha1(data).hexdigest() != manifest.content_hash:
+            CACHE_GET_LARGE_INCONSISTENT.inc()
+            return None
+        CACHE_GET_LARGE.inc()
+        return pickle.loads(zlib.decompress(data))
+
     @classmethod
     def delete(cls, key, namespace=None):
         """Deletes an item from memcache if memcache is enabled."""
@@ -353,12 +541,13 @@ class MemcacheManager(object):
                 key_list, namespace=cls._get_namespace(namespace))
 
     @classmethod
-    def incr(cls, key, delta, namespace=None):
-        """Incr an item in memcache if memcache is enabled."""
+    def incr(cls, key, delta, namespace=None, initial_value=0):
+        """Incr an item in memcache if memcache is enabled; returns value."""
         if CAN_USE_MEMCACHE.value:
-            memcache.incr(
+            return memcache.incr(
                 key, delta,
-                namespace=cls._get_namespace(namespace), initial_value=0)
+                namespace=cls._get_namespace(namespace),
+                initial_value=initial_value)
 
 
 CAN_AGGREGATE_COUNTERS = config.ConfigProperty(
@@ -1665,6 +1854,66 @@ class TransientStudent(object):
         return {}
 
 
+class _EventWriteBehindBuffer(caching.RequestScopedSingleton):
+    """Holds events recorded during a request until the request ends.
+
+    Buffered events are put into datastore asynchronously, one batch per
+    namespace, and the writes are waited for when the request scope is
+    cleared.
+    """
+
+    def __init__(self):
+        self._events_by_namespace = {}
+        self._rpcs = []
+        self._rpcs_started_on = None
+
+    @classmethod
+    def add(cls, event):
+        cls.instance()._add(event)
+
+    def _add(self, event):
+        namespace = namespace_manager.get_namespace()
+        events = self._events_by_namespace.setdefault(namespace, [])
+        events.append(event)
+        EVENT_BUFFERED.inc()
+        if len(events) >= MAX_BUFFERED_EVENTS:
+            self._put_async(namespace)
+
+    def _put_async(self, namespace):
+        events = self._events_by_namespace.pop(namespace, None)
+        if not events:
+            return
+        if self._rpcs_started_on is None:
+            self._rpcs_started_on = time.time()
+        with common_utils.Namespace(namespace):
+            self._rpcs.append(db.put_async(events))
+        DB_PUT.inc(increment=len(events))
+        EVENT_BATCH_PUT.inc()
+        EVENT_BATCH_PUT_EVENTS.inc(increment=len(events))
+
+    def flush(self):
+        for namespace in self._events_by_namespace.keys():
+            self._put_async(namespace)
+        try:
+            for rpc in self._rpcs:
+                try:
+                    rpc.get_result()
+                except Exception:  # On purpose. pylint: disable=broad-except
+                    logging.exception('Failed to put buffered events.')
+        finally:
+            if self._rpcs_started_on is not None:
+                EVENT_BATCH_PUT_MSEC.inc(increment=int(
+                    1000 * (time.time() - self._rpcs_started_on)))
+            self._rpcs = []
+            self._rpcs_started_on = None
+
+    def clear(self):
+        try:
+            self.flush()
+        finally:
+            super(_EventWriteBehindBuffer, self).clear()
+
+
 class EventEntity(BaseEntity):
     """Generic events.
 
@@ -1701,8 +1950,7 @@ class EventEntity(BaseEntity):
                     source, user.user_id(), data_dict)
 
     @classmethod
-    def record(cls, source, user, data, user_id=None):
-        """Records new event into a datastore."""
+    def _make_event(cls, source, user, data, user_id=None):
         data_dict = transforms.loads(data)
         cls._run_record_hooks(source, user, data_dict)
         data = transforms.dumps(data_dict)
@@ -1711,7 +1959,50 @@ class EventEntity(BaseEntity):
         event.source = source
         event.user_id = user_id if user_id else user.user_id()
         event.data = data
-        event.put()
+        return event
+
+    @classmethod
+    def record(cls, source, user, data, user_id=None, buffered=False):
+        """Records new event into a datastore.
+
+        Args:
+          source: string; where in the code the event was recorded.
+          user: users.User who triggered the event.
+          data: string; JSON representation of the event data.
+          user_id: string; the ID to record instead of the ID of the user.
+          buffered: bool; when True, the event is held in a per-request
+              write-behind buffer and put into datastore asynchronously, in
+              one batch with other buffered events, when the request ends.
+        """
+        event = cls._make_event(source, user, data, user_id=user_id)
+        if buffered:
+            _EventWriteBehindBuffer.add(event)
+        else:
+            event.put()
+
+    @classmethod
+    def record_multi(cls, events):
+        """Records new events into a datastore with a single batch put.
+
+        Args:
+          events: list of (source, user, data, user_id) tuples, with the
+              same meaning as the arguments of record().
+        """
+        entities = [
+            cls._make_event(source, user, data, user_id=user_id)
+            for source, user, data, user_id in events]
+        if not entities:
+            return
+        start = time.time()
+        put(entities)
+        EVENT_BATCH_PUT.inc()
+        EVENT_BATCH_PUT_EVENTS.inc(increment=len(entities))
+        EVENT_BATCH_PUT_MSEC.inc(increment=int(1000 * (time.time() - start)))
+
+    @classmethod
+    def flush_buffered(cls):
+        """Puts events held in the write-behind buffer into datastore now."""
+        _EventWriteBehindBuffer.instance().flush()
 
     def for_export(self, transform_fn):
         model = super(EventEntity, self).for_export(transform_fn)
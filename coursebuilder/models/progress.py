@@ -23,6 +23,7 @@ from collections import defaultdict
 
 import transforms
 
+from common import caching
 from common import utils
 from models import QuestionDAO
 from models import QuestionGroupDAO
@@ -37,6 +38,57 @@ TRACKABLE_COMPONENTS = [
 ]
 
 
+class _ParsedProgressCache(caching.RequestScopedSingleton):
+    """Holds the progress dicts decoded during this request.
+
+    They are kept here rather than on the entities, since entities are
+    pickled into memcache when they are put and would carry them along.
+    """
+
+    def __init__(self):
+        self.parsed_by_key = {}
+
+
+class _ParsedProgress(object):
+    """The decoded progress dict of a StudentPropertyEntity.
+
+    It is decoded once per entity; it remains valid for as long as the
+    entity's value is the one it was decoded from. Changes are made to the
+    dict and are encoded into the entity's value once, before the entity is
+    put.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        try:
+            self.progress_dict = transforms.loads(value) if value else {}
+        except (AttributeError, TypeError):
+            self.progress_dict = {}
+        self.dirty = False
+        self.student_property = None
+
+    @classmethod
+    def get(cls, student_property):
+        parsed_by_key = _ParsedProgressCache.instance().parsed_by_key
+        key = student_property.key()
+        parsed = parsed_by_key.get(key)
+        if (parsed is None or
+            parsed.student_property is not student_property or
+            parsed.value is not student_property.value):
+            parsed = cls(student_property.value)
+            parsed.student_property = student_property
+            parsed_by_key[key] = parsed
+        return parsed
+
+    def encode(self, student_property):
+        """Sets the value of the entity if the progress dict has changed."""
+        if not self.dirty:
+            return
+        student_property.value = transforms.dumps(self.progress_dict)
+        self.value = student_property.value
+        self.dirty = False
+
+
 class UnitLessonCompletionTracker(object):
     """Tracks student completion for a unit/lesson-based linear course."""
 
@@ -656,8 +708,7 @@ class UnitLessonCompletionTracker(object):
         if current_state == state or current_state == self.COMPLETED_STATE:
             return
         self._set_entity_value(progress, event_key, state)
-        progress.updated_on = datetime.datetime.now()
-        progress.put()
+        self._put_progress(progress)
 
     UPDATER_MAPPING = {
         'activity': _update_activity,
@@ -819,8 +870,7 @@ class UnitLessonCompletionTracker(object):
         self._update_event(
             student, progress, event_entity, event_key, direct_update=True)
 
-        progress.updated_on = datetime.datetime.now()
-        progress.put()
+        self._put_progress(progress)
 
     def _update_event(self, student, progress, event_entity, event_key,
                       direct_update=False):
@@ -1038,50 +1088,43 @@ class UnitLessonCompletionTracker(object):
             progress, unit_id, lesson_id, cpt_id) or 0
 
     def _get_entity_value(self, progress, event_key):
-        if not progress.value:
-            return None
-        return transforms.loads(progress.value).get(event_key)
+        return _ParsedProgress.get(progress).progress_dict.get(event_key)
 
     def _set_entity_value(self, student_property, key, value):
         """Sets the integer value of a student property.
 
         Note: this method does not commit the change. The calling method should
-        call put() on the StudentPropertyEntity.
+        call _put_progress() on the StudentPropertyEntity.
 
         Args:
           student_property: the StudentPropertyEntity
           key: the student property whose value should be incremented
           value: the value to increment this property by
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
-
-        progress_dict[key] = value
-        student_property.value = transforms.dumps(progress_dict)
+        parsed = _ParsedProgress.get(student_property)
+        parsed.progress_dict[key] = value
+        parsed.dirty = True
 
     def _inc(self, student_property, key, value=1):
         """Increments the integer value of a student property.
 
         Note: this method does not commit the change. The calling method should
-        call put() on the StudentPropertyEntity.
+        call _put_progress() on the StudentPropertyEntity.
 
         Args:
           student_property: the StudentPropertyEntity
           key: the student property whose value should be incremented
           value: the value to increment this property by
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
+        parsed = _ParsedProgress.get(student_property)
+        parsed.progress_dict[key] = parsed.progress_dict.get(key, 0) + value
+        parsed.dirty = True
 
-        if key not in progress_dict:
-            progress_dict[key] = 0
-
-        progress_dict[key] += value
-        student_property.value = transforms.dumps(progress_dict)
+    def _put_progress(self, progress):
+        """Encodes changes made to the progress and puts it to datastore."""
+        _ParsedProgress.get(progress).encode(progress)
+        progress.updated_on = datetime.datetime.now()
+        progress.put()
 
     @classmethod
     def get_elements_from_key(cls, key):
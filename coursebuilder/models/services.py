@@ -122,6 +122,47 @@ class Notifications(Service):
         """
         raise NotImplementedError()
 
+    def query_many(self, to, intent, enqueue_date):
+        """Gets the Status of notifications queued previously via send_many().
+
+        Args:
+          to: list of string. The recipients of the notification.
+          intent: string. Short string identifier of the intent of the
+              notification (for example, 'invitation' or 'reminder').
+          enqueue_date: datetime. The enqueue date shared by the notifications
+              created by one call to send_many().
+
+        Returns:
+          Dict of to string -> [Status]. Recipients who have no such
+          notification are omitted.
+        """
+        raise NotImplementedError()
+
+    def send_many(
+        self, to, sender, intent, body, subject, audit_trail=None, html=None,
+        retention_policy=None):
+        """Asyncronously sends the same notification to many recipients.
+
+        Args:
+          to: list of string. Recipient email addresses.
+          sender: string. See send_async().
+          intent: string. See send_async().
+          body: string. See send_async().
+          subject: string. See send_async().
+          audit_trail: JSON-serializable object. See send_async().
+          html: optional string. See send_async().
+          retention_policy: RetentionPolicy. See send_async().
+
+        Returns:
+          List of (notification_key, payload_key) 2-tuples, one per recipient.
+
+        Raises:
+          Exception: if values delegated to model initializers are invalid.
+          ValueError: if any of to or sender are malformed according to App
+              Engine (note that well-formed values do not guarantee success).
+        """
+        raise NotImplementedError()
+
 
 class Unsubscribe(Service):
 
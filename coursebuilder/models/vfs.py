@@ -21,14 +21,19 @@ import os
 import re
 import sys
 import threading
+import time
 import unittest
 
 from config import ConfigProperty
+from config import ValidateIntegerRange
 from counters import PerfCounter
 from entities import BaseEntity
+from entities import delete as entities_delete
+from entities import get as entities_get
 from entities import put as entities_put
 import jinja2
 
+import appengine_config
 from common import caching
 from common import jinja_utils
 from models import messages
@@ -55,6 +60,13 @@ CAN_USE_VFS_IN_PROCESS_CACHE = ConfigProperty(
     messages.SITE_SETTINGS_CACHE_CONTENT, default_value=True,
     label='Cache Content')
 
+CONTENT_RESYNC_INTERVAL_MS = ConfigProperty(
+    'gcb_vfs_cache_resync_interval_ms', int,
+    messages.SITE_SETTINGS_CACHE_CONTENT_RESYNC_INTERVAL, default_value=1000,
+    label='Cache Content Resync Interval',
+    validator=ValidateIntegerRange(
+        lower_bound_inclusive=0, upper_bound_inclusive=60 * 1000).validate)
+
 
 class AbstractFileSystem(object):
     """A generic file system interface that forwards to an implementation."""
@@ -233,6 +245,16 @@ class FileDataEntity(BaseEntity):
     data = db.BlobProperty()
 
 
+class FileTombstoneEntity(BaseEntity):
+    """An entity to record a file deletion; absolute file name is a key.
+
+    Lets the in-process caches of all instances evict a deleted file right
+    away. A tombstone and a FileMetadataEntity never exist for the same file
+    at the same time.
+    """
+    updated_on = db.DateTimeProperty(indexed=True)
+
+
 class FileStreamWrapped(object):
     """A class that wraps a file stream, but adds extra attributes to it."""
 
@@ -316,7 +338,8 @@ class ProcessScopedVfsCache(caching.ProcessScopedSingleton):
     def __init__(self):
         self._cache = caching.LRUCache(
             max_size_bytes=MAX_GLOBAL_CACHE_SIZE_BYTES,
-            max_item_size_bytes=MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES)
+            max_item_size_bytes=MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES,
+            index=caching.UpdatedOnIndex())
         self._cache.get_entry_size = self._get_entry_size
 
     def _get_entry_size(self, key, value):
@@ -341,6 +364,9 @@ VFS_CACHE_SIZE_BYTES.poll_value = ProcessScopedVfsCache.get_vfs_cache_size
 class CacheFileEntry(caching.AbstractCacheEntry):
     """Cache entry representing a file."""
 
+    # deletions are tracked by VfsCacheConnection, so entries can live longer
+    CACHE_ENTRY_TTL_SEC = 3 * 60 * 60
+
     def __init__(self, filename, metadata, body):
         self.filename = filename
         self.metadata = metadata
@@ -349,8 +375,9 @@ class CacheFileEntry(caching.AbstractCacheEntry):
 
     def getsizeof(self):
         return (
+            sys.getsizeof(self) +
             sys.getsizeof(self.filename) +
-            sys.getsizeof(self.metadata) +
+            caching.getsizeof(self.metadata) +
             sys.getsizeof(self.body) +
             sys.getsizeof(self.created_on))
 
@@ -381,6 +408,7 @@ class CacheFileEntry(caching.AbstractCacheEntry):
 class VfsCacheConnection(caching.AbstractCacheConnection):
 
     PERSISTENT_ENTITY = FileMetadataEntity
+    TOMBSTONE_ENTITY = FileTombstoneEntity
     CACHE_ENTRY = CacheFileEntry
 
     @classmethod
@@ -395,14 +423,85 @@ class VfsCacheConnection(caching.AbstractCacheConnection):
             'gcb-models-VfsCacheConnection-cache-inherited',
             'A number of times an object was obtained from the inherited vfs.')
 
+        cls.CACHE_RESYNC_SKIPPED = PerfCounter(
+            'gcb-models-VfsCacheConnection-cache-resync-skipped',
+            'A number of times a datastore query for vfs updates was skipped '
+            'because the namespace was resynced recently and no writes were '
+            'announced since.')
+
+    # {namespace: (resynced_on_ms, generation)} of the last resync done by
+    # this process; a generation of None means it could not be read
+    _LAST_RESYNC = {}
+
     @classmethod
     def is_enabled(cls):
         return CAN_USE_VFS_IN_PROCESS_CACHE.value
 
+    @classmethod
+    def _make_generation_key(cls, namespace):
+        return 'vfs:generation:%s' % namespace
+
+    @classmethod
+    def _get_generation(cls, namespace):
+        # Imported here to avoid a circular import.
+        from models import MemcacheManager
+        generation = MemcacheManager.get(
+            cls._make_generation_key(namespace),
+            namespace=appengine_config.DEFAULT_NAMESPACE_NAME)
+        if generation is None:
+            # Courses that are only read would otherwise never have a
+            # generation number. Incrementing by zero adds the key only if
+            # it is still missing, so we never overwrite a bumped one.
+            generation = MemcacheManager.incr(
+                cls._make_generation_key(namespace), 0,
+                namespace=appengine_config.DEFAULT_NAMESPACE_NAME,
+                initial_value=int(time.time() * 1000))
+        return generation
+
+    @classmethod
+    def bump_generation(cls, namespace):
+        """Announces a change in a namespace to all instances."""
+        from models import MemcacheManager
+        cls._LAST_RESYNC.pop(namespace, None)
+
+        # A missing key starts from the current time and not from 0, so a
+        # generation number evicted from memcache is never recreated with a
+        # value some instance has already seen.
+        MemcacheManager.incr(
+            cls._make_generation_key(namespace), 1,
+            namespace=appengine_config.DEFAULT_NAMESPACE_NAME,
+            initial_value=int(time.time() * 1000))
+
     def __init__(self, namespace):
         super(VfsCacheConnection, self).__init__(namespace)
         self.cache = ProcessScopedVfsCache.instance().cache
 
+    def _get_incremental_updates(self):
+        """Skips the datastore query if nothing changed since last resync.
+
+        The query is skipped only if this process resynced the namespace less
+        than CONTENT_RESYNC_INTERVAL_MS ago and the memcache generation number
+        for the namespace is still the same as it was at that time. All writes
+        via DatastoreBackedFileSystem bump the generation number, so they are
+        seen immediately. If the generation number can't be read from
+        memcache, the query is never skipped.
+
+        Returns:
+          a dict of {key: update} objects that represent recent updates
+        """
+        now_ms = int(time.time() * 1000)
+        generation = self._get_generation(self.namespace)
+        last = self._LAST_RESYNC.get(self.namespace)
+        if generation is not None and last:
+            resynced_on_ms, last_generation = last
+            if (generation == last_generation and
+                now_ms - resynced_on_ms < CONTENT_RESYNC_INTERVAL_MS.value):
+                self.CACHE_RESYNC_SKIPPED.inc()
+                return {}
+        updates = super(VfsCacheConnection, self)._get_incremental_updates()
+        self._LAST_RESYNC[self.namespace] = (now_ms, generation)
+        return updates
+
 
 VfsCacheConnection.init_counters()
 
@@ -596,6 +695,11 @@ class DatastoreBackedFileSystem(object):
             content = stream
         self._transactional_put(filename, content, is_draft, metadata_only)
 
+        # bump again now that the transaction has committed; the bump done
+        # inside of it may be seen by other instances before the data is
+        # committed
+        VfsCacheConnection.bump_generation(self.ns)
+
     @db.transactional(xg=True)
     def _transactional_put(
         self, filename, stream, is_draft=False, metadata_only=False):
@@ -648,6 +752,12 @@ class DatastoreBackedFileSystem(object):
         metadata = FileMetadataEntity.get_by_key_name(filename)
         if not metadata:
             metadata = FileMetadataEntity(key_name=filename)
+
+            # the file may have been deleted before; only files without
+            # metadata can have a tombstone
+            tombstone = FileTombstoneEntity.get_by_key_name(filename)
+            if tombstone:
+                tombstone.delete()
         metadata.updated_on = datetime.datetime.utcnow()
         metadata.is_draft = is_draft
 
@@ -670,6 +780,7 @@ class DatastoreBackedFileSystem(object):
 
         metadata.put()
         self.cache.delete(filename)
+        VfsCacheConnection.bump_generation(self.ns)
 
     def put_multi_async(self, filedata_list):
         """Initiate an async put of the given files.
@@ -696,6 +807,7 @@ class DatastoreBackedFileSystem(object):
         filename_list = []
         data_list = []
         metadata_list = []
+        tombstone_keys = []
 
         for filename, stream in filedata_list:
             filename = self._logical_to_physical(filename)
@@ -704,6 +816,8 @@ class DatastoreBackedFileSystem(object):
             metadata = FileMetadataEntity.get_by_key_name(filename)
             if not metadata:
                 metadata = FileMetadataEntity(key_name=filename)
+                tombstone_keys.append(db.Key.from_path(
+                    FileTombstoneEntity.kind(), filename))
             metadata_list.append(metadata)
             metadata.updated_on = datetime.datetime.utcnow()
 
@@ -721,17 +835,44 @@ class DatastoreBackedFileSystem(object):
             # record DELETE, but EVICT when they query for updates
             self.cache.delete(filename)
 
+        # only delete the tombstones that exist; most new files never had one
+        tombstone_keys = [
+            tombstone.key() for tombstone in entities_get(tombstone_keys)
+            if tombstone]
+
         data_future = db.put_async(data_list)
         metadata_future = db.put_async(metadata_list)
+        tombstone_future = db.delete_async(tombstone_keys)
 
         def wait_and_finalize():
             data_future.check_success()
             metadata_future.check_success()
+            tombstone_future.check_success()
+            VfsCacheConnection.bump_generation(self.ns)
 
         return wait_and_finalize
 
-    @db.transactional(xg=True)
     def delete(self, filename):
+        self._transactional_delete(filename)
+        VfsCacheConnection.bump_generation(self.ns)
+        self._delete_expired_tombstones()
+
+    @classmethod
+    def _delete_expired_tombstones(cls):
+        """Deletes tombstones older than the lifetime of a cache entry.
+
+        By then, every instance has either resynced past the tombstone or let
+        its cached copy of the deleted file expire, so nothing reads it.
+        """
+        expired_on = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=CacheFileEntry.CACHE_ENTRY_TTL_SEC)
+        keys = FileTombstoneEntity.all(keys_only=True).filter(
+            'updated_on < ', expired_on).fetch(1000)
+        if keys:
+            entities_delete(keys)
+
+    @db.transactional(xg=True)
+    def _transactional_delete(self, filename):
         filename = self._logical_to_physical(filename)
         metadata = FileMetadataEntity.get_by_key_name(filename)
         if metadata:
@@ -739,6 +880,9 @@ class DatastoreBackedFileSystem(object):
         data = FileDataEntity(key_name=filename)
         if data:
             data.delete()
+        if metadata:
+            entities_put(FileTombstoneEntity(
+                key_name=filename, updated_on=datetime.datetime.utcnow()))
         self.cache.delete(filename)
 
     def isfile(self, afilename):
@@ -947,6 +1091,54 @@ class VfsTests(unittest.TestCase):
         self.assertFalse(found)
         self.assertEquals(stream, None)
 
+    def test_resync_is_skipped_until_generation_changes(self):
+        generations = [7]
+        queries = []
+
+        def get_generation(unused_namespace):
+            return generations[0]
+
+        def get_incremental_updates(unused_self):
+            queries.append(True)
+            return {}
+
+        old_get_generation = VfsCacheConnection.__dict__['_get_generation']
+        old_get_incremental_updates = (
+            caching.AbstractCacheConnection._get_incremental_updates)
+        VfsCacheConnection._get_generation = staticmethod(get_generation)
+        caching.AbstractCacheConnection._get_incremental_updates = (
+            get_incremental_updates)
+        VfsCacheConnection._LAST_RESYNC.clear()
+        try:
+            conn = VfsCacheConnection('ns_test')
+            conn._get_incremental_updates()
+            conn._get_incremental_updates()
+            self.assertEquals(1, len(queries))
+
+            generations[0] = 8
+            conn._get_incremental_updates()
+            conn._get_incremental_updates()
+            self.assertEquals(2, len(queries))
+
+            generations[0] = None
+            conn._get_incremental_updates()
+            conn._get_incremental_updates()
+            self.assertEquals(4, len(queries))
+
+            generations[0] = 8
+            conn._get_incremental_updates()
+            resynced_on_ms, generation = VfsCacheConnection._LAST_RESYNC[
+                'ns_test']
+            VfsCacheConnection._LAST_RESYNC['ns_test'] = (
+                resynced_on_ms - CONTENT_RESYNC_INTERVAL_MS.value, generation)
+            conn._get_incremental_updates()
+            self.assertEquals(6, len(queries))
+        finally:
+            VfsCacheConnection._get_generation = old_get_generation
+            caching.AbstractCacheConnection._get_incremental_updates = (
+                old_get_incremental_updates)
+            VfsCacheConnection._LAST_RESYNC.clear()
+
 
 def run_all_unit_tests():
     """Runs all unit tests in this module."""
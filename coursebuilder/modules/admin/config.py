@@ -404,6 +404,9 @@ class CourseDeleteHandler(utils.BaseHandler):
                 # this course (i.e. namespace), so call (in no particular
                 # order) callbacks waiting to be informed of course deletion.
                 ns_name = namespace_manager.get_namespace()
+                # A course later created in this namespace must not be
+                # served from copies of this one cached in-process.
+                courses.CourseModel13.bump_version(ns_name)
                 common_utils.run_hooks(
                     cls.COURSE_DELETED_HOOKS.itervalues(), ns_name)
                 logging.info(
@@ -232,6 +232,9 @@ def register_module():
             clustering.StudentClusters.delete_by_key)
         data_removal.Registry.register_indexed_by_user_id_remover(
             student_aggregate.StudentAggregateEntity.delete_by_key)
+        data_removal.Registry.register_indexed_by_user_id_remover(
+            student_aggregate.StudentAggregateOverflowEntity.
+            delete_by_user_id_prefix)
         data_removal.Registry.register_indexed_by_user_id_remover(
             gradebook.QuestionAnswersEntity.delete_by_primary_id)
 
@@ -38,6 +38,7 @@ from models import jobs
 from models import models
 from models import transforms
 from models.data_sources import paginated_table
+from modules.analytics import click_link_aggregator
 from modules.analytics import clustering
 from modules.analytics import filters
 from modules.analytics import gradebook
@@ -142,7 +143,8 @@ class AbstractModulesAnalyticsTest(actions.TestBase):
             aggregate_entity = (
                 student_aggregate.StudentAggregateEntity.get_by_key_name(
                     student.user_id))
-            return transforms.loads(zlib.decompress(aggregate_entity.data))
+            return student_aggregate.StudentAggregateEntity.load_aggregates(
+                [aggregate_entity])[0]
 
     def load_expected_data(self, path, item):
         data_path = self._get_data_path(path)
@@ -318,6 +320,97 @@ class StudentAggregateTest(AbstractModulesAnalyticsTest):
             self.get_aggregated_data_by_email('foo@bar.com'),
             self.load_expected_data(data_set_name, 'expected.json'))
 
+    def _add_click_link_event(self, href):
+        with common_utils.Namespace('ns_' + self.COURSE_NAME):
+            models.EventEntity(
+                source='click-link', user_id='124317316405206137111',
+                data=transforms.dumps({'href': href})).put()
+
+    def test_incremental_run_merges_new_events(self):
+        registry = student_aggregate.StudentAggregateComponentRegistry
+        component = click_link_aggregator.ClickLinkAggregator
+        self.swap(registry, '_components', [component])
+        self.swap(registry, '_components_for_event_source',
+                  {'click-link': [component]})
+
+        data_set_name = 'click_link'
+        self.load_course(data_set_name)
+        self.load_datastore(data_set_name)
+        self.run_aggregator_job()
+        expected = self.load_expected_data(data_set_name, 'expected.json')
+        self.assertEqual(
+            {'click_link': expected['click_link']},
+            self.get_aggregated_data_by_email('foo@bar.com'))
+
+        # Only the new event is mapped on the next run; the earlier clicks
+        # come from the previous aggregate.
+        self._add_click_link_event('http://example.org/')
+        processed = []
+        process_event = component.process_event.im_func
+        def counting_process_event(cls, event, static_params):
+            processed.append(event)
+            return process_event(cls, event, static_params)
+        self.swap(component, 'process_event',
+                  classmethod(counting_process_event))
+        self.run_aggregator_job()
+
+        self.assertEqual(1, len(processed))
+        actual = self.get_aggregated_data_by_email('foo@bar.com')
+        self.assertEqual(
+            expected['click_link'], actual['click_link'][:-1])
+        self.assertEqual(
+            'http://example.org/', actual['click_link'][-1]['href'])
+
+    def test_oversized_aggregate_is_stored_in_overflow_chunks(self):
+        data_set_name = 'click_link'
+        self.load_course(data_set_name)
+        self.load_datastore(data_set_name)
+        overflowed = student_aggregate.STUDENT_AGGREGATE_OVERFLOWED.value
+        self.swap(student_aggregate, '_MAX_CHUNK_BYTES', 100)
+        self.run_aggregator_job()
+
+        self.assertEquals(
+            overflowed + 1,
+            student_aggregate.STUDENT_AGGREGATE_OVERFLOWED.value)
+        with common_utils.Namespace('ns_' + self.COURSE_NAME):
+            self.assertGreater(
+                student_aggregate.StudentAggregateOverflowEntity.all().count(),
+                0)
+        self.assertEqual(
+            self.get_aggregated_data_by_email('foo@bar.com'),
+            self.load_expected_data(data_set_name, 'expected.json'))
+
+        # Once the aggregate fits in one entity, stale chunks are removed.
+        self.swap(student_aggregate, '_MAX_CHUNK_BYTES', 1000 * 1000)
+        self.run_aggregator_job()
+        with common_utils.Namespace('ns_' + self.COURSE_NAME):
+            self.assertEquals(
+                0,
+                student_aggregate.StudentAggregateOverflowEntity.all().count())
+        self.assertEqual(
+            self.get_aggregated_data_by_email('foo@bar.com'),
+            self.load_expected_data(data_set_name, 'expected.json'))
+
+    def test_components_without_combine_run_full_rebuild(self):
+        data_set_name = 'click_link'
+        self.load_course(data_set_name)
+        self.load_datastore(data_set_name)
+        self.run_aggregator_job()
+        self._add_click_link_event('http://example.org/')
+
+        job = student_aggregate.StudentAggregateGenerator(self.app_context)
+        params = job.build_additional_mapper_params(self.app_context)
+        self.assertFalse(params['incremental'])
+        self.assertNotIn('filters', params)
+
+        job.submit()
+        self.execute_all_deferred_tasks()
+        actual = self.get_aggregated_data_by_email('foo@bar.com')
+        self.assertEqual(3, len(actual['click_link']))
+        self.assertEqual(
+            self.load_expected_data(data_set_name, 'expected.json')['youtube'],
+            actual['youtube'])
+
 
 class StudentAggregateSchemaRegistryTests(actions.TestBase):
 
@@ -1771,6 +1864,56 @@ class ClusteringGeneratorTests(actions.TestBase):
         ]
         self._check_hamming(cluster_vector, [], 1)
 
+    def test_distance_engine_matches_hamming_distance(self):
+        if not clustering._NUMPY_AVAILABLE:
+            return
+        clusters = [
+            {'id': 1, 'vector': [
+                {clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+                 clustering.DIM_ID: '1',
+                 clustering.DIM_HIGH: 10,
+                 clustering.DIM_LOW: None},
+                {clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+                 clustering.DIM_ID: 2,
+                 clustering.DIM_HIGH: 80,
+                 clustering.DIM_LOW: 60}]},
+            {'id': 2, 'vector': [
+                {clustering.DIM_TYPE: clustering.DIM_TYPE_QUESTION,
+                 clustering.DIM_ID: '2',
+                 clustering.DIM_HIGH: '',
+                 clustering.DIM_LOW: 3}]},
+        ]
+        student_vectors = [
+            [],
+            [{clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+              clustering.DIM_ID: '2',
+              clustering.DIM_VALUE: 60},
+             {clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+              clustering.DIM_ID: '2',
+              clustering.DIM_VALUE: 100},
+             {clustering.DIM_TYPE: clustering.DIM_TYPE_QUESTION,
+              clustering.DIM_ID: '2',
+              clustering.DIM_VALUE: None}],
+            [{clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+              clustering.DIM_ID: 1,
+              clustering.DIM_VALUE: 11},
+             {clustering.DIM_TYPE: clustering.DIM_TYPE_QUESTION,
+              clustering.DIM_ID: '2',
+              clustering.DIM_VALUE: 3},
+             {clustering.DIM_TYPE: clustering.DIM_TYPE_LESSON,
+              clustering.DIM_ID: '7',
+              clustering.DIM_VALUE: 3}],
+        ]
+        engine = clustering.ClusterDistanceEngine(clusters)
+        distances = engine.get_distances(
+            engine.pack_student_vectors(student_vectors))
+        expected = [
+            [clustering.hamming_distance(cluster['vector'], student_vector)
+             for cluster in clusters]
+            for student_vector in student_vectors]
+        self.assertEqual([[1, 1], [0, 1], [2, 0]], expected)
+        self.assertEqual(expected, distances.tolist())
+
 
 class TestClusterStatisticsDataSource(actions.TestBase):
 
@@ -2139,6 +2282,34 @@ class GradebookCsvTests(actions.TestBase):
         actions.login(self.ADMIN_EMAIL)
         self._verify(expected_scores, expected_questions)
 
+    def test_rows_are_streamed_a_page_of_answers_at_a_time(self):
+        actions.login(self.STUDENT_EMAIL)
+        actions.register(self, 'Jane Smith', self.COURSE_NAME)
+        student_id = users.get_current_user().user_id()
+        actions.login(self.ADMIN_EMAIL)
+
+        # Rows come out in key order; the first is from a user who has no
+        # Student record.
+        for key_name, user_id, score in (
+            ('a', 'no_such_student', 3), ('b', student_id, 2)):
+            answers = [[
+                self.unit_two.unit_id, self.u2_l1.lesson_id, 0, self.q_a_id,
+                None, None, 'x', score, score, True]]
+            gradebook.QuestionAnswersEntity(
+                key_name=key_name, primary_id=user_id,
+                data=transforms.dumps(answers)).put()
+
+        self.swap(gradebook.AbstractGradebookCsvGenerator,
+                  'STUDENTS_PER_CHUNK', 1)
+        rows = gradebook.GradebookGradedItemsCsvGenerator(
+            self.app_context).iter_rows()
+        self.assertEquals('Email', next(rows)[0])
+
+        # The admin is registered, but has no answers, so has no row.
+        self.assertEquals(
+            [['<unknown>', 3.0], [self.STUDENT_EMAIL, 2.0]],
+            [row[:2] for row in rows])
+
     def test_commas_are_stripped(self):
         course_name = 'commas'
         with common_utils.Namespace('ns_' + course_name):
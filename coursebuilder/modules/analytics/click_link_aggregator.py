@@ -49,6 +49,15 @@ class ClickLinkAggregator(
         return {'click_link':
             list(sorted(event_items, key=lambda event: event["timestamp"]))}
 
+    @classmethod
+    def combine_aggregate(cls, course, student, static_params, previous,
+                          event_items):
+        if not event_items:
+            return None
+        clicks = (previous or {}).get('click_link', []) + event_items
+        return {'click_link':
+            list(sorted(clicks, key=lambda event: event["timestamp"]))}
+
     @classmethod
     def get_schema(cls):
         event = schema_fields.FieldRegistry('event')
@@ -23,9 +23,9 @@ import json
 import math
 import os
 import urllib
-import zlib
 
 from mapreduce import context
+from mapreduce import operation as op
 
 from common import schema_fields
 from controllers import utils
@@ -42,6 +42,13 @@ from modules.dashboard import dto_editor
 
 from google.appengine.ext import db
 
+_NUMPY_AVAILABLE = False
+try:
+    import numpy
+    _NUMPY_AVAILABLE = True
+except ImportError:
+    if appengine_config.PRODUCTION_MODE:
+        raise
 
 DIM_TYPE_UNIT = 'u'
 DIM_TYPE_LESSON = 'l'
@@ -579,7 +586,10 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         from the assessment data in item.
         """
         mapper_params = context.get().mapreduce_spec.mapper.params
-        raw_data = transforms.loads(zlib.decompress(item.data))
+        raw_data = student_aggregate.StudentAggregateEntity.load_aggregates(
+            [item])[0]
+        if raw_data is None:
+            return
 
         raw_assessments = raw_data.get('assessments', [])
         sub_data = StudentVectorGenerator._inverse_submission_data(
@@ -814,6 +824,99 @@ def hamming_distance(vector, student_vector):
     return distance
 
 
+def _get_dimension_key(dim):
+    return (dim[DIM_TYPE], str(dim[DIM_ID]))
+
+
+class ClusterDistanceEngine(object):
+    """Calculates hamming distances from many StudentVectors to all clusters.
+
+    The dimensions used by the clusters are numbered by a dimension index.
+    The cluster ranges are packed into low and high arrays of shape
+    (clusters, dimensions), where a missing side of a range, or a dimension
+    not used by a cluster, is -inf or inf. Student vectors are packed into a
+    dense matrix of shape (students, dimensions), where missing values are 0.
+    The distances from every student to every cluster are then calculated in
+    bulk, and are the same as those calculated by hamming_distance().
+
+    ClusteringGenerator.map() is handed one student at a time and has no
+    hook at the end of a slice, so it packs one-row matrices; each call
+    still compares the student to all clusters at once.
+    """
+
+    # The number of students compared to the clusters at a time. This bounds
+    # the size of the intermediate (students, clusters, dimensions) arrays.
+    STUDENTS_PER_CHUNK = 1000
+
+    def __init__(self, clusters):
+        """Packs the cluster ranges.
+
+        Args:
+            clusters: a list of dictionaries with the keys 'id', the id of
+                the ClusterEntity, and 'vector', its vector field.
+        """
+        self.cluster_ids = [cluster['id'] for cluster in clusters]
+        self.dimension_index = {}
+        for cluster in clusters:
+            for dim in cluster['vector']:
+                self.dimension_index.setdefault(
+                    _get_dimension_key(dim), len(self.dimension_index))
+
+        shape = (len(clusters), len(self.dimension_index))
+        self.low = numpy.empty(shape)
+        self.low.fill(-numpy.inf)
+        self.high = numpy.empty(shape)
+        self.high.fill(numpy.inf)
+        for row, cluster in enumerate(clusters):
+            for dim in cluster['vector']:
+                column = self.dimension_index[_get_dimension_key(dim)]
+                if _has_left_side(dim):
+                    self.low[row, column] = dim[DIM_LOW]
+                if _has_right_side(dim):
+                    self.high[row, column] = dim[DIM_HIGH]
+
+    def pack_student_vectors(self, student_vectors):
+        """Returns the matrix of values of the given unpacked vectors.
+
+        Dimensions not used by any cluster are ignored. As in
+        StudentVector.get_dimension_value, the first value found for a
+        dimension is used.
+        """
+        matrix = numpy.zeros((len(student_vectors), len(self.dimension_index)))
+        for row, vector in enumerate(student_vectors):
+            seen = set()
+            for dim in vector:
+                column = self.dimension_index.get(_get_dimension_key(dim))
+                if column is not None and column not in seen:
+                    seen.add(column)
+                    matrix[row, column] = dim.get(DIM_VALUE) or 0
+        return matrix
+
+    def get_distances(self, matrix):
+        """Returns an int array of shape (students, clusters) of distances."""
+        distances = numpy.empty(
+            (matrix.shape[0], len(self.cluster_ids)), dtype=int)
+        for start in xrange(0, matrix.shape[0], self.STUDENTS_PER_CHUNK):
+            chunk = matrix[start:start + self.STUDENTS_PER_CHUNK, None, :]
+            outside = (chunk < self.low) | (chunk > self.high)
+            distances[start:start + self.STUDENTS_PER_CHUNK] = outside.sum(
+                axis=2)
+        return distances
+
+
+# An engine for the clusters of the running job, built once per process
+# rather than once per student: {mapreduce_id: ClusterDistanceEngine}.
+_ENGINE_CACHE = {}
+
+
+def _get_cluster_distance_engine(mapreduce_id, clusters):
+    engine = _ENGINE_CACHE.get(mapreduce_id)
+    if engine is None:
+        _ENGINE_CACHE.clear()
+        engine = _ENGINE_CACHE[mapreduce_id] = ClusterDistanceEngine(clusters)
+    return engine
+
+
 class ClusteringGenerator(jobs.MapReduceJob):
     """A map reduce job to calculate which students belong to each cluster.
 
@@ -871,12 +974,22 @@ class ClusteringGenerator(jobs.MapReduceJob):
         """
         student = StudentVector.get_by_key_name(item.user_id)
         if student:
-            mapper_params = context.get().mapreduce_spec.mapper.params
+            mapreduce_spec = context.get().mapreduce_spec
+            mapper_params = mapreduce_spec.mapper.params
             max_distance = mapper_params['max_distance']
             clusters = {}
             item_vector = transforms.loads(student.vector)
-            for cluster in mapper_params['clusters']:
-                distance = hamming_distance(cluster['vector'], item_vector)
+            if _NUMPY_AVAILABLE:
+                engine = _get_cluster_distance_engine(
+                    mapreduce_spec.mapreduce_id, mapper_params['clusters'])
+                distances = engine.get_distances(
+                    engine.pack_student_vectors([item_vector]))[0].tolist()
+            else:
+                distances = [
+                    hamming_distance(cluster['vector'], item_vector)
+                    for cluster in mapper_params['clusters']]
+            for cluster, distance in zip(mapper_params['clusters'],
+                                         distances):
                 if distance > max_distance:
                     continue
                 for cluster2_id, distance2 in clusters.items():
@@ -887,7 +1000,8 @@ class ClusteringGenerator(jobs.MapReduceJob):
                 to_yield = (item.user_id, distance)
                 yield(cluster['id'], transforms.dumps(to_yield))
             clusters = transforms.dumps(clusters)
-            StudentClusters(key_name=item.user_id, clusters=clusters).put()
+            yield op.db.Put(
+                StudentClusters(key_name=item.user_id, clusters=clusters))
         yield ('student_count', 1)
 
     @staticmethod
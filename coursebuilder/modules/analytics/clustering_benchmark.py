@@ -0,0 +1,105 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of ClusterDistanceEngine against hamming_distance().
+
+Run from the Course Builder root, with the App Engine SDK and numpy in the
+Python path:
+
+    python -m modules.analytics.clustering_benchmark
+
+ClusteringGenerator.map() is handed one student at a time, so the engine is
+timed the same way: each student's vector is packed into a one-row matrix
+and its distances to all clusters are calculated in one call. The engine is
+built once, as map() builds it once per job. hamming_distance() is too slow
+to run for every student, so it is run on a sample and its time is
+extrapolated; the sample is also used to check that both produce the same
+distances.
+"""
+
+import argparse
+import random
+import time
+
+from modules.analytics import clustering
+
+DIM_TYPES = [
+    clustering.DIM_TYPE_UNIT, clustering.DIM_TYPE_LESSON,
+    clustering.DIM_TYPE_QUESTION]
+
+
+def _make_dimensions(num_dimensions):
+    return [(DIM_TYPES[i % len(DIM_TYPES)], str(i))
+            for i in xrange(num_dimensions)]
+
+
+def _make_clusters(dimensions, num_clusters, dims_per_cluster):
+    clusters = []
+    for cluster_id in xrange(num_clusters):
+        vector = []
+        for dim_type, dim_id in random.sample(dimensions, dims_per_cluster):
+            low = random.choice([None, random.randint(0, 50)])
+            high = random.choice(['', random.randint(50, 100)])
+            vector.append({
+                clustering.DIM_TYPE: dim_type, clustering.DIM_ID: dim_id,
+                clustering.DIM_LOW: low, clustering.DIM_HIGH: high})
+        clusters.append({'id': cluster_id, 'vector': vector})
+    return clusters
+
+
+def _make_student_vectors(dimensions, num_students):
+    return [[{clustering.DIM_TYPE: dim_type, clustering.DIM_ID: dim_id,
+              clustering.DIM_VALUE: random.randint(0, 100)}
+             for dim_type, dim_id in dimensions]
+            for _ in xrange(num_students)]
+
+
+def main(args):
+    random.seed(args.seed)
+    dimensions = _make_dimensions(args.dimensions)
+    clusters = _make_clusters(
+        dimensions, args.clusters, min(args.dims_per_cluster, len(dimensions)))
+    student_vectors = _make_student_vectors(dimensions, args.students)
+    print '%d students x %d clusters x %d dimensions' % (
+        args.students, args.clusters, args.dimensions)
+
+    engine = clustering.ClusterDistanceEngine(clusters)
+    start = time.time()
+    distances = [
+        engine.get_distances(engine.pack_student_vectors([vector]))[0].tolist()
+        for vector in student_vectors]
+    elapsed = time.time() - start
+    print 'ClusterDistanceEngine: %.2fs, %.0fus per student' % (
+        elapsed, elapsed * 1e6 / max(len(student_vectors), 1))
+
+    sample = student_vectors[:args.sample]
+    start = time.time()
+    expected = [[clustering.hamming_distance(cluster['vector'], vector)
+                 for cluster in clusters] for vector in sample]
+    elapsed = time.time() - start
+    print 'hamming_distance: %.2fs for %d students, ~%.0fs for all' % (
+        elapsed, len(sample), elapsed * args.students / max(len(sample), 1))
+
+    assert expected == distances[:len(sample)], 'Distances differ'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--students', type=int, default=10000)
+    parser.add_argument('--clusters', type=int, default=50)
+    parser.add_argument('--dimensions', type=int, default=200)
+    parser.add_argument('--dims_per_cluster', type=int, default=20)
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -26,10 +26,10 @@ import StringIO
 
 from mapreduce import context
 
-from common import catch_and_log
 from common import crypto
 from common import schema_fields
 from common import tags
+from common import utils as common_utils
 from controllers import utils
 from models import courses
 from models import data_sources
@@ -293,9 +293,13 @@ class RawAnswersDataSource(data_sources.SynchronousQuery,
         """Unpack all responses from single student into separate rows."""
 
         # Fill in responses with actual student name, not just ID.
-        ids = []
-        for entity in rows:
-            ids.append(entity.primary_id)
+        students = cls.get_students([entity.primary_id for entity in rows])
+        return cls.unpack_answers(
+            rows, students, cls.get_multiple_choice_texts())
+
+    @classmethod
+    def get_students(cls, ids):
+        """Look up the Student for each user ID, or a placeholder if none."""
 
         # Chunkify student lookups; 'in' has max of 30
         students = []
@@ -314,13 +318,29 @@ class RawAnswersDataSource(data_sources.SynchronousQuery,
                     students += [StudentPlaceholder(
                         student_id, '<unknown>', '<unknown>')]
 
-        # Prepare to convert multiple-choice question indices to answer strings.
+        return students
+
+    @classmethod
+    def get_multiple_choice_texts(cls):
+        """Map question ID to choice texts, to convert answer indices."""
         mc_choices = {}
         for question in models.QuestionDAO.get_all():
             if 'choices' in question.dict:
                 mc_choices[str(question.id)] = [
                     choice['text'] for choice in question.dict['choices']]
+        return mc_choices
 
+    @classmethod
+    def unpack_answers(cls, rows, students, mc_choices):
+        """Produce one answer dict per answer in rows, from the given student.
+
+        Args:
+          rows: QuestionAnswersEntity instances.
+          students: Student (or StudentPlaceholder) for each of rows.
+          mc_choices: As returned from get_multiple_choice_texts().
+        Returns:
+          A list of dicts, as described by the schema of this data source.
+        """
         ret = []
         for entity, student in zip(rows, students):
             raw_answers = transforms.loads(entity.data)
@@ -581,45 +601,55 @@ class AbstractGradebookCsvGenerator(object):
         self._app_context = app_context
         self._source_context = source_context
 
-    def get_output(self):
-        student_question_answers = self._fetch_all_question_answers()
-        column_titles, ids_to_index = self._walk_course()
-        answer_rows = self._reduce_answers(
-            student_question_answers, ids_to_index)
+    # Answers are read this many QuestionAnswersEntity rows (one per
+    # student) at a time; this is the most values an 'in' filter may have.
+    STUDENTS_PER_CHUNK = datastore.MAX_ALLOWABLE_QUERIES
 
+    def get_output(self):
         stream = StringIO.StringIO()
+        self.write_output(stream)
+        ret = stream.getvalue()
+        stream.close()
+        return ret
+
+    def write_output(self, stream):
+        """Write CSV to a file-like object one row at a time."""
         csv_stream = csv.writer(stream, quoting=csv.QUOTE_MINIMAL)
-        for row in [column_titles] + answer_rows:
+        for row in self.iter_rows():
             row = [i.encode('utf-8') if isinstance(i, unicode) else str(i)
                    for i in row]
             csv_stream.writerow(row)
-        ret = stream.getvalue()
-        stream.close()
-        return ret
 
-    def _fetch_all_question_answers(self):
-        source_class = RawAnswersDataSource
-        values = []
-        chunk_size = source_class.get_default_chunk_size()
-        context_class = source_class.get_context_class()
-        source_context = context_class.build_blank_default({}, chunk_size)
-        catch_and_log_ = catch_and_log.CatchAndLog()
-        sought_page_number = 0
-        with catch_and_log_.propagate_exceptions('Loading gradebook data'):
-            schema = source_class.get_schema(
-                self._app_context, catch_and_log, source_context)
+    def iter_rows(self):
+        """Yield the column titles, then one row per student."""
+        column_titles, ids_to_index = self._walk_course()
+        yield column_titles
+        for row in self._reduce_answers(
+            self._iter_question_answers(), ids_to_index):
+            yield row
+
+    def _iter_question_answers(self):
+        """Yield answers, one student at a time, in data source order.
+
+        QuestionAnswersEntity rows are read a page at a time, and the
+        Students for each page are then looked up, so memory use does not
+        depend on the number of students in the course.  As in the
+        RawAnswersDataSource, answers from users with no Student record are
+        reported as being from "<unknown>".
+        """
+        with common_utils.Namespace(self._app_context.get_namespace_name()):
+            mc_choices = RawAnswersDataSource.get_multiple_choice_texts()
+            rows_iter = common_utils.iter_all(QuestionAnswersEntity.all())
             while True:
-                data, actual_page_number = source_class.fetch_values(
-                    self._app_context, source_context, schema, catch_and_log_,
-                    sought_page_number)
-                if actual_page_number != sought_page_number:
+                rows = list(itertools.islice(
+                    rows_iter, self.STUDENTS_PER_CHUNK))
+                if not rows:
                     break
-                values.extend(data)
-                if len(data) < source_context.chunk_size:
-                    break
-                sought_page_number += 1
-        values.sort(key=lambda x: x['user_email'])
-        return values
+                students = RawAnswersDataSource.get_students(
+                    [row.primary_id for row in rows])
+                for answer in RawAnswersDataSource.unpack_answers(
+                    rows, students, mc_choices):
+                    yield answer
 
     def _walk_course(self):
         """Traverse course, producing helper items.
@@ -643,8 +673,8 @@ class AbstractGradebookCsvGenerator(object):
         """Iterate over student answers to produce rows for CSV output.
 
         Args:
-          student_question_answers: Rows, as generated by
-              RawAnswersDataSource._postprocess_rows.  Each row corresponds to
+          student_question_answers: Iterable of rows, as generated by
+              RawAnswersDataSource.unpack_answers.  Each row corresponds to
               one answer to one question by one student.  All answers for each
               student are guaranteed to be adjacent.  This is not a complete
               Cartesian product of students X all possible questions; only the
@@ -652,10 +682,10 @@ class AbstractGradebookCsvGenerator(object):
               is up to the subclass to correctly place results in the (fixed-
               width) CSV rows.
           ids_to_index: As described in return value for _walk_course().
-        Returns:
-          An iterable of iterables.  Each iterable should provide a list of
-              items for a single student, starting with the student's
-              email address.
+        Yields:
+          A list of items for each student, starting with the student's
+              email address.  Rows should be yielded as soon as they are
+              complete, rather than being accumulated.
         """
         raise NotImplementedError
 
@@ -693,16 +723,18 @@ class GradebookGradedItemsCsvGenerator(AbstractGradebookCsvGenerator):
         return titles, indices_by_unit_and_lesson
 
     def _reduce_answers(self, student_question_answers, ids_to_index):
-        prev_email = None
-        ret = []
+        prev_user_id = None
+        answers = None
         for answer in student_question_answers:
-            if answer['user_email'] != prev_email:
-                prev_email = answer['user_email']
+            if answer['user_id'] != prev_user_id:
+                if answers:
+                    yield answers
+                prev_user_id = answer['user_id']
                 answers = [answer['user_email']] + [0.0] * len(ids_to_index)
-                ret.append(answers)
             index = ids_to_index[(answer['unit_id'], answer['lesson_id'])] + 1
             answers[index] += answer['weighted_score']
-        return ret
+        if answers:
+            yield answers
 
 
 class GradebookAllQuestionsCsvGenerator(AbstractGradebookCsvGenerator):
@@ -711,7 +743,7 @@ class GradebookAllQuestionsCsvGenerator(AbstractGradebookCsvGenerator):
         column_titles, ids_to_index = self._walk_course()
         answer_rows = self._reduce_answers(student_question_answers,
                                            ids_to_index)
-        return [column_titles] + answer_rows
+        return [column_titles] + list(answer_rows)
 
 
     def _walk_course(self):
@@ -740,13 +772,14 @@ class GradebookAllQuestionsCsvGenerator(AbstractGradebookCsvGenerator):
         return column_titles, ids_to_index
 
     def _reduce_answers(self, student_question_answers, ids_to_index):
-        prev_email = None
-        ret = []
+        prev_user_id = None
+        answers = None
         for answer in student_question_answers:
-            if answer['user_email'] != prev_email:
-                prev_email = answer['user_email']
+            if answer['user_id'] != prev_user_id:
+                if answers:
+                    yield answers
+                prev_user_id = answer['user_id']
                 answers = [answer['user_email']] + ['', 0.0] * len(ids_to_index)
-                ret.append(answers)
             index = ids_to_index[
                 (answer['unit_id'], answer['lesson_id'], answer['question_id'])]
             response = answer['answers']
@@ -755,19 +788,18 @@ class GradebookAllQuestionsCsvGenerator(AbstractGradebookCsvGenerator):
             else:
                 answers[index] = str(response)
             answers[index + 1] = answer['weighted_score']
-        return ret
+        if answers:
+            yield answers
 
 
-def _generate_csv(app_context, mode):
+def _get_csv_generator(app_context, mode):
     if mode == _MODE_SCORES:
         generator_class = GradebookGradedItemsCsvGenerator
     elif mode == _MODE_QUESTIONS:
         generator_class = GradebookAllQuestionsCsvGenerator
     else:
         raise ValueError('Mode "%s" not in %s' % (mode, ','.join(_MODES)))
-    generator = generator_class(app_context)
-    output = generator.get_output()
-    return output
+    return generator_class(app_context)
 
 
 class DownloadAsCsv(etl_lib.CourseJob):
@@ -795,9 +827,9 @@ class DownloadAsCsv(etl_lib.CourseJob):
     def main(self):
         app_context = self._get_app_context_or_die(
             self.etl_args.course_url_prefix)
-        output = _generate_csv(app_context, self.args.mode)
+        generator = _get_csv_generator(app_context, self.args.mode)
         with open(self.args.save_as, 'w') as fp:
-            fp.write(output)
+            generator.write_output(fp)
 
 
 class CsvDownloadHandler(utils.BaseHandler):
@@ -808,7 +840,7 @@ class CsvDownloadHandler(utils.BaseHandler):
         if not roles.Roles.is_course_admin(self.app_context):
             self.error(401)
         mode = self.request.get(_MODE_ARG_NAME, _MODE_SCORES)
-        output = _generate_csv(self.app_context, mode)
+        generator = _get_csv_generator(self.app_context, mode)
         filename = '%s_%s.csv' % (self.app_context.get_title(), mode)
         safe_filename = re.sub(r'[\"\']', '_', filename.lower())
         if isinstance(safe_filename, unicode):
@@ -818,4 +850,4 @@ class CsvDownloadHandler(utils.BaseHandler):
         self.response.headers.add(
             'Content-Disposition',
             str('attachment; filename="%s"' % str(safe_filename)))
-        self.response.write(output)
+        generator.write_output(self.response)
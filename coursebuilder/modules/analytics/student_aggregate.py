@@ -26,6 +26,7 @@ from mapreduce import context
 from common import schema_fields
 from common import utils as common_utils
 from controllers import sites
+from models import counters
 from models import courses
 from models import data_sources
 from models import entities
@@ -33,11 +34,38 @@ from models import jobs
 from models import models
 from models import transforms
 
-from google.appengine.api import datastore_types
 from google.appengine.ext import db
 
 UNIX_EPOCH = datetime.datetime(year=1970, month=1, day=1)
 
+# Aggregates are written once per job run but read on every data pump page,
+# so favor compression speed over size; decompression speed does not depend
+# on the level used.
+_COMPRESSION_LEVEL = 1
+
+# Compressed aggregate bytes stored per entity.  Kept under
+# _MAX_RAW_PROPERTY_BYTES with room for the other properties and the key.
+_MAX_CHUNK_BYTES = 1000 * 1000
+
+STUDENT_AGGREGATE_OVERFLOWED = counters.PerfCounter(
+    'gcb-student-aggregate-overflowed',
+    'The number of student aggregates too large for one entity, written '
+    'with overflow chunks.')
+STUDENT_AGGREGATE_INCOMPLETE = counters.PerfCounter(
+    'gcb-student-aggregate-incomplete',
+    'The number of student aggregates skipped on read because overflow '
+    'chunks were missing.')
+
+
+def _datetime_to_usec(when):
+    delta = when - UNIX_EPOCH
+    return (delta.days * 24 * 60 * 60 + delta.seconds) * 10 ** 6 + (
+        delta.microseconds)
+
+
+def _usec_to_datetime(usec):
+    return UNIX_EPOCH + datetime.timedelta(microseconds=usec)
+
 
 class AbstractStudentAggregationComponent(object):
     """Allows modules to contribute to map/reduce on EventEntity by Student.
@@ -136,6 +164,33 @@ class AbstractStudentAggregationComponent(object):
         """
         raise NotImplementedError()
 
+    def combine_aggregate(self, course, student, static_params, previous,
+                          event_items):
+        """Merge new event-item outputs into a previously produced aggregate.
+
+        Optional.  When every registered component implements this function,
+        StudentAggregateGenerator can run incrementally: only events recorded
+        since its previous run are mapped, and this function is called instead
+        of produce_aggregate() for each Student having any such events.
+        Students without new events keep their previous aggregate.  If any
+        component does not implement this function, the job falls back to
+        rebuilding all aggregates from all events.
+
+        Args:
+          course: The Course in which the student and the events are found.
+          student: the Student for which the events occurred.
+          static_params: the value from build_static_params(), if any.
+          previous: the dict previously returned for this Student from
+              produce_aggregate() or combine_aggregate(), or None if there is
+              none.
+          event_items: a list of the items produced by process_event() for
+              the events recorded for the given Student since then.
+        Returns:
+          A dict corresponding to the declared schema, or None to leave the
+          previous value unchanged.
+        """
+        raise NotImplementedError()
+
     def get_schema(self):
         """Provide the partial schema for results produced.
 
@@ -159,14 +214,145 @@ class StudentAggregateEntity(entities.BaseEntity):
     than write this large volume of data out to, say, BlobStore, we instead
     prefer to write each Student's aggregated data to one record in the DB.
     Doing this permits us to use existing paginated-rest-data-source logic
-    to provide the aggregated student data as a feed to the data pump."""
+    to provide the aggregated student data as a feed to the data pump.
+
+    The rare aggregate whose compressed form does not fit in one entity
+    continues in StudentAggregateOverflowEntity records; use
+    load_aggregates() rather than decompressing data directly."""
 
     data = db.BlobProperty()
 
+    # The high watermark of the job run that last wrote this record: events
+    # recorded up to this time are reflected in data.
+    recorded_on = db.DateTimeProperty(indexed=False)
+
+    # Number of StudentAggregateOverflowEntity records holding the remainder
+    # of the compressed aggregate, following the bytes in data.
+    num_overflow_chunks = db.IntegerProperty(indexed=False, default=0)
+
     @classmethod
     def safe_key(cls, db_key, transform_fn):
         return db.Key.from_path(cls.kind(), transform_fn(db_key.id_or_name()))
 
+    def get_overflow_keys(self):
+        return [StudentAggregateOverflowEntity.get_key(self.key().name(), i)
+                for i in xrange(1, (self.num_overflow_chunks or 0) + 1)]
+
+    @classmethod
+    def load_aggregates(cls, entities_list):
+        """Decompress aggregates, fetching overflow chunks in one batch.
+
+        Args:
+          entities_list: list of StudentAggregateEntity.
+        Returns:
+          A list of aggregate dicts, parallel to entities_list.  Entries are
+          None for records whose overflow chunks could not be found.
+        """
+        keys = []
+        for entity in entities_list:
+            keys.extend(entity.get_overflow_keys())
+        chunks = dict(zip(keys, db.get(keys))) if keys else {}
+
+        ret = []
+        for entity in entities_list:
+            overflow = [chunks[key] for key in entity.get_overflow_keys()]
+            if not all(overflow):
+                STUDENT_AGGREGATE_INCOMPLETE.inc()
+                logging.error(
+                    'Missing overflow chunks for student aggregate %s; '
+                    'ignoring this record.', entity.key().name())
+                ret.append(None)
+                continue
+            decompressor = zlib.decompressobj()
+            parts = [decompressor.decompress(entity.data)]
+            for chunk in overflow:
+                parts.append(decompressor.decompress(chunk.data))
+            parts.append(decompressor.flush())
+            ret.append(transforms.loads(''.join(parts)))
+        return ret
+
+    @classmethod
+    def put_aggregate(cls, user_id, aggregate, recorded_on, previous=None):
+        """Compress and store an aggregate, splitting it if necessary.
+
+        Args:
+          user_id: The user ID of the Student; the key name of the record.
+          aggregate: dict.  The aggregated data for the Student.
+          recorded_on: datetime.  The high watermark of the writing job.
+          previous: The StudentAggregateEntity being overwritten, if any.
+              Overflow chunks it had beyond those now needed are deleted.
+        """
+        data = zlib.compress(transforms.dumps(aggregate), _COMPRESSION_LEVEL)
+        chunks = [data[i:i + _MAX_CHUNK_BYTES]
+                  for i in xrange(0, len(data), _MAX_CHUNK_BYTES)]
+        entity = cls(key_name=user_id, data=chunks[0], recorded_on=recorded_on,
+                     num_overflow_chunks=len(chunks) - 1)
+        to_put = [
+            StudentAggregateOverflowEntity(
+                key=StudentAggregateOverflowEntity.get_key(user_id, i),
+                data=chunk)
+            for i, chunk in enumerate(chunks[1:], 1)]
+        # Write the chunks before the record that refers to them; a batch
+        # put does not apply its entities in any particular order.
+        if to_put:
+            STUDENT_AGGREGATE_OVERFLOWED.inc()
+            db.put(to_put)
+        entity.put()
+        if previous:
+            stale = previous.get_overflow_keys()[entity.num_overflow_chunks:]
+            if stale:
+                db.delete(stale)
+
+
+class StudentAggregateOverflowEntity(entities.BaseEntity):
+    """Holds a continuation of the compressed data of a StudentAggregateEntity.
+
+    Keyed by the Student's user ID, a hyphen, and the 1-based chunk number.
+    """
+
+    data = db.BlobProperty()
+
+    @classmethod
+    def get_key(cls, user_id, chunk_number):
+        return db.Key.from_path(cls.kind(), '%s-%d' % (user_id, chunk_number))
+
+    @classmethod
+    def safe_key(cls, db_key, transform_fn):
+        user_id, chunk_number = db_key.name().rsplit('-', 1)
+        return db.Key.from_path(
+            cls.kind(), '%s-%s' % (transform_fn(user_id), chunk_number))
+
+
+class StudentAggregateWatermarkEntity(entities.BaseEntity):
+    """Records how far StudentAggregateGenerator has aggregated events.
+
+    There is one of these per course.  recorded_on is the high watermark of
+    the last successful run of the job, and components lists the names of the
+    components whose output is in the StudentAggregateEntity records.
+    """
+
+    KEY_NAME = 'student_aggregate'
+
+    recorded_on = db.DateTimeProperty(indexed=False)
+    components = db.StringListProperty(indexed=False)
+
+    @classmethod
+    def get_watermark(cls):
+        return cls.get_by_key_name(cls.KEY_NAME)
+
+    @classmethod
+    def set_watermark(cls, recorded_on, components):
+        cls(key_name=cls.KEY_NAME, recorded_on=recorded_on,
+            components=components).put()
+
+
+def _can_combine_aggregate(component):
+    """Whether a component, registered as a class or instance, can merge."""
+    component_class = (
+        component if isinstance(component, type) else type(component))
+    return (component_class.combine_aggregate.im_func is not
+            AbstractStudentAggregationComponent.combine_aggregate.im_func)
+
 
 class StudentAggregateGenerator(jobs.MapReduceJob):
     """M/R job to aggregate data by student using registered plug-ins.
@@ -177,8 +363,18 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
     insulated from one another, and are permitted to fail individually without
     compromising the results contributed for a Student by other plugins.
 
+    The job runs incrementally when it can: if it has run before with the
+    same components, and all of them implement combine_aggregate(), only
+    events recorded since the previous run are mapped, and they are merged
+    into the existing StudentAggregateEntity records.  Each record notes the
+    watermark it was written at, so events already merged by an interrupted
+    run are not merged again.
     """
 
+    def __init__(self, app_context, incremental=True):
+        super(StudentAggregateGenerator, self).__init__(app_context)
+        self._incremental = incremental
+
     @staticmethod
     def get_description():
         return 'student_aggregate'
@@ -195,7 +391,8 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
             'schemas': schemas,
             'schema_names': schema_names,
             }
-        for component in StudentAggregateComponentRegistry.get_components():
+        components = StudentAggregateComponentRegistry.get_components()
+        for component in components:
             component_name = component.get_name()
             static_value = component.build_static_params(app_context)
             if static_value:
@@ -207,14 +404,32 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
                 schema_name = schema.name
             schema_names[component_name] = schema_name
             schemas[component_name] = schema.get_json_schema_dict()
+
+        high_watermark = datetime.datetime.utcnow()
+        ret['high_watermark'] = _datetime_to_usec(high_watermark)
+        with common_utils.Namespace(app_context.get_namespace_name()):
+            watermark = StudentAggregateWatermarkEntity.get_watermark()
+        ret['incremental'] = bool(
+            self._incremental and watermark and
+            sorted(watermark.components) == sorted(schema_names) and
+            all(_can_combine_aggregate(c) for c in components))
+        if ret['incremental']:
+            ret['low_watermark'] = _datetime_to_usec(watermark.recorded_on)
+            ret['filters'] = [
+                ('recorded_on', '>', watermark.recorded_on),
+                ('recorded_on', '<=', high_watermark)]
         return ret
 
     @staticmethod
     def map(event):
+        params = context.get().mapreduce_spec.mapper.params
+        recorded_on = _datetime_to_usec(event.recorded_on)
+        if (recorded_on > params['high_watermark'] or
+            recorded_on <= params.get('low_watermark', -1)):
+            return
         for component in (StudentAggregateComponentRegistry.
                           get_components_for_event_source(event.source)):
             component_name = component.get_name()
-            params = context.get().mapreduce_spec.mapper.params
             static_data = params.get(component_name)
             value = None
             try:
@@ -226,7 +441,8 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
                                  'component handler %s failed: %s',
                                  component_name, str(ex))
             if value:
-                value_str = '%s:%s' % (component_name, transforms.dumps(value))
+                value_str = '%s:%d:%s' % (
+                    component_name, recorded_on, transforms.dumps(value))
                 yield event.user_id, value_str
 
     @staticmethod
@@ -250,24 +466,49 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
         app_context = sites.get_course_index().get_app_context_for_namespace(ns)
         course = courses.Course(None, app_context=app_context)
 
+        # When running incrementally, start from the previous aggregate and
+        # skip events it already reflects.
+        incremental = params.get('incremental')
+        previous = {}
+        student_watermark = params.get('low_watermark', -1)
+        entity = StudentAggregateEntity.get_by_key_name(user_id)
+        if incremental and entity:
+            previous = StudentAggregateEntity.load_aggregates([entity])[0]
+            if previous is None:
+                # Cannot merge into a damaged record; leave it for the next
+                # full rebuild to repair.
+                return
+            if entity.recorded_on:
+                student_watermark = max(
+                    student_watermark, _datetime_to_usec(entity.recorded_on))
+
         # Bundle items together into lists by collection name
         event_items = collections.defaultdict(list)
         for value in values:
-            component_name, payload = value.split(':', 1)
-            event_items[component_name].append(transforms.loads(payload))
+            component_name, recorded_on, payload = value.split(':', 2)
+            if int(recorded_on) > student_watermark:
+                event_items[component_name].append(transforms.loads(payload))
 
         # Build up per-Student aggregate by calling each component.  Note that
         # we call each component whether or not its mapper produced any
         # output.
-        aggregate = {}
+        aggregate = dict(previous)
         for component in StudentAggregateComponentRegistry.get_components():
             component_name = component.get_name()
+            schema_name = params['schema_names'][component_name]
             static_value = params.get(component_name)
             value = {}
             try:
-                value = component.produce_aggregate(
-                    course, student, static_value,
-                    event_items.get(component_name, []))
+                if incremental:
+                    value = component.combine_aggregate(
+                        course, student, static_value,
+                        ({schema_name: previous[schema_name]}
+                         if schema_name in previous else None),
+                        event_items.get(component_name, []))
+                else:
+                    value = component.produce_aggregate(
+                        course, student, static_value,
+                        event_items.get(component_name, []))
                 if not value:
                     continue
             # pylint: disable=broad-except
@@ -278,7 +519,6 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
                                  component_name, str(ex))
                 continue
 
-            schema_name = params['schema_names'][component_name]
             if schema_name not in value:
                 logging.critical(
                     'Student aggregation reduce handler %s produced '
@@ -299,22 +539,17 @@ class StudentAggregateGenerator(jobs.MapReduceJob):
             aggregate.update(value)
 
         # Overwrite any previous value.
-        # TODO(mgainer): Consider putting records into blobstore.  Some
-        # light activity manually producing test data is about 10K unzipped
-        # and 1K zipped.  Unlikely that we'd see 1000x this amount of
-        # activity, but possible eventually.
-        data = zlib.compress(transforms.dumps(aggregate))
-        # pylint: disable=protected-access
-        if len(data) > datastore_types._MAX_RAW_PROPERTY_BYTES:
-            # TODO(mgainer): Add injection and collection of counters to
-            # map/reduce job.  Have overridable method to verify no issues
-            # occurred when job completes.  If critical issues, mark job
-            # as failed, even though M/R completed.
-            logging.critical(
-                'Aggregated compressed student data is over %d bytes; '
-                'cannot store this in one field; ignoring this record!')
-        else:
-            StudentAggregateEntity(key_name=user_id, data=data).put()
+        StudentAggregateEntity.put_aggregate(
+            user_id, aggregate, _usec_to_datetime(params['high_watermark']),
+            previous=entity)
+
+    @classmethod
+    def complete(cls, kwargs, results):
+        params = kwargs['mapper_params']
+        with common_utils.Namespace(params['course_namespace']):
+            StudentAggregateWatermarkEntity.set_watermark(
+                _usec_to_datetime(params['high_watermark']),
+                sorted(params['schema_names']))
 
 
 class StudentAggregateComponentRegistry(
@@ -379,8 +614,10 @@ class StudentAggregateComponentRegistry(
         else:
             transform_fn = cls._build_transform_fn(data_source_context)
         ret = []
-        for row in rows:
-            item = transforms.loads(zlib.decompress(row.data))
+        for row, item in zip(
+            rows, StudentAggregateEntity.load_aggregates(rows)):
+            if item is None:
+                continue
             item['user_id'] = transform_fn(row.key().id_or_name())
             ret.append(item)
         return ret
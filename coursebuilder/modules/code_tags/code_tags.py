@@ -128,6 +128,10 @@ class CodeTag(tags.ContextAwareTag):
     def vendor(cls):
         return 'gcb'
 
+    @classmethod
+    def is_cacheable(cls):
+        return True
+
     @classmethod
     def required_modules(cls):
         return super(CodeTag, cls).required_modules() + [
@@ -126,6 +126,10 @@ class GoogleDoc(CoreTag):
     def name(cls):
         return 'Google Doc'
 
+    @classmethod
+    def is_cacheable(cls):
+        return True
+
     def render(self, node, unused_handler):
         height = node.attrib.get('height') or '300'
         link = node.attrib.get('link')
@@ -388,6 +392,10 @@ class GoogleSpreadsheet(CoreTag):
     def name(cls):
         return 'Google Spreadsheet'
 
+    @classmethod
+    def is_cacheable(cls):
+        return True
+
     def render(self, node, unused_handler):
         height = node.attrib.get('height') or '300'
         link = node.attrib.get('link')
@@ -585,6 +593,10 @@ class GoogleGroup(CoreTag):
 
 class IFrame(CoreTag):
 
+    @classmethod
+    def is_cacheable(cls):
+        return True
+
     def render(self, node, unused_handler):
         src = node.attrib.get('src')
         title = node.attrib.get('title')
@@ -675,6 +687,10 @@ class Markdown(tags.ContextAwareTag, CoreTag):
     def name(cls):
         return 'Markdown'
 
+    @classmethod
+    def is_cacheable(cls):
+        return True
+
     @classmethod
     def required_modules(cls):
         return super(Markdown, cls).required_modules() + ['gcb-code']
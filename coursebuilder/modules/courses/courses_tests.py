@@ -25,6 +25,7 @@ import urlparse
 from common import utils as common_utils
 from common import crypto
 from common import resource
+from common import users
 from controllers import sites
 from controllers import utils
 from models import config
@@ -2913,3 +2914,94 @@ class EventRecordingRestHandlerTests(actions.TestBase):
 
         self.assertEquals(self.user_id, event.user_id)
         self.assertNotEquals(random_id_one, self.user_id)
+
+    def _post_events(self, slug, events, expected_status=200):
+        request = {
+            'xsrf_token': crypto.XsrfTokenManager.create_xsrf_token(
+                lessons.EventsBatchRESTHandler.XSRF_TOKEN),
+            'events': [
+                {'source': source, 'payload': transforms.dumps(payload)}
+                for source, payload in events],
+            }
+
+        url = slug.rstrip('/') + lessons.EventsBatchRESTHandler.URL
+        response = self.post(
+            url, {'request': transforms.dumps(request)}, expect_errors=True)
+        self.assertEquals(response.status_int, expected_status)
+
+    def test_batch_of_events_is_put_at_once(self):
+        batches = models.EVENT_BATCH_PUT.value
+        self._post_events(self.COURSE_ONE_SLUG, [
+            ('course', {'index': 0}),
+            ('course', {'index': 1}),
+            ('course', {'index': 2})])
+        self.assertEquals(batches + 1, models.EVENT_BATCH_PUT.value)
+
+        with common_utils.Namespace(self.COURSE_ONE_NS):
+            events = models.EventEntity.all().fetch(10)
+        self.assertEquals(
+            [0, 1, 2],
+            sorted(transforms.loads(event.data)['index'] for event in events))
+        self.assertEquals(1, len(set(event.user_id for event in events)))
+        self.assertTrue(events[0].user_id.startswith('RND_'))
+
+    def test_too_large_batch_of_events_is_rejected(self):
+        self._post_events(
+            self.COURSE_ONE_SLUG,
+            [('course', {})] * (
+                lessons.EventsBatchRESTHandler.MAX_EVENTS_PER_BATCH + 1),
+            expected_status=400)
+        self.assertIsNone(self._get_event(self.COURSE_ONE_NS))
+
+    def _post_raw_events(self, slug, events):
+        request = {
+            'xsrf_token': crypto.XsrfTokenManager.create_xsrf_token(
+                lessons.EventsBatchRESTHandler.XSRF_TOKEN),
+            'events': events,
+            }
+        url = slug.rstrip('/') + lessons.EventsBatchRESTHandler.URL
+        return self.post(
+            url, {'request': transforms.dumps(request)}, expect_errors=True)
+
+    def test_malformed_batch_of_events_is_rejected(self):
+        received = lessons.COURSE_EVENTS_RECEIVED.value
+        batches = lessons.COURSE_EVENT_BATCHES_RECEIVED.value
+        for events in (['x'], 'x', {'source': 'course'}, [{'source': 'c'}]):
+            response = self._post_raw_events(self.COURSE_ONE_SLUG, events)
+            self.assertEquals(400, response.status_int)
+        self.assertIsNone(self._get_event(self.COURSE_ONE_NS))
+        self.assertEquals(received, lessons.COURSE_EVENTS_RECEIVED.value)
+        self.assertEquals(
+            batches, lessons.COURSE_EVENT_BATCHES_RECEIVED.value)
+
+    def test_rejected_batch_of_events_is_not_counted(self):
+        received = lessons.COURSE_EVENTS_RECEIVED.value
+        self._post_events(
+            self.COURSE_ONE_SLUG,
+            [('course', {})] * (
+                lessons.EventsBatchRESTHandler.MAX_EVENTS_PER_BATCH + 1),
+            expected_status=400)
+        self.assertEquals(received, lessons.COURSE_EVENTS_RECEIVED.value)
+
+    def test_buffered_events_are_put_when_flushed(self):
+        recorded = []
+        def listener(source, user, data):
+            recorded.append(data['index'])
+        models.EventEntity.EVENT_LISTENERS.append(listener)
+        try:
+            user = users.get_current_user()
+            with common_utils.Namespace(self.COURSE_ONE_NS):
+                for index in xrange(3):
+                    models.EventEntity.record(
+                        'course', user, transforms.dumps({'index': index}),
+                        buffered=True)
+        finally:
+            models.EventEntity.EVENT_LISTENERS.remove(listener)
+
+        # Listeners are notified as events are recorded, but nothing is
+        # written until the buffer is flushed.
+        self.assertEquals([0, 1, 2], recorded)
+        self.assertIsNone(self._get_event(self.COURSE_ONE_NS))
+        models.EventEntity.flush_buffered()
+        with common_utils.Namespace(self.COURSE_ONE_NS):
+            self.assertEquals(3, models.EventEntity.all().count())
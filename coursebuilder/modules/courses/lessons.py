@@ -51,6 +51,11 @@ COURSE_EVENTS_RECORDED = counters.PerfCounter(
     'gcb-course-events-recorded',
     'A number of activity/assessment events recorded in a datastore.')
 
+COURSE_EVENT_BATCHES_RECEIVED = counters.PerfCounter(
+    'gcb-course-event-batches-received',
+    'A number of batches of activity/assessment events received by the '
+    'server.')
+
 UNIT_PAGE_TYPE = 'unit'
 ACTIVITY_PAGE_TYPE = 'activity'
 ASSESSMENT_PAGE_TYPE = 'assessment'
@@ -139,7 +144,9 @@ class CourseHandler(utils.BaseHandler):
     @classmethod
     def get_child_routes(cls):
         """Add child handlers for REST."""
-        return [(EventsRESTHandler.URL, EventsRESTHandler)]
+        return [
+            (EventsRESTHandler.URL, EventsRESTHandler),
+            (EventsBatchRESTHandler.URL, EventsBatchRESTHandler)]
 
     def get_user_student_profile(self):
         user = self.personalize_page_and_get_user()
@@ -1011,20 +1018,11 @@ class EventsRESTHandler(utils.BaseRESTHandler):
             models.transforms.JSON_XSSI_PREFIX)
         return payload_json
 
-    def post(self):
-        """Receives event and puts it into datastore."""
-
-        COURSE_EVENTS_RECEIVED.inc()
-        if not self.can_record_student_events():
-            return
-
-        request = transforms.loads(self.request.get('request'))
-        if not self.assert_xsrf_token_or_fail(request, self.XSRF_TOKEN, {}):
-            return
-
+    def _get_user_and_student(self):
+        """Returns (user, student, user_id) for the events being recorded."""
         user = self.get_user()
         if not user:
-            return
+            return None, None, None
 
         # For non-Students, the amount of logged PII is tiny - just
         # EventEntity.  We don't want to bother doing the full Wipeout support
@@ -1044,11 +1042,28 @@ class EventsRESTHandler(utils.BaseRESTHandler):
                 self.response.set_cookie(
                     self.NON_PII_RANDOMIZED_ID, value=user_id,
                     path=self.app_context.get_slug())
+        return user, student, user_id
+
+    def post(self):
+        """Receives event and puts it into datastore."""
+
+        COURSE_EVENTS_RECEIVED.inc()
+        if not self.can_record_student_events():
+            return
+
+        request = transforms.loads(self.request.get('request'))
+        if not self.assert_xsrf_token_or_fail(request, self.XSRF_TOKEN, {}):
+            return
+
+        user, student, user_id = self._get_user_and_student()
+        if not user:
+            return
 
         source = request.get('source')
         payload_json = request.get('payload')
         payload_json = self._add_request_facts(payload_json)
-        models.EventEntity.record(source, user, payload_json, user_id)
+        models.EventEntity.record(
+            source, user, payload_json, user_id, buffered=True)
         COURSE_EVENTS_RECORDED.inc()
 
         if student:
@@ -1093,6 +1108,63 @@ class EventsRESTHandler(utils.BaseRESTHandler):
                     student, unit_id, lesson_id)
 
 
+class EventsBatchRESTHandler(EventsRESTHandler):
+    """Provides REST API for recording many events with one request.
+
+    The request carries a list of events, each with the 'source' and
+    'payload' expected by EventsRESTHandler; all of them are put into
+    datastore together.
+    """
+
+    URL = '/rest/events/batch'
+    MAX_EVENTS_PER_BATCH = 100
+
+    def post(self):
+        """Receives a batch of events and puts them into datastore."""
+
+        if not self.can_record_student_events():
+            return
+        request = transforms.loads(self.request.get('request'))
+        if not self.assert_xsrf_token_or_fail(request, self.XSRF_TOKEN, {}):
+            return
+        events = request.get('events') or []
+        if not self._is_valid_batch(events):
+            self.error(400)
+            return
+        COURSE_EVENTS_RECEIVED.inc(increment=len(events))
+        COURSE_EVENT_BATCHES_RECEIVED.inc()
+
+        user, student, user_id = self._get_user_and_student()
+        if not user:
+            return
+
+        records = []
+        for event in events:
+            source = event.get('source')
+            payload_json = self._add_request_facts(event.get('payload'))
+            records.append((source, user, payload_json, user_id))
+        models.EventEntity.record_multi(records)
+        COURSE_EVENTS_RECORDED.inc(increment=len(records))
+
+        if student:
+            for source, _, payload_json, _ in records:
+                self.process_event(student, source, payload_json)
+
+    @classmethod
+    def _is_valid_batch(cls, events):
+        """Checks that events is a list of at most MAX_EVENTS_PER_BATCH dicts.
+
+        Each of them must have a 'payload' holding a JSON string.
+        """
+        if not isinstance(events, list) or (
+            len(events) > cls.MAX_EVENTS_PER_BATCH):
+            return False
+        return all(
+            isinstance(event, dict) and
+            isinstance(event.get('payload'), basestring)
+            for event in events)
+
+
 def on_module_enabled(unused_custom_module):
     # Conform with convention for sub-packages within modules/courses; this
     # file doesn't have any module-registration-time work to do.
@@ -73,21 +73,29 @@ Course Builder module developers may want to insert additional fields into
 locations in the base CB GraphQL tree. See the test
 gql_tests.TopLevelQueryTests.test_extensibility for an example of how to do
 this.
+
+The schema is built once per process, and rebuilt if fields are added to its
+types. Within a request, course settings, Course objects and course views are
+looked up through RequestDataLoader, which loads them for all the courses
+returned by allCourses at once and shares them between nodes.
 """
 
 __author__ = [
     'John Orr (jorr@google.com)',
 ]
 
+import collections
 import graphene
 import graphene.relay
 import graphql
+from graphql_relay.connection import arrayconnection
 from graphql_relay.node import node as graphql_node
 import logging
 import os
 
 import appengine_config
 
+from common import caching
 from common import jinja_utils
 from common import utils as common_utils
 from common import users
@@ -117,6 +125,62 @@ def _resolve_id(cls, node_id):
     return resolved_id.id
 
 
+class RequestDataLoader(caching.RequestScopedSingleton):
+    """Collects and memoizes lookups made by many nodes in one request.
+
+    Graphene resolves fields one node at a time, so lookups cannot be
+    deferred until all siblings have asked for theirs. Instead, the keys
+    that sibling nodes will ask for are primed up front, and the first load
+    of a kind of value loads it for all primed keys in one call of its batch
+    function. Loaded values are kept for the rest of the request.
+    """
+
+    def __init__(self):
+        self._primed = collections.defaultdict(list)
+        self._loaded = collections.defaultdict(dict)
+
+    def prime(self, batch_fn, keys):
+        """Registers keys to be loaded along with the next load by batch_fn.
+
+        Args:
+          batch_fn: function. Given a list of keys, returns a list of the
+              corresponding values.
+          keys: list of keys that are likely to be loaded by batch_fn.
+        """
+        self._primed[batch_fn].extend(keys)
+
+    def load(self, batch_fn, key):
+        loaded = self._loaded[batch_fn]
+        if key not in loaded:
+            keys = [key]
+            for primed_key in self._primed.pop(batch_fn, []):
+                if primed_key not in loaded and primed_key not in keys:
+                    keys.append(primed_key)
+            loaded.update(zip(keys, batch_fn(keys)))
+        return loaded[key]
+
+
+def _load_environs(app_contexts):
+    environs = []
+    for app_context in app_contexts:
+        with common_utils.Namespace(app_context.namespace):
+            environs.append(courses.Course.get_environ(app_context))
+    return environs
+
+
+def _load_courses(app_contexts):
+    return [courses.Course(None, app_context) for app_context in app_contexts]
+
+
+def _load_course_views(app_contexts):
+    loader = RequestDataLoader.instance()
+    return [
+        CourseAwareObjectType.get_course_view(
+            loader.load(_load_courses, app_context),
+            CourseAwareObjectType.get_student(app_context))
+        for app_context in app_contexts]
+
+
 class CourseAwareObjectType(object):
     """Mixin providing methods for Graphene objects having a course context."""
 
@@ -128,15 +192,16 @@ class CourseAwareObjectType(object):
 
     @property
     def course(self):
-        return self._course or courses.Course(None, self.app_context)
+        return self._course or RequestDataLoader.instance().load(
+            _load_courses, self.app_context)
 
     @property
     def course_view(self):
         # StudentCourseView is expensive to build, so only construct it when
         # needed, and inherit from the parent if possible.
         if not self._course_view:
-            self._course_view = self.get_course_view(
-                self.course, self.get_student(self.app_context))
+            self._course_view = RequestDataLoader.instance().load(
+                _load_course_views, self.app_context)
         return self._course_view
 
     @classmethod
@@ -226,9 +291,9 @@ class Lesson(CourseAwareObjectType, graphene.relay.Node):
     @classmethod
     def get_lesson(cls, lesson_id):
         course_id, unit_id, lesson_id = lesson_id.split(ID_SEP)
-        course = Course.get_course(course_id).course
-        student = cls.get_student(course.app_context)
-        course_view = cls.get_course_view(course, student)
+        gql_course = Course.get_course(course_id)
+        course = gql_course.course
+        course_view = gql_course.course_view
         unit = course_view.find_element([unit_id]).course_element
         lesson = course_view.find_element([unit_id, lesson_id]).course_element
         if lesson:
@@ -282,9 +347,9 @@ class Unit(CourseAwareObjectType, graphene.relay.Node):
     @classmethod
     def get_unit(cls, unit_id):
         course_id, unit_id = unit_id.split(ID_SEP)
-        course = Course.get_course(course_id).course
-        student = cls.get_student(course.app_context)
-        course_view = cls.get_course_view(course, student)
+        gql_course = Course.get_course(course_id)
+        course = gql_course.course
+        course_view = gql_course.course_view
         unit = course_view.find_element([unit_id]).course_element
         if unit:
             return Unit(
@@ -403,8 +468,8 @@ class Course(CourseAwareObjectType, graphene.relay.Node):
 
     @property
     def course_environ(self):
-        with common_utils.Namespace(self.app_context.namespace):
-            return courses.Course.get_environ(self.app_context)
+        return RequestDataLoader.instance().load(
+            _load_environs, self.app_context)
 
     @classmethod
     def get_node(cls, node_id, info):
@@ -496,7 +561,15 @@ class Query(graphene.ObjectType):
 
     def resolve_all_courses(self, args, info):
         try:
-            return Course.get_all_courses()
+            all_courses = Course.get_all_courses()
+            # Batch lookups for the courses on the requested page.
+            app_contexts = [
+                edge.node.app_context for edge in
+                arrayconnection.connection_from_list(all_courses, args).edges]
+            loader = RequestDataLoader.instance()
+            for batch_fn in (_load_environs, _load_courses, _load_course_views):
+                loader.prime(batch_fn, app_contexts)
+            return all_courses
         except:  # pylint: disable=bare-except
             common_utils.log_exception_origin()
             raise
@@ -509,6 +582,50 @@ class Query(graphene.ObjectType):
             raise
 
 
+class _CachedSchema(graphene.Schema):
+    """A graphene.Schema which builds its GraphQLSchema only once.
+
+    graphene.Schema builds a new GraphQLSchema, with its map of all types,
+    for every query it executes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_CachedSchema, self).__init__(*args, **kwargs)
+        self._graphql_schema = None
+
+    @property
+    def schema(self):
+        if self._graphql_schema is None:
+            self._graphql_schema = super(_CachedSchema, self).schema
+        return self._graphql_schema
+
+
+def _get_fields_key(schema):
+    return sorted(
+        (name, len(getattr(object_type._meta, 'local_fields', ())))
+        for name, object_type in schema.types.iteritems())
+
+
+_SCHEMA = None
+_SCHEMA_FIELDS_KEY = None
+
+
+def get_schema():
+    """Returns the schema for Query, building it once per process.
+
+    Modules may add fields to the types in the tree with add_to_class() at
+    any time, so the schema is rebuilt when the number of fields of any of
+    its types has changed.
+    """
+    global _SCHEMA, _SCHEMA_FIELDS_KEY  # pylint: disable=global-statement
+    if _SCHEMA is None or _get_fields_key(_SCHEMA) != _SCHEMA_FIELDS_KEY:
+        schema = _CachedSchema(query=Query)
+        schema.schema  # pylint: disable=pointless-statement
+        _SCHEMA_FIELDS_KEY = _get_fields_key(schema)
+        _SCHEMA = schema
+    return _SCHEMA
+
+
 class GraphQLRestHandler(utils.BaseRESTHandler):
     URL = '/modules/gql/query'
 
@@ -519,7 +636,7 @@ class GraphQLRestHandler(utils.BaseRESTHandler):
                 'errors': ['Missing required query parameter "q"']
             }
 
-        schema = graphene.Schema(query=Query)
+        schema = get_schema()
         try:
             result = schema.execute(
                 request=query_str,
@@ -560,7 +677,13 @@ class GraphQLRestHandler(utils.BaseRESTHandler):
 
         query_str = self.request.get('q')
         expanded_gcb_tags = self.request.get('expanded_gcb_tags')
-        response_dict = self._get_response_dict(query_str, expanded_gcb_tags)
+        try:
+            response_dict = self._get_response_dict(
+                query_str, expanded_gcb_tags)
+        finally:
+            # This is a global route, so nothing else ends the request scope
+            # of the loader; values it holds are for the current user only.
+            RequestDataLoader.clear_instance()
         status_code = 400 if response_dict['errors'] else 200
         self._send_response(status_code, response_dict)
 
@@ -0,0 +1,126 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the GraphQL service on a site with many courses.
+
+Creating the courses takes a while, so this is not part of the regular test
+suite. Run it with:
+
+    python scripts/project.py --test modules.gql.gql_benchmark
+
+The latency and the number of memcache and datastore RPCs of an
+allCourses { allUnits { allLessons } } query are logged, for the first
+query after the caches are flushed and for a repeated query.
+"""
+
+import logging
+import time
+
+from common import utils as common_utils
+from controllers import sites
+from models import config
+from models import courses
+from models import models
+from modules.gql import gql_tests
+from tests.functional import actions
+
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_rpc
+
+NUM_COURSES = 200
+UNITS_PER_COURSE = 3
+LESSONS_PER_UNIT = 3
+
+ALL_COURSES_QUERY = (
+    '{allCourses {edges {node {... on Course {'
+    '  title abstract openForRegistration showInExplorer'
+    '  allUnits {edges {node {'
+    '    title'
+    '    allLessons {edges {node {title}}}}}}}}}}}')
+
+
+class AllCoursesBenchmark(gql_tests.BaseGqlTests):
+
+    def setUp(self):
+        super(AllCoursesBenchmark, self).setUp()
+        self.set_service_enabled(True)
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        for index in xrange(NUM_COURSES):
+            name = 'benchmark_%d' % index
+            app_context = actions.simple_add_course(
+                name, gql_tests.ADMIN_EMAIL, 'Course %d' % index)
+            with common_utils.Namespace(app_context.get_namespace_name()):
+                course = courses.Course(None, app_context)
+                for _ in xrange(UNITS_PER_COURSE):
+                    unit = course.add_unit()
+                    for _ in xrange(LESSONS_PER_UNIT):
+                        course.add_lesson(unit)
+                course.save()
+        courses.Course.ENVIRON_TEST_OVERRIDES = {
+            'course': {'now_available': True, 'browsable': True}}
+
+    def tearDown(self):
+        courses.Course.ENVIRON_TEST_OVERRIDES = {}
+        sites.reset_courses()
+        super(AllCoursesBenchmark, self).tearDown()
+
+    def _profile(self, hint):
+        counts = {'memcache': 0, 'db': 0}
+        # Need to muck with internals of code under test.
+        # pylint: disable=protected-access
+        old_memcache_make_async_call = memcache._CLIENT._make_async_call
+        old_db_make_rpc_call = datastore_rpc.BaseConnection._make_rpc_call
+
+        def _memcache_make_async_call(*args, **kwargs):
+            counts['memcache'] += 1
+            return old_memcache_make_async_call(*args, **kwargs)
+
+        def _db_make_rpc_call(*args, **kwargs):
+            counts['db'] += 1
+            return old_db_make_rpc_call(*args, **kwargs)
+
+        memcache._CLIENT._make_async_call = _memcache_make_async_call
+        datastore_rpc.BaseConnection._make_rpc_call = _db_make_rpc_call
+        try:
+            start = time.time()
+            response = self.get_response(ALL_COURSES_QUERY)
+            elapsed = time.time() - start
+        finally:
+            memcache._CLIENT._make_async_call = old_memcache_make_async_call
+            datastore_rpc.BaseConnection._make_rpc_call = old_db_make_rpc_call
+
+        logging.info(
+            '%s: %.2fs, %d memcache RPCs, %d datastore RPCs', hint, elapsed,
+            counts['memcache'], counts['db'])
+        return response
+
+    def test_all_courses_units_and_lessons(self):
+        memcache.flush_all()
+        sites.ApplicationContext.clear_per_process_cache()
+        response = self._profile(
+            'allCourses x %d, cold caches' % NUM_COURSES)
+        response = self._profile(
+            'allCourses x %d, warm caches' % NUM_COURSES)
+
+        edges = [
+            edge for edge in response['data']['allCourses']['edges']
+            if edge['node']['title'].startswith('Course ')]
+        self.assertEquals(NUM_COURSES, len(edges))
+        for edge in edges:
+            unit_edges = edge['node']['allUnits']['edges']
+            self.assertEquals(UNITS_PER_COURSE, len(unit_edges))
+            for unit_edge in unit_edges:
+                self.assertEquals(
+                    LESSONS_PER_UNIT,
+                    len(unit_edge['node']['allLessons']['edges']))
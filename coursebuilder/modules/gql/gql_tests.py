@@ -311,6 +311,12 @@ class TopLevelQueryTests(GraphQLTreeTests):
         # Force a reload of the gql classes in order to clear out the extension
         reload(gql)
 
+    def test_schema_is_built_once(self):
+        self.get_response('{currentUser {loggedIn}}')
+        schema = gql.get_schema()
+        self.get_response('{currentUser {loggedIn}}')
+        self.assertIs(schema, gql.get_schema())
+
 
 class CourseSettingsTests(GraphQLTreeTests):
     def setUp(self):
@@ -469,6 +475,24 @@ class CourseTests(GraphQLTreeTests):
         response = self.get_response('{node(id: "%s") {id}}' % self.course_id)
         self.assertEquals(self.course_id, response['data']['node']['id'])
 
+    def test_course_settings_are_loaded_in_one_batch(self):
+        batches = []
+        load_environs = gql._load_environs
+
+        def recording_load_environs(app_contexts):
+            batches.append([app_context.get_slug()
+                            for app_context in app_contexts])
+            return load_environs(app_contexts)
+
+        self.swap(gql, '_load_environs', recording_load_environs)
+        response = self.get_response(
+            '{allCourses {edges {node {... on Course {'
+            '    title abstract openForRegistration showInExplorer }}}}}')
+        edges = response['data']['allCourses']['edges']
+        self.assertIn(COURSE_NAME, [edge['node']['title'] for edge in edges])
+        self.assertEquals(1, len(batches))
+        self.assertEquals(len(edges), len(batches[0]))
+
     def test_course_title(self):
         response = self.get_response(
             '{course(id: "%s") {title}}' % self.course_id)
@@ -513,6 +537,25 @@ class CourseTests(GraphQLTreeTests):
                 self.course_id))
         self.assertEquals([], response['data']['course']['allUnits']['edges'])
 
+    def test_loaded_values_are_not_shared_by_requests(self):
+        self.unit.availability = courses.AVAILABILITY_UNAVAILABLE
+        self.course.save()
+        query = (
+            '{allCourses {edges {node {... on Course {title '
+            '    allUnits {edges {node {... on Unit {title '
+            '        allLessons {edges {node {id}}}}}}}}}}}}')
+
+        def get_unit_titles():
+            response = self.get_response(query)
+            for edge in response['data']['allCourses']['edges']:
+                if edge['node']['title'] == COURSE_NAME:
+                    return [unit_edge['node']['title'] for unit_edge
+                            in edge['node']['allUnits']['edges']]
+
+        self.assertEquals([self.unit.title], get_unit_titles())
+        actions.logout()
+        self.assertEquals([], get_unit_titles())
+
     def test_enrollment(self):
         actions.logout()
 
@@ -21,11 +21,13 @@ import cgi
 import collections
 import cStringIO
 import datetime
+import hashlib
 import logging
 import os
 import re
 import StringIO
 import sys
+import time
 import urllib
 from xml.dom import minidom
 import zipfile
@@ -48,6 +50,7 @@ from common import utils as common_utils
 from common import xcontent
 from controllers import sites
 from controllers import utils
+from models import counters
 from models import courses
 from models import resources_display
 from models import custom_modules
@@ -104,6 +107,20 @@ RESOURCE_BUNDLE_CACHE_NAME = 'resource_bundle'
 RESOURCE_BUNDLE_CACHE_MAX_SIZE_BYTES = 16 * 1024 * 1024
 RESOURCE_BUNDLE_CACHE_TTL_SEC = 5 * 60
 
+# max size for in-process cache of HTML translated by LazyTranslator
+TRANSLATED_HTML_CACHE_MAX_SIZE_BYTES = 8 * 1024 * 1024
+
+TRANSLATED_HTML_CACHE_HIT = counters.PerfCounter(
+    'gcb-i18n-translated-html-cache-hit',
+    'A number of times translated HTML was found in the cache.')
+TRANSLATED_HTML_CACHE_MISS = counters.PerfCounter(
+    'gcb-i18n-translated-html-cache-miss',
+    'A number of times HTML had to be translated.')
+TRANSLATED_HTML_CACHE_SAVED_MS = counters.PerfCounter(
+    'gcb-i18n-translated-html-cache-saved-ms',
+    'A total time the translations found in the cache took to make, in '
+    'milliseconds.')
+
 custom_module = None
 
 
@@ -215,13 +232,13 @@ class ResourceBundleEntity(models.BaseEntity):
     created_on = db.DateTimeProperty(auto_now_add=True, indexed=False)
     updated_on = db.DateTimeProperty(indexed=True)
 
-    @classmethod
-    def getsizeof(cls, entity):
+    def getsizeof(self):
         return (
-            sys.getsizeof(entity.data) +
-            sys.getsizeof(entity.locale) +
-            sys.getsizeof(entity.created_on) +
-            sys.getsizeof(entity.updated_on))
+            sys.getsizeof(self) +
+            sys.getsizeof(self.data) +
+            sys.getsizeof(self.locale) +
+            sys.getsizeof(self.created_on) +
+            sys.getsizeof(self.updated_on))
 
 
 class ResourceBundleDTO(object):
@@ -258,6 +275,16 @@ class ResourceBundleDAO(NamedJsonDAO):
     DTO = ResourceBundleDTO
     ENTITY = ResourceBundleEntity
 
+    @classmethod
+    def save(cls, dto):
+        ProcessScopedTranslatedHtmlCache.invalidate([dto.id])
+        return super(ResourceBundleDAO, cls).save(dto)
+
+    @classmethod
+    def save_all(cls, dtos):
+        ProcessScopedTranslatedHtmlCache.invalidate([dto.id for dto in dtos])
+        return super(ResourceBundleDAO, cls).save_all(dtos)
+
     @classmethod
     def before_put(cls, dto, entity):
         resource_bundle_key = ResourceBundleKey.fromstring(dto.id)
@@ -1721,6 +1748,7 @@ class I18nTranslationContext(caching.RequestScopedSingleton):
     def __init__(self, app_context):
         self.app_context = app_context
         self._xcontent_config = None
+        self._xcontent_config_hash = None
 
     @classmethod
     def _init_xcontent_configuration(cls, app_context):
@@ -1763,11 +1791,70 @@ class I18nTranslationContext(caching.RequestScopedSingleton):
                 self.app_context)
         return self._xcontent_config
 
+    def _get_xcontent_configuration_hash(self):
+        if self._xcontent_config_hash is None:
+            config = self._get_xcontent_configuration()
+            self._xcontent_config_hash = hashlib.sha1(repr([
+                sorted(config.inline_tag_names),
+                sorted(config.opaque_tag_names),
+                sorted(config.opaque_decomposable_tag_names),
+                sorted(
+                    (name, sorted(tag_names)) for name, tag_names in
+                    config.recomposable_attributes_map.iteritems()),
+                config.omit_empty_opaque_decomposable,
+                config.sort_attributes])).hexdigest()
+        return self._xcontent_config_hash
+
     @classmethod
     def get(cls, app_context):
         # pylint: disable=protected-access
         return cls.instance(app_context)._get_xcontent_configuration()
 
+    @classmethod
+    def get_hash(cls, app_context):
+        """Returns a hash of the xcontent configuration for cache keys."""
+        # pylint: disable=protected-access
+        return cls.instance(app_context)._get_xcontent_configuration_hash()
+
+
+class ProcessScopedTranslatedHtmlCache(caching.ProcessScopedSingleton):
+    """This class holds in-process cache of HTML translated by LazyTranslator.
+
+    Entries are grouped by (namespace, resource bundle key); within a group
+    they are keyed by hashes of the source, of the translation and of the
+    xcontent configuration. The resource bundle key includes the locale.
+    """
+
+    def __init__(self):
+        self.cache = caching.LRUCache(
+            max_size_bytes=TRANSLATED_HTML_CACHE_MAX_SIZE_BYTES)
+
+    @classmethod
+    def _bundle_key(cls, bundle_id):
+        return (models.MemcacheManager.get_namespace(), str(bundle_id))
+
+    @classmethod
+    def get(cls, bundle_id, entry_key):
+        found, entries = cls.instance().cache.get(cls._bundle_key(bundle_id))
+        if not found:
+            return None
+        return entries.get(entry_key)
+
+    @classmethod
+    def put(cls, bundle_id, entry_key, entry):
+        cache = cls.instance().cache
+        bundle_key = cls._bundle_key(bundle_id)
+        _, entries = cache.get(bundle_key)
+        entries = dict(entries or {})
+        entries[entry_key] = entry
+        cache.put(bundle_key, entries)
+
+    @classmethod
+    def invalidate(cls, bundle_ids):
+        cache = cls.instance().cache
+        for bundle_id in bundle_ids:
+            cache.delete(cls._bundle_key(bundle_id))
+
 
 def swapcase(text):
     """Swap case for full words with only alpha/num and punctutation marks."""
@@ -2964,7 +3051,39 @@ class LazyTranslator(object):
         return self.translation_dict['data'][0]['target_value']
 
     def _translate_html(self):
-        self._status = self.INVALID_TRANSLATION
+        source_value = self.source_value
+        if isinstance(source_value, unicode):
+            source_value = source_value.encode('utf-8')
+        entry_key = (
+            hashlib.sha1(source_value).hexdigest(),
+            hashlib.sha1(transforms.dumps(
+                self.translation_dict, sort_keys=True)).hexdigest(),
+            I18nTranslationContext.get_hash(self._app_context))
+
+        entry = ProcessScopedTranslatedHtmlCache.get(self._key, entry_key)
+        if entry is not None:
+            TRANSLATED_HTML_CACHE_HIT.inc()
+            TRANSLATED_HTML_CACHE_SAVED_MS.inc(increment=entry[3])
+        else:
+            TRANSLATED_HTML_CACHE_MISS.inc()
+            start = time.time()
+            status, errm, body = self._recompose_html()
+            elapsed_ms = int((time.time() - start) * 1000)
+            entry = (status, errm, body, elapsed_ms)
+            ProcessScopedTranslatedHtmlCache.put(self._key, entry_key, entry)
+
+        self._status, self._errm, body, _ = entry
+        if self._status == self.VALID_TRANSLATION:
+            return body
+        return self._detailed_error(self._errm, body)
+
+    def _recompose_html(self):
+        """Translates the source HTML using the resource bundle.
+
+        Returns:
+            A tuple of the status, the error message and the translated HTML,
+            or the best fallback for it if the translation is out of date.
+        """
         try:
             context = xcontent.Context(xcontent.ContentIO.fromstring(
                 self.source_value))
@@ -2999,22 +3118,21 @@ class LazyTranslator(object):
             transformer.recompose(context, resource_bundle, errors)
             body = xcontent.ContentIO.tostring(context.tree)
             if count_misses == 0 and not errors:
-                self._status = self.VALID_TRANSLATION
-                return body
+                return self.VALID_TRANSLATION, '', body
             else:
                 parts = 'part' if count_misses == 1 else 'parts'
                 are = 'is' if count_misses == 1 else 'are'
-                self._errm = (
+                errm = (
                     'The content has changed and {n} {parts} of the '
                     'translation {are} out of date.'.format(
                     n=count_misses, parts=parts, are=are))
-                return self._detailed_error(self._errm, self._fallback(body))
+                return self.INVALID_TRANSLATION, errm, self._fallback(body)
 
         except Exception as ex:  # pylint: disable=broad-except
             logging.exception('Unable to translate: %s', self.source_value)
-            self._errm = str(ex)
-            return self._detailed_error(
-                str(ex), self._fallback(self.source_value))
+            return (
+                self.INVALID_TRANSLATION, str(ex),
+                self._fallback(self.source_value))
 
     def _fallback(self, default_body):
         """Try to fallback to the last known good translation."""
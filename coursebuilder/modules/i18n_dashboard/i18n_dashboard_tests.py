@@ -1404,6 +1404,38 @@ class LazyTranslatorTests(actions.TestBase):
             'of the translation is out of date.',
             lazy_translator.errm)
 
+    def test_translated_html_is_cached_until_bundle_is_saved(self):
+        translation_dict = {
+            'type': 'html',
+            'source_value': 'hello',
+            'data': [
+                {'source_value': 'hello', 'target_value': 'HELLO'}]}
+        key = ResourceBundleKey(
+            resources_display.ResourceLesson.TYPE, '23', 'el')
+        i18n_dashboard.ProcessScopedTranslatedHtmlCache.clear_instance()
+
+        def translate():
+            lazy_translator = LazyTranslator(
+                self.app_context, key, 'hello', translation_dict)
+            self.assertEquals('HELLO', str(lazy_translator))
+            self.assertEquals(
+                LazyTranslator.VALID_TRANSLATION, lazy_translator.status)
+
+        hits = i18n_dashboard.TRANSLATED_HTML_CACHE_HIT.value
+        misses = i18n_dashboard.TRANSLATED_HTML_CACHE_MISS.value
+        translate()
+        translate()
+        self.assertEquals(
+            hits + 1, i18n_dashboard.TRANSLATED_HTML_CACHE_HIT.value)
+        self.assertEquals(
+            misses + 1, i18n_dashboard.TRANSLATED_HTML_CACHE_MISS.value)
+
+        ResourceBundleDAO.save(
+            ResourceBundleDTO(str(key), {'content': translation_dict}))
+        translate()
+        self.assertEquals(
+            misses + 2, i18n_dashboard.TRANSLATED_HTML_CACHE_MISS.value)
+
 
 class CourseContentTranslationTests(actions.TestBase):
     ADMIN_EMAIL = 'admin@foo.com'
@@ -15,7 +15,8 @@
 """Notification module.
 
 Provides Manager.send_async, which sends notifications; and Manager.query, which
-queries the current status of notifications.
+queries the current status of notifications. Manager.send_many and
+Manager.query_many do the same for many recipients of one notification.
 
 Notifications are transported by email. Every message you send consumes email
 quota. A message is a single payload delivered to a single user. We do not
@@ -101,6 +102,11 @@ _MAX_RETRY_DAYS = 3
 # hard failure. Used as a brake on runaway queues. Should be larger than the
 # expected cap on the number of retries imposed by taskqueue.
 _RECOVERABLE_FAILURE_CAP = 20
+# Max number of entities written with one datastore put, and of keys read with
+# one datastore get, by send_many() and query_many().
+_MAX_BATCH_SIZE = 500
+# Number of notifications sent by each task enqueued by send_many().
+_SEND_MANY_TASK_SIZE = 100
 _SECONDS_PER_HOUR = 60 * 60
 _SECONDS_PER_DAY = 24 * _SECONDS_PER_HOUR
 _USECS_PER_SECOND = 10 ** 6
@@ -125,6 +131,14 @@ COUNTER_SEND_ASYNC_SUCCESS = counters.PerfCounter(
     'gcb-notifications-send-async-success',
     'number of times send_async succeeded'
 )
+COUNTER_SEND_MANY_NOTIFICATIONS = counters.PerfCounter(
+    'gcb-notifications-send-many-notifications',
+    'number of notifications enqueued by send_many'
+)
+COUNTER_SEND_MANY_TASKS = counters.PerfCounter(
+    'gcb-notifications-send-many-tasks',
+    'number of tasks enqueued by send_many, each sending many notifications'
+)
 COUNTER_SEND_MAIL_TASK_FAILED = counters.PerfCounter(
     'gcb-notifications-send-mail-task-failed',
     'number of times the send mail task failed, but could be retried'
@@ -348,6 +362,123 @@ class Manager(object):
 
         return results
 
+    @classmethod
+    def query_many(cls, to, intent, enqueue_date):
+        """Gets the Status of notifications queued previously via send_many().
+
+        Unlike query(), this does not search: keys of notifications are made
+        from the recipient, intent and enqueue date, so the notifications sent
+        with one call to send_many() are loaded with one datastore get per
+        batch of recipients.
+
+        Args:
+          to: list of string. The recipients of the notification.
+          intent: string. Short string identifier of the intent of the
+              notification (for example, 'invitation' or 'reminder').
+          enqueue_date: datetime. The enqueue date of the notifications, as
+              set on each of the notifications returned by send_many().
+
+        Returns:
+            Dict of to string -> [Status]. Recipients who have no such
+            notification are omitted.
+        """
+        results = {}
+        keys = [
+            db.Key.from_path(
+                Notification.kind(),
+                Notification.key_name(address, intent, enqueue_date))
+            for address in to]
+        for index in xrange(0, len(keys), _MAX_BATCH_SIZE):
+            for notification in entities.get(
+                    keys[index:index + _MAX_BATCH_SIZE]):
+                if notification:
+                    _accumulate_statuses(notification, results)
+
+        return results
+
+    @classmethod
+    def send_many(
+            cls, to, sender, intent, body, subject, audit_trail=None,
+            html=None, retention_policy=None):
+        """Asyncronously sends the same notification to many recipients.
+
+        Behaves as send_async() called for each of the recipients, but puts
+        the Notification and Payload entities into datastore in batches and
+        enqueues one task per _SEND_MANY_TASK_SIZE recipients rather than one
+        task per recipient. All of the notifications have the same enqueue
+        date, so their statuses can be loaded with query_many().
+
+        Args:
+            to: list of string. Recipient email addresses.
+            sender: string. See send_async().
+            intent: string. See send_async().
+            body: string. See send_async().
+            subject: string. See send_async().
+            audit_trail: JSON-serializable object. See send_async().
+            html: optional string. See send_async().
+            retention_policy: RetentionPolicy. See send_async().
+
+        Returns:
+            List of (notification_key, payload_key) 2-tuples, one per
+            recipient, in the same order as the recipients.
+
+        Raises:
+            Exception: if values delegated to model initializers are invalid.
+            ValueError: if any of to or sender are malformed according to App
+                    Engine (note that well-formed values do not guarantee
+                    success).
+        """
+        enqueue_date = datetime.datetime.utcnow()
+        retention_policy = (
+            retention_policy if retention_policy else RetainAuditTrail)
+
+        for email in [sender] + list(to):
+            if not mail.is_email_valid(email):
+                COUNTER_SEND_ASYNC_FAILED_BAD_ARGUMENTS.inc()
+                raise ValueError('Malformed email address: "%s"' % email)
+
+        if retention_policy.NAME not in _RETENTION_POLICIES:
+            COUNTER_SEND_ASYNC_FAILED_BAD_ARGUMENTS.inc()
+            raise ValueError('Invalid retention policy: ' +
+                             str(retention_policy))
+
+        keys = []
+        for index in xrange(0, len(to), _MAX_BATCH_SIZE):
+            notifications = []
+            payloads = []
+            try:
+                for address in to[index:index + _MAX_BATCH_SIZE]:
+                    # pylint: disable=unbalanced-tuple-unpacking
+                    notification, payload = cls._make_unsaved_models(
+                        audit_trail, body, enqueue_date, intent,
+                        retention_policy.NAME, sender, subject, address,
+                        html=html)
+                    cls._mark_enqueued(notification, enqueue_date)
+                    notifications.append(notification)
+                    payloads.append(payload)
+            except Exception, e:
+                COUNTER_SEND_ASYNC_FAILED_BAD_ARGUMENTS.inc()
+                raise e
+
+            try:
+                # Payloads first: a Notification is never without its Payload.
+                payload_keys = entities.put(payloads)
+                notification_keys = entities.put(notifications)
+            except Exception, e:
+                COUNTER_SEND_ASYNC_FAILED_DATASTORE_ERROR.inc()
+                raise e
+            keys.extend(zip(notification_keys, payload_keys))
+
+        for index in xrange(0, len(keys), _SEND_MANY_TASK_SIZE):
+            deferred.defer(
+                cls._send_many_mail_task,
+                keys[index:index + _SEND_MANY_TASK_SIZE],
+                _retry_options=cls._get_retry_options())
+            COUNTER_SEND_MANY_TASKS.inc()
+        COUNTER_SEND_MANY_NOTIFICATIONS.inc(increment=len(keys))
+
+        return keys
+
     @classmethod
     def send_async(
             cls, to, sender, intent, body, subject, audit_trail=None,
@@ -652,6 +783,29 @@ class Manager(object):
             db.create_transaction_options(xg=True), cls._send_mail_task,
             notification_key, payload_key)
 
+    @classmethod
+    def _send_many_mail_task(cls, keys):
+        """Sends each of the notifications in its own transaction.
+
+        A notification whose sending fails, but may be retried, is enqueued
+        in its own task, so other notifications are not sent again.
+
+        Args:
+            keys: list of (notification_key, payload_key) 2-tuples.
+        """
+        for notification_key, payload_key in keys:
+            try:
+                cls._transactional_send_mail_task(notification_key, payload_key)
+            except deferred.PermanentTaskFailure, e:
+                _LOG.error(
+                    'Notification with key %s failed permanently: %s',
+                    notification_key, e)
+            # Must be vague. pylint: disable=broad-except
+            except Exception:
+                deferred.defer(
+                    cls._transactional_send_mail_task, notification_key,
+                    payload_key, _retry_options=cls._get_retry_options())
+
     @classmethod
     def _done(cls, notification):
         return bool(notification._done_date)
@@ -1013,5 +1167,15 @@ def register_module():
                 to, sender, intent, body, subject, audit_trail=audit_trail,
                 html=html, retention_policy=retention_policy)
 
+        def query_many(self, to, intent, enqueue_date):
+            return Manager.query_many(to, intent, enqueue_date)
+
+        def send_many(
+            self, to, sender, intent, body, subject, audit_trail=None,
+            html=None, retention_policy=None):
+            return Manager.send_many(
+                to, sender, intent, body, subject, audit_trail=audit_trail,
+                html=html, retention_policy=retention_policy)
+
     services.notifications = Service()
     return custom_module
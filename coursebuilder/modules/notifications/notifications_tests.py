@@ -696,6 +696,68 @@ class ManagerTest(actions.TestBase):
                 invalid_to, self.sender, self.intent, self.body, self.subject,
                 )
 
+    def test_send_many_enqueues_task_per_chunk_and_sends_to_everyone(self):
+        self.swap(notifications, '_SEND_MANY_TASK_SIZE', 2)
+        to = ['to%s@example.com' % index for index in xrange(5)]
+        keys = notifications.Manager.send_many(
+            to, self.sender, self.intent, self.body, self.subject)
+
+        self.assertEqual(5, len(keys))
+        notification, payload = db.get(keys[0])
+        self.assertEqual(to[0], notification.to)
+        self.assertEqual(to[0], payload.to)
+        self.assertEqual(self.body, payload.body)
+        self.assertEqual(
+            notification.enqueue_date, notification._last_enqueue_date)
+        self.assertEqual(3, len(self.taskq.GetTasks('default')))
+        self.assertEqual(
+            {notifications.Status.PENDING},
+            set(statuses[0].state for statuses in
+                notifications.Manager.query_many(
+                    to, self.intent, notification.enqueue_date).values()))
+
+        self.execute_all_deferred_tasks()
+        messages = self.get_mail_stub().get_sent_messages()
+        self.assertEqual(sorted(to), sorted(message.to for message in messages))
+        results = notifications.Manager.query_many(
+            to + ['other@example.com'], self.intent, notification.enqueue_date)
+        self.assertEqual(set(to), set(results))
+        self.assertEqual(
+            {notifications.Status.SUCCEEDED},
+            set(statuses[0].state for statuses in results.values()))
+        self.assertEqual(5, notifications.COUNTER_SEND_MAIL_TASK_SENT.value)
+
+    def test_send_many_retries_failed_notification_in_its_own_task(self):
+        to = ['to%s@example.com' % index for index in xrange(3)]
+        send_mail = notifications.mail.send_mail
+        failures = []
+
+        def fail_once_for_first_recipient(sender, to_, subject, body, **kwargs):
+            if to_ == to[0] and not failures:
+                failures.append(to_)
+                raise ValueError('thrown')
+            send_mail(sender, to_, subject, body, **kwargs)
+
+        self.swap(
+            notifications.mail, 'send_mail', fail_once_for_first_recipient)
+        notifications.Manager.send_many(
+            to, self.sender, self.intent, self.body, self.subject)
+        self.execute_all_deferred_tasks()
+
+        messages = self.get_mail_stub().get_sent_messages()
+        self.assertEqual([to[0]], failures)
+        self.assertEqual(sorted(to), sorted(message.to for message in messages))
+        self.assertEqual(1, notifications.COUNTER_SEND_MAIL_TASK_FAILED.value)
+
+    def test_send_many_raises_value_error_if_any_to_invalid(self):
+        with self.assertRaisesRegexp(ValueError, 'Malformed email address: ""'):
+            notifications.Manager.send_many(
+                [self.to, ''], self.sender, self.intent, self.body,
+                self.subject)
+
+        self.assertEqual(0, notifications.Notification.all().count())
+        self.assertEqual(0, len(self.taskq.GetTasks('default')))
+
     def test_send_mail_task_fails_permanent_and_marks_entities_if_cap_hit(self):
         over_cap = notifications._RECOVERABLE_FAILURE_CAP + 1
         notification_key, payload_key = db.put(
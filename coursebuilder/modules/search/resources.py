@@ -19,11 +19,11 @@ __author__ = 'Ellis Michael (emichael@google.com)'
 import collections
 import datetime
 import gettext
+import hashlib
 import HTMLParser
 import logging
 import operator
 import os
-import Queue
 import re
 import robotparser
 import urllib
@@ -34,6 +34,7 @@ import jinja2
 
 import appengine_config
 from common import jinja_utils
+from models import models
 from modules.announcements import announcements
 
 from google.appengine.api import search
@@ -49,6 +50,15 @@ YOUTUBE_TIMED_TEXT_URL = 'https://youtube.com/api/timedtext'
 # and more docs in the index.
 YOUTUBE_CAPTION_SIZE_SECS = 30
 
+# The maximum number of URLs fetched at the same time while indexing.
+MAX_CONCURRENT_FETCHES = 10
+
+# The maximum number of fetched resources held in memory at once while indexing.
+MAX_PREFETCHED_URLS = 100
+
+# How long a fetched resource is kept for revalidation against its ETag.
+FETCH_CACHE_TTL_SECS = 60 * 60 * 24 * 30
+
 
 class URLNotParseableException(Exception):
     """Exception thrown when the resource at a URL cannot be parsed."""
@@ -101,8 +111,106 @@ class ResourceHTMLParser(HTMLParser.HTMLParser):
         return self._title
 
 
-def get_parser_for_html(url, ignore_robots=False):
-    """Returns a ResourceHTMLParser with the parsed data."""
+class _CachedFetchResult(object):
+    """The parts of a urlfetch result kept in the fetch cache."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+def _get_fetch_cache_key(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return 'search-fetch:%s' % hashlib.sha1(url).hexdigest()
+
+
+def fetch_all(urls):
+    """Fetches URLs concurrently, revalidating cached copies by their ETags.
+
+    The fetches are asynchronous urlfetch RPCs, at most MAX_CONCURRENT_FETCHES
+    of them in flight at the same time. Responses carrying an ETag are kept in
+    memcache; the next fetch of the same URL sends If-None-Match and a 304
+    response is answered from the cached copy.
+
+    Args:
+        urls: list of string. The URLs to fetch. Duplicates are fetched once.
+    Returns:
+        A dict from each URL to its urlfetch result, or to the exception raised
+        while fetching it.
+    """
+
+    urls = list(collections.OrderedDict.fromkeys(urls))
+    cache_keys = {url: _get_fetch_cache_key(url) for url in urls}
+    cached = models.MemcacheManager.get_multi(cache_keys.values()) or {}
+
+    results = {}
+    in_flight = collections.deque()
+
+    def finish_oldest_fetch():
+        url, rpc = in_flight.popleft()
+        try:
+            results[url] = rpc.get_result()
+        except BaseException as e:  # pylint: disable=broad-except
+            results[url] = e
+
+    for url in urls:
+        if len(in_flight) >= MAX_CONCURRENT_FETCHES:
+            finish_oldest_fetch()
+        entry = cached.get(cache_keys[url])
+        rpc = urlfetch.create_rpc()
+        try:
+            if entry:
+                urlfetch.make_fetch_call(rpc, url, headers={
+                    'If-None-Match': entry.headers['ETag']})
+            else:
+                urlfetch.make_fetch_call(rpc, url)
+        except BaseException as e:  # pylint: disable=broad-except
+            # Malformed URLs are rejected before any fetch starts.
+            results[url] = e
+            continue
+        in_flight.append((url, rpc))
+    while in_flight:
+        finish_oldest_fetch()
+
+    to_cache = {}
+    for url in urls:
+        result = results[url]
+        entry = cached.get(cache_keys[url])
+        if isinstance(result, BaseException):
+            continue
+        if result.status_code == 304 and entry:
+            results[url] = entry
+        elif result.status_code == 200 and result.headers.get('ETag'):
+            to_cache[cache_keys[url]] = _CachedFetchResult(200, {
+                'Content-type': result.headers.get('Content-type', ''),
+                'ETag': result.headers.get('ETag')}, result.content)
+    if to_cache:
+        models.MemcacheManager.set_multi(to_cache, ttl=FETCH_CACHE_TTL_SECS)
+    return results
+
+
+def _fetch(url, prefetched=None):
+    """Returns the urlfetch result for url, preferring a prefetched one."""
+
+    if prefetched is None or url not in prefetched:
+        prefetched = fetch_all([url])
+    result = prefetched[url]
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def get_parser_for_html(url, ignore_robots=False, prefetched=None):
+    """Returns a ResourceHTMLParser with the parsed data.
+
+    Args:
+        url: string. The URL of the page to parse.
+        ignore_robots: boolean. Whether to skip checking robots.txt.
+        prefetched: dict. Optional results of fetch_all(); URLs not in it are
+            fetched on demand.
+    """
 
     if not (ignore_robots or _url_allows_robots(url)):
         raise URLNotParseableException('robots.txt disallows access to URL: %s'
@@ -110,7 +218,7 @@ def get_parser_for_html(url, ignore_robots=False):
 
     parser = ResourceHTMLParser(url)
     try:
-        result = urlfetch.fetch(url)
+        result = _fetch(url, prefetched=prefetched)
         if (result.status_code in [200, 304] and
             any(content_type in result.headers['Content-type'] for
                 content_type in ['text/html', 'xml'])):
@@ -126,7 +234,7 @@ def get_parser_for_html(url, ignore_robots=False):
     return parser
 
 
-def get_minidom_from_xml(url, ignore_robots=False):
+def get_minidom_from_xml(url, ignore_robots=False, prefetched=None):
     """Returns a minidom representation of an XML file at url."""
 
     if not (ignore_robots or _url_allows_robots(url)):
@@ -134,7 +242,7 @@ def get_minidom_from_xml(url, ignore_robots=False):
                                        % url)
 
     try:
-        result = urlfetch.fetch(url)
+        result = _fetch(url, prefetched=prefetched)
     except urlfetch.Error as e:
         raise URLNotParseableException('Could not parse file at URL: %s. %s' %
                                        (url, e))
@@ -153,16 +261,26 @@ def get_minidom_from_xml(url, ignore_robots=False):
     return xmldoc
 
 
-def _url_allows_robots(url):
-    """Checks robots.txt for user agent * at URL."""
+def _url_allows_robots(url, robots=None):
+    """Checks robots.txt for user agent * at URL.
+
+    Args:
+        url: string. The URL to check.
+        robots: dict. Optional map from robots.txt URL to its parsed
+            RobotFileParser, so that each site's robots.txt is read once.
+    """
     url = url.encode('utf-8')
     try:
         parts = urlparse.urlparse(url)
         base = urlparse.urlunsplit((
             parts.scheme, parts.netloc, '', None, None))
-        rp = robotparser.RobotFileParser(url=urlparse.urljoin(
-            base, '/robots.txt'))
-        rp.read()
+        robots_url = urlparse.urljoin(base, '/robots.txt')
+        rp = robots.get(robots_url) if robots is not None else None
+        if rp is None:
+            rp = robotparser.RobotFileParser(url=robots_url)
+            rp.read()
+            if robots is not None:
+                robots[robots_url] = rp
     except BaseException as e:
         logging.info('Could not retreive robots.txt for URL: %s', url)
         raise URLNotParseableException(e)
@@ -197,6 +315,11 @@ class Resource(object):
     # nonnegative.
     FRESHNESS_THRESHOLD_DAYS = 0
 
+    # Subclasses whose resources are cheap to generate should set this to
+    # True. They are then generated on every indexing run regardless of
+    # FRESHNESS_THRESHOLD_DAYS, and only re-indexed when their content changes.
+    INDEX_BY_CONTENT_HASH = False
+
     @classmethod
     def generate_all(
         cls, course, timestamps):  # pylint: disable=unused-argument
@@ -284,17 +407,14 @@ class LessonResource(Resource):
     TYPE_NAME = 'Lesson'
     RETURNED_FIELDS = ['title', 'unit_id', 'lesson_id', 'url']
     SNIPPETED_FIELDS = ['content']
-    FRESHNESS_THRESHOLD_DAYS = 3
+    INDEX_BY_CONTENT_HASH = True
 
     @classmethod
-    def generate_all(cls, course, timestamps):
+    def generate_all(cls, course, unused_timestamps):
         for lesson in course.get_lessons_for_all_units():
             unit = course.find_unit_by_id(lesson.unit_id)
-            doc_id = cls._get_doc_id(lesson.unit_id, lesson.lesson_id)
             if (course.is_unit_available(unit) and
-                course.is_lesson_available(unit, lesson) and
-                not cls._indexed_within_num_days(timestamps, doc_id,
-                                                 cls.FRESHNESS_THRESHOLD_DAYS)):
+                course.is_lesson_available(unit, lesson)):
                 try:
                     yield LessonResource(lesson)
                 except HTMLParser.HTMLParseError as e:
@@ -388,45 +508,59 @@ class ExternalLinkResource(Resource):
             A sequence of ExternalLinkResource.
         """
 
-        url_queue = Queue.LifoQueue()
-        for url, dist in sorted(link_dist.iteritems(),
-                                key=operator.itemgetter(1)):
-            url_queue.put(url)
-
-        while not url_queue.empty():
-            url = url_queue.get()
-            doc_id = cls._get_doc_id(url)
-
-            if (cls._indexed_within_num_days(timestamps, doc_id,
-                                             cls.FRESHNESS_THRESHOLD_DAYS)):
-                continue
-
-            dist = link_dist[url]
-            unit_id = link_unit_id.get(url)
-            if dist > 1:
-                break
-
-            try:
-                resource = ExternalLinkResource(url, unit_id)
-            except URLNotParseableException as e:
-                logging.info(e)
-            else:
-                if dist < 1:
-                    for new_link in resource.get_links():
-                        if new_link not in link_dist:
-                            link_dist[new_link] = dist + 1
-                            url_queue.put(new_link)
-                            link_unit_id[new_link] = unit_id
-                yield resource
-
-    def __init__(self, url, unit_id):
+        # Links are followed breadth first. The pages at each distance are
+        # fetched concurrently, in groups of MAX_PREFETCHED_URLS.
+        robots = {}
+        urls = [url for url, unused_dist in sorted(
+            link_dist.iteritems(), key=operator.itemgetter(1))]
+        while urls:
+            allowed_urls = []
+            for url in urls:
+                doc_id = cls._get_doc_id(url)
+                if (link_dist[url] > 1 or cls._indexed_within_num_days(
+                        timestamps, doc_id, cls.FRESHNESS_THRESHOLD_DAYS)):
+                    continue
+                try:
+                    if _url_allows_robots(url, robots=robots):
+                        allowed_urls.append(url)
+                    else:
+                        logging.info(
+                            'robots.txt disallows access to URL: %s', url)
+                except URLNotParseableException as e:
+                    logging.info(e)
+
+            urls = []
+            for i in xrange(0, len(allowed_urls), MAX_PREFETCHED_URLS):
+                group = allowed_urls[i:i + MAX_PREFETCHED_URLS]
+                prefetched = fetch_all(group)
+                for url in group:
+                    dist = link_dist[url]
+                    unit_id = link_unit_id.get(url)
+                    try:
+                        parser = get_parser_for_html(
+                            url, ignore_robots=True, prefetched=prefetched)
+                    except URLNotParseableException as e:
+                        logging.info(e)
+                        continue
+                    resource = ExternalLinkResource(
+                        url, unit_id, parser=parser)
+                    if dist < 1:
+                        for new_link in resource.get_links():
+                            if new_link not in link_dist:
+                                link_dist[new_link] = dist + 1
+                                urls.append(new_link)
+                                link_unit_id[new_link] = unit_id
+                    yield resource
+
+    def __init__(self, url, unit_id, parser=None):
         # distance is the distance from the course material in the link graph,
         # where a lesson notes page has a distance of 0
         super(ExternalLinkResource, self).__init__()
 
         self.url = url
         self.unit_id = unit_id
-        parser = get_parser_for_html(url)
+        if parser is None:
+            parser = get_parser_for_html(url)
         self.content = parser.get_content()
         self.title = parser.get_title()
         self.links = parser.get_links()
@@ -485,6 +619,15 @@ class YouTubeFragmentResource(Resource):
 
         youtube_ct_regex = r"""<[ ]*gcb-youtube[^>]+videoid=['"]([^'"]+)['"]"""
 
+        # Gather (unit_id, video_id, url_in_course) for each video first, so
+        # that the videos' data can be fetched concurrently.
+        videos = collections.OrderedDict()
+
+        def add_video(unit_id, video_id, url_in_course):
+            if video_id not in videos and not cls._indexed_within_num_days(
+                    timestamps, video_id, cls.FRESHNESS_THRESHOLD_DAYS):
+                videos[video_id] = (unit_id, video_id, url_in_course)
+
         for lesson in course.get_lessons_for_all_units():
             unit = course.find_unit_by_id(lesson.unit_id)
             if not (course.is_unit_available(unit) and
@@ -493,20 +636,13 @@ class YouTubeFragmentResource(Resource):
             lesson_url = 'unit?unit=%s&lesson=%s' % (
                 lesson.unit_id, lesson.lesson_id)
 
-            if lesson.video and not cls._indexed_within_num_days(
-                    timestamps, lesson.video, cls.FRESHNESS_THRESHOLD_DAYS):
-                for fragment in cls._get_fragments_for_video(
-                    lesson.unit_id, lesson.video, lesson_url):
-                    yield fragment
+            if lesson.video:
+                add_video(lesson.unit_id, lesson.video, lesson_url)
 
             match = re.search(youtube_ct_regex, unicode(lesson.objectives))
             if match:
                 for video_id in match.groups():
-                    if not cls._indexed_within_num_days(
-                            timestamps, video_id, cls.FRESHNESS_THRESHOLD_DAYS):
-                        for fragment in cls._get_fragments_for_video(
-                            lesson.unit_id, video_id, lesson_url):
-                            yield fragment
+                    add_video(lesson.unit_id, video_id, lesson_url)
 
         if announcements.custom_module.enabled:
             for entity in get_locale_filtered_announcement_list(course):
@@ -516,12 +652,13 @@ class YouTubeFragmentResource(Resource):
                 match = re.search(youtube_ct_regex, entity.html)
                 if match:
                     for video_id in match.groups():
-                        if not cls._indexed_within_num_days(
-                                timestamps, video_id,
-                                cls.FRESHNESS_THRESHOLD_DAYS):
-                            for fragment in cls._get_fragments_for_video(
-                                None, video_id, announcement_url):
-                                yield fragment
+                        add_video(None, video_id, announcement_url)
+
+        videos = videos.values()
+        for i in xrange(0, len(videos), MAX_PREFETCHED_URLS):
+            for fragment in cls._get_fragments_for_videos(
+                    videos[i:i + MAX_PREFETCHED_URLS]):
+                yield fragment
 
     @classmethod
     def _indexed_within_num_days(cls, timestamps, video_id, num_days):
@@ -533,10 +670,45 @@ class YouTubeFragmentResource(Resource):
         return False
 
     @classmethod
-    def _get_fragments_for_video(cls, unit_id, video_id, url_in_course):
+    def _get_fragments_for_videos(cls, videos):
+        """Get the transcript fragment docs for a list of videos.
+
+        The video info and track lists of all of the videos are fetched
+        concurrently, followed by all of their transcripts.
+
+        Args:
+            videos: list of (unit_id, video_id, url_in_course) tuples.
+        Returns:
+            A list of YouTubeFragmentResource.
+        """
+        video_ids = [video_id for unused_unit_id, video_id, unused_url
+                     in videos]
+        prefetched = fetch_all(
+            [cls._get_info_url(video_id) for video_id in video_ids] +
+            [cls._get_tracklist_url(video_id) for video_id in video_ids])
+
+        transcript_urls = []
+        for video_id in video_ids:
+            try:
+                transcript_urls.append(
+                    cls._get_transcript_url(video_id, prefetched=prefetched))
+            except BaseException:  # pylint: disable=broad-except
+                pass  # Reported by _get_fragments_for_video() below.
+        prefetched.update(fetch_all(transcript_urls))
+
+        fragments = []
+        for unit_id, video_id, url_in_course in videos:
+            fragments.extend(cls._get_fragments_for_video(
+                unit_id, video_id, url_in_course, prefetched=prefetched))
+        return fragments
+
+    @classmethod
+    def _get_fragments_for_video(cls, unit_id, video_id, url_in_course,
+                                 prefetched=None):
         """Get all of the transcript fragment docs for a specific video."""
         try:
-            (transcript, title, thumbnail_url) = cls._get_video_data(video_id)
+            (transcript, title, thumbnail_url) = cls._get_video_data(
+                video_id, prefetched=prefetched)
         except BaseException as e:
             logging.info('Could not parse YouTube video with id %s.\n%s',
                          video_id, e)
@@ -565,13 +737,41 @@ class YouTubeFragmentResource(Resource):
         return aggregated_fragments
 
     @classmethod
-    def _get_video_data(cls, video_id):
+    def _get_info_url(cls, video_id):
+        return urlparse.urljoin(YOUTUBE_DATA_URL, video_id)
+
+    @classmethod
+    def _get_tracklist_url(cls, video_id):
+        return urlparse.urljoin(YOUTUBE_TIMED_TEXT_URL,
+                                '?v=%s&type=list' % video_id)
+
+    @classmethod
+    def _get_transcript_url(cls, video_id, prefetched=None):
+        """Returns the URL of the transcript of the first track of a video."""
+
+        # TODO(emichael): Handle the existence of multiple tracks
+        tracklist = get_minidom_from_xml(
+            cls._get_tracklist_url(video_id), ignore_robots=True,
+            prefetched=prefetched)
+        tracks = tracklist.getElementsByTagName('track')
+        if not tracks:
+            raise URLNotParseableException('No tracks for video %s' % video_id)
+        track_name = tracks[0].attributes['name'].value
+        track_lang = tracks[0].attributes['lang_code'].value
+        track_id = tracks[0].attributes['id'].value
+
+        return urlparse.urljoin(YOUTUBE_TIMED_TEXT_URL, urllib.quote(
+            '?v=%s&lang=%s&name=%s&id=%s' %
+            (video_id, track_lang, track_name, track_id), '?/=&'))
+
+    @classmethod
+    def _get_video_data(cls, video_id, prefetched=None):
         """Returns (track_minidom, title, thumbnail_url) for a video."""
 
         try:
             vid_info = get_minidom_from_xml(
-                urlparse.urljoin(YOUTUBE_DATA_URL, video_id),
-                ignore_robots=True)
+                cls._get_info_url(video_id), ignore_robots=True,
+                prefetched=prefetched)
             title = vid_info.getElementsByTagName(
                 'title')[0].firstChild.nodeValue
             thumbnail_url = vid_info.getElementsByTagName(
@@ -583,21 +783,9 @@ class YouTubeFragmentResource(Resource):
             title = ''
             thumbnail_url = ''
 
-        # TODO(emichael): Handle the existence of multiple tracks
-        url = urlparse.urljoin(YOUTUBE_TIMED_TEXT_URL,
-                               '?v=%s&type=list' % video_id)
-        tracklist = get_minidom_from_xml(url, ignore_robots=True)
-        tracks = tracklist.getElementsByTagName('track')
-        if not tracks:
-            raise URLNotParseableException('No tracks for video %s' % video_id)
-        track_name = tracks[0].attributes['name'].value
-        track_lang = tracks[0].attributes['lang_code'].value
-        track_id = tracks[0].attributes['id'].value
-
-        url = urlparse.urljoin(YOUTUBE_TIMED_TEXT_URL, urllib.quote(
-            '?v=%s&lang=%s&name=%s&id=%s' %
-            (video_id, track_lang, track_name, track_id), '?/=&'))
-        transcript = get_minidom_from_xml(url, ignore_robots=True)
+        transcript = get_minidom_from_xml(
+            cls._get_transcript_url(video_id, prefetched=prefetched),
+            ignore_robots=True, prefetched=prefetched)
 
         return (transcript, title, thumbnail_url)
 
@@ -668,15 +856,13 @@ class AnnouncementResource(Resource):
     TYPE_NAME = 'Announcement'
     RETURNED_FIELDS = ['title', 'url']
     SNIPPETED_FIELDS = ['content']
-    FRESHNESS_THRESHOLD_DAYS = 1
+    INDEX_BY_CONTENT_HASH = True
 
     @classmethod
-    def generate_all(cls, course, timestamps):
+    def generate_all(cls, course, unused_timestamps):
         if announcements.custom_module.enabled:
             for entity in get_locale_filtered_announcement_list(course):
-                doc_id = cls._get_doc_id(entity.key())
-                if not(entity.is_draft or cls._indexed_within_num_days(
-                        timestamps, doc_id, cls.FRESHNESS_THRESHOLD_DAYS)):
+                if not entity.is_draft:
                     try:
                         yield AnnouncementResource(entity)
                     except HTMLParser.HTMLParseError as e:
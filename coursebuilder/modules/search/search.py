@@ -18,6 +18,7 @@ __author__ = 'Ellis Michael (emichael@google.com)'
 
 import collections
 import gettext
+import hashlib
 import logging
 import math
 import mimetypes
@@ -34,12 +35,14 @@ import appengine_config
 from common import crypto
 from common import safe_dom
 from common import schema_fields
+from common import utils as common_utils
 from controllers import sites
 from controllers import utils
 from models import config
 from models import counters
 from models import courses
 from models import custom_modules
+from models import entities
 from models import jobs
 from models import services
 from models import transforms
@@ -74,6 +77,9 @@ GCB_SEARCH_FOLDER_NAME = os.path.normpath('/modules/search/')
 
 MAX_RETRIES = 5
 
+# Datastore rejects puts and deletes of more entities than this in one call.
+MAX_MANIFEST_ENTITIES_PER_RPC = 500
+
 # Name of a per-course setting determining whether automatic indexing is enabled
 AUTO_INDEX_SETTING = 'auto_index'
 
@@ -91,9 +97,73 @@ def get_index(namespace, locale):
     return search.Index(name=INDEX_NAME % locale, namespace=namespace)
 
 
+class SearchManifestEntity(entities.BaseEntity):
+    """The content hash, type and indexing date of one doc in a search index.
+
+    Entities live in the course's namespace and are keyed by index name and
+    doc_id. Incremental indexing reads them instead of paging through the
+    index, and compares content hashes to skip re-indexing unchanged docs.
+    """
+
+    index_name = db.StringProperty(indexed=True)
+    doc_id = db.StringProperty(indexed=False)
+    content_hash = db.StringProperty(indexed=False)
+    doc_type = db.StringProperty(indexed=False)
+    date = db.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def _make_key_name(cls, index_name, doc_id):
+        return '%s:%s' % (index_name, doc_id)
+
+    @classmethod
+    def create(cls, index_name, doc_id, content_hash, doc_type, date):
+        return cls(
+            key_name=cls._make_key_name(index_name, doc_id),
+            index_name=index_name, doc_id=doc_id, content_hash=content_hash,
+            doc_type=doc_type, date=date)
+
+    @classmethod
+    def _all_for_index(cls, index_name, keys_only=False):
+        return common_utils.iter_all(cls.all(keys_only=keys_only).filter(
+            'index_name =', index_name))
+
+    @classmethod
+    def get_manifest(cls, index_name):
+        """Returns a dict from doc_id to entity for the docs in an index."""
+        return {entity.doc_id: entity
+                for entity in cls._all_for_index(index_name)}
+
+    @classmethod
+    def put_entries(cls, entries):
+        _in_batches(db.put, entries)
+
+    @classmethod
+    def delete_docs(cls, index_name, doc_ids):
+        _in_batches(db.delete, [db.Key.from_path(
+            cls.kind(), cls._make_key_name(index_name, doc_id))
+                                for doc_id in doc_ids])
+
+    @classmethod
+    def delete_manifest(cls, index_name):
+        _in_batches(
+            db.delete, list(cls._all_for_index(index_name, keys_only=True)))
+
+
+def _in_batches(rpc, items):
+    """Call a datastore put or delete on items, a few hundred at a time."""
+    for i in xrange(0, len(items), MAX_MANIFEST_ENTITIES_PER_RPC):
+        rpc(items[i:i + MAX_MANIFEST_ENTITIES_PER_RPC])
+
+
 def index_all_docs(course, incremental):
     """Index all of the docs for a given models.Course object.
 
+    Lessons and announcements are generated on every run, but only those whose
+    content hash differs from the one in the index manifest are put. Docs for
+    lessons and announcements that are no longer generated are deleted. With
+    incremental off, every doc is put and every doc that is no longer generated
+    is deleted.
+
     Args:
         course: models.courses.Course. the course to index.
         incremental: boolean. whether or not to index only new or out-of-date
@@ -117,35 +187,123 @@ def index_all_docs(course, incremental):
     index = get_index(
         course.app_context.get_namespace_name(),
         course.app_context.get_current_locale())
-    timestamps, doc_types = (_get_index_metadata(index) if incremental
-                             else ({}, {}))
+    manifest = _get_manifest(index)
+    timestamps = ({doc_id: entry.date for doc_id, entry in manifest.iteritems()}
+                  if incremental else {})
+
+    # Documents are put in batches; a later document with the same doc_id
+    # replaces an earlier one still waiting in the batch.
+    generated_doc_ids = set()
+    batch = collections.OrderedDict()
     for doc in resources.generate_all_documents(course, timestamps):
-        retry_count = 0
-        while retry_count < MAX_RETRIES:
-            try:
-                index.put(doc)
-                timestamps[doc.doc_id] = doc['date'][0].value
-                doc_types[doc.doc_id] = doc['type'][0].value
-                break
-            except search.Error, e:
-                if e.results[0].code == search.OperationResult.TRANSIENT_ERROR:
-                    retry_count += 1
-                    if retry_count >= MAX_RETRIES:
-                        logging.error(
-                            'Multiple transient errors indexing doc_id: %s',
-                            doc.doc_id)
-                else:
-                    logging.error('Failed to index doc_id: %s', doc.doc_id)
-                    break
+        generated_doc_ids.add(doc.doc_id)
+        content_hash = _get_content_hash(doc)
+        entry = manifest.get(doc.doc_id)
+        if incremental and entry and entry.content_hash == content_hash:
+            continue
+        batch[doc.doc_id] = (doc, content_hash)
+        if len(batch) >= search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST:
+            _put_docs(index, batch.values(), manifest)
+            batch.clear()
+    if batch:
+        _put_docs(index, batch.values(), manifest)
+
+    # Fresh external links and videos are not generated in incremental mode,
+    # so only docs of types that are always generated are known to be gone.
+    hashed_types = set(
+        resource_type.TYPE_NAME
+        for resource_type, unused_result_type in resources.RESOURCE_TYPES
+        if resource_type.INDEX_BY_CONTENT_HASH)
+    _delete_docs(index, [
+        doc_id for doc_id, entry in manifest.iteritems()
+        if doc_id not in generated_doc_ids and (
+            not incremental or entry.doc_type in hashed_types)], manifest)
 
     indexed_doc_types = collections.Counter()
-    for type_name in doc_types.values():
-        indexed_doc_types[type_name] += 1
-    return {'num_indexed_docs': len(timestamps),
+    for entry in manifest.itervalues():
+        indexed_doc_types[entry.doc_type] += 1
+    return {'num_indexed_docs': len(manifest),
             'doc_types': indexed_doc_types,
             'indexing_time_secs': time.time() - start_time}
 
 
+def _get_content_hash(doc):
+    """Returns a hash of the fields of doc other than its indexing date."""
+    content = [(field.name, unicode(field.value))
+               for field in doc.fields if field.name != 'date']
+    return hashlib.sha1(transforms.dumps(content)).hexdigest()
+
+
+def _get_manifest(index):
+    """Returns a dict from doc_id to SearchManifestEntity for an index."""
+
+    manifest = SearchManifestEntity.get_manifest(index.name)
+    if not manifest:
+        # The index may predate manifests; adopt whatever it holds. Without
+        # content hashes, every lesson and announcement is put once more.
+        timestamps, doc_types = _get_index_metadata(index)
+        manifest = {
+            doc_id: SearchManifestEntity.create(
+                index.name, doc_id, None, doc_types[doc_id], timestamp)
+            for doc_id, timestamp in timestamps.iteritems()}
+        SearchManifestEntity.put_entries(manifest.values())
+    return manifest
+
+
+def _put_docs(index, docs, manifest):
+    """Put a batch of docs in the index, retrying only transient failures.
+
+    Args:
+        index: search.Index. The index to add the docs to.
+        docs: list of (search.Document, content hash) pairs. At most
+            search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST docs.
+        manifest: dict from doc_id to SearchManifestEntity. Updated, and
+            saved, with the docs that were indexed.
+    """
+
+    retry_count = 0
+    while docs:
+        try:
+            results = index.put([doc for doc, unused_hash in docs])
+        except search.PutError, e:
+            results = e.results
+
+        failed_docs = []
+        indexed_entries = []
+        for (doc, content_hash), result in zip(docs, results):
+            if result.code == search.OperationResult.OK:
+                entry = SearchManifestEntity.create(
+                    index.name, doc.doc_id, content_hash,
+                    doc['type'][0].value, doc['date'][0].value)
+                manifest[doc.doc_id] = entry
+                indexed_entries.append(entry)
+            elif result.code == search.OperationResult.TRANSIENT_ERROR:
+                failed_docs.append((doc, content_hash))
+            else:
+                logging.error('Failed to index doc_id: %s', doc.doc_id)
+        SearchManifestEntity.put_entries(indexed_entries)
+
+        retry_count += 1
+        if failed_docs and retry_count >= MAX_RETRIES:
+            for doc, unused_hash in failed_docs:
+                logging.error(
+                    'Multiple transient errors indexing doc_id: %s',
+                    doc.doc_id)
+            break
+        docs = failed_docs
+
+
+def _delete_docs(index, doc_ids, manifest):
+    """Delete docs from the index and from its manifest."""
+
+    for i in xrange(0, len(doc_ids), search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST):
+        batch = doc_ids[i:i + search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST]
+        index.delete(batch)
+        SearchManifestEntity.delete_docs(index.name, batch)
+        for doc_id in batch:
+            del manifest[doc_id]
+
+
 def clear_index(namespace, locale):
     """Delete all docs in the index for a given models.Course object."""
 
@@ -159,6 +317,7 @@ def clear_index(namespace, locale):
         index.delete(doc_ids)
         doc_ids = [document.doc_id
                    for document in index.get_range(ids_only=True)]
+    SearchManifestEntity.delete_manifest(index.name)
     return {'deleted_docs': total_docs}
 
 
@@ -439,7 +598,7 @@ class CronIndexCourse(utils.AbstractAllCoursesCronHandler):
 @db.transactional(xg=True)
 def check_job_and_submit(app_context, incremental=True):
     """Determines whether an indexing job is running and submits if not."""
-    indexing_job = IndexCourse(app_context, incremental=False)
+    indexing_job = IndexCourse(app_context, incremental=incremental)
     job_entity = IndexCourse(app_context).load()
 
     bad_status_codes = [jobs.STATUS_CODE_STARTED, jobs.STATUS_CODE_QUEUED]
@@ -477,9 +636,10 @@ class IndexCourse(jobs.DurableJob):
             'indexing_time_secs': 0,
             'locales': []
         }
-        for locale in app_context.get_allowed_locales():
-            stats = clear_index(namespace, locale)
-            indexing_stats['deleted_docs'] += stats['deleted_docs']
+        if not self.incremental:
+            for locale in app_context.get_allowed_locales():
+                stats = clear_index(namespace, locale)
+                indexing_stats['deleted_docs'] += stats['deleted_docs']
         for locale in app_context.get_allowed_locales():
             app_context.set_current_locale(locale)
             course = courses.Course(None, app_context=app_context)
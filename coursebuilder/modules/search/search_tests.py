@@ -28,6 +28,7 @@ from models import models
 from models import transforms
 from modules.announcements import announcements
 from modules.i18n_dashboard import i18n_dashboard
+from modules.search import resources
 from modules.search import search
 from modules.search import search_unit_tests
 from tests.functional import actions
@@ -293,6 +294,57 @@ class SearchTest(search_unit_tests.SearchTestBase):
         self.assertNotIn('gcb-search-result', response.body)
         self.assertNotIn('v=portal', response.body)
 
+    def test_incremental_index_puts_only_changed_docs(self):
+        context = actions.simple_add_course('test', 'admin@google.com',
+                                            'Test Course')
+        course = courses.Course(None, context)
+        unit = course.add_unit()
+        unit.availability = courses.AVAILABILITY_AVAILABLE
+        lesson1 = course.add_lesson(unit)
+        lesson1.objectives = 'A lesson about apples.'
+        lesson1.availability = courses.AVAILABILITY_AVAILABLE
+        lesson2 = course.add_lesson(unit)
+        lesson2.objectives = 'A lesson about pears.'
+        lesson2.availability = courses.AVAILABILITY_AVAILABLE
+        course.update_unit(unit)
+        course.save()
+
+        put_doc_ids = []
+        original_put_docs = search._put_docs
+
+        def put_docs(index, docs, manifest):
+            put_doc_ids.extend(doc.doc_id for doc, unused_hash in docs)
+            original_put_docs(index, docs, manifest)
+
+        self.swap(search, '_put_docs', put_docs)
+
+        with common_utils.Namespace('ns_test'):
+            stats = search.index_all_docs(course, incremental=True)
+            self.assertEquals(2, stats['num_indexed_docs'])
+            self.assertEquals(2, len(put_doc_ids))
+
+            # Nothing changed; nothing is put.
+            del put_doc_ids[:]
+            stats = search.index_all_docs(course, incremental=True)
+            self.assertEquals(2, stats['num_indexed_docs'])
+            self.assertEquals([], put_doc_ids)
+
+            # Only the changed lesson is put; the deleted one is removed.
+            course = courses.Course(None, context)
+            course.find_lesson_by_id(
+                None, lesson2.lesson_id).objectives = 'A lesson about plums.'
+            course.delete_lesson(course.find_lesson_by_id(
+                None, lesson1.lesson_id))
+            course.save()
+            course = courses.Course(None, context)
+            stats = search.index_all_docs(course, incremental=True)
+            self.assertEquals(1, stats['num_indexed_docs'])
+            self.assertEquals([resources.LessonResource._get_doc_id(
+                unit.unit_id, lesson2.lesson_id)], put_doc_ids)
+            self.assertEquals(0, search.fetch(course, 'apples')['total_found'])
+            self.assertEquals(0, search.fetch(course, 'pears')['total_found'])
+            self.assertEquals(1, search.fetch(course, 'plums')['total_found'])
+
     def test_tracked_lessons(self):
         context = actions.simple_add_course('test', 'admin@google.com',
                                             'Test Course')
@@ -18,14 +18,20 @@
 
 __author__ = 'Ellis Michael (emichael@google.com)'
 
+import datetime
 import re
 import robotparser
 import urlparse
 
+from models import config
+from models import models
 from modules.search import resources
+from modules.search import search
 from tests.functional import actions
 
+from google.appengine.api import search as gae_search
 from google.appengine.api import urlfetch
+from google.appengine.ext import db
 
 
 VALID_PAGE_URL = 'http://valid.null/'
@@ -204,6 +210,22 @@ class SearchTestBase(actions.TestBase):
 
         self.swap(urlfetch, 'fetch', return_doc)
 
+        class FakeFetchRpc(object):
+            """Monkey patch for asynchronous URL fetching."""
+
+            def __init__(self):
+                self.call = None
+
+            def get_result(self):
+                return self.call()
+
+        def make_fetch_call(rpc, url, **kwargs):
+            # Defer to whatever urlfetch.fetch is when the result is read.
+            rpc.call = lambda: urlfetch.fetch(url, **kwargs)
+
+        self.swap(urlfetch, 'create_rpc', FakeFetchRpc)
+        self.swap(urlfetch, 'make_fetch_call', make_fetch_call)
+
         class FakeRobotParser(robotparser.RobotFileParser):
             """Monkey patch for robot parser."""
 
@@ -290,3 +312,166 @@ class ParserTests(SearchTestBase):
             'document')[0].attributes['attribute'].value)
         self.assertIn('Text content.', dom.getElementsByTagName(
             'childNode')[0].firstChild.nodeValue)
+
+
+class FetchTests(SearchTestBase):
+    """Unit tests for concurrent, cached fetching of resources."""
+
+    def setUp(self):
+        super(FetchTests, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+
+    def tearDown(self):
+        del config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name]
+        super(FetchTests, self).tearDown()
+
+    def test_fetch_all(self):
+        bad_url = 'http://bad.null/'
+        original_fetch = urlfetch.fetch
+
+        def fetch(url, **kwargs):
+            if url == bad_url:
+                raise urlfetch.DownloadError('Unreachable')
+            return original_fetch(url, **kwargs)
+
+        self.swap(urlfetch, 'fetch', fetch)
+        results = resources.fetch_all(
+            [VALID_PAGE_URL, LINKED_PAGE_URL, bad_url, VALID_PAGE_URL])
+        self.assertEqual(3, len(results))
+        self.assertEqual(VALID_PAGE, results[VALID_PAGE_URL].content)
+        self.assertEqual(LINKED_PAGE, results[LINKED_PAGE_URL].content)
+        self.assertIsInstance(results[bad_url], urlfetch.DownloadError)
+
+    def test_fetch_all_limits_fetches_in_flight(self):
+        in_flight = []
+        most_in_flight = []
+        original_make_fetch_call = urlfetch.make_fetch_call
+
+        def make_fetch_call(rpc, url, **kwargs):
+            original_make_fetch_call(rpc, url, **kwargs)
+            in_flight.append(url)
+            most_in_flight.append(len(in_flight))
+            call = rpc.call
+
+            def finish():
+                in_flight.remove(url)
+                return call()
+            rpc.call = finish
+
+        self.swap(resources, 'MAX_CONCURRENT_FETCHES', 2)
+        self.swap(urlfetch, 'make_fetch_call', make_fetch_call)
+        urls = ['http://valid.null/%s' % i for i in xrange(5)]
+        results = resources.fetch_all(urls)
+        self.assertEqual(set(urls), set(results.keys()))
+        self.assertEqual(2, max(most_in_flight))
+        self.assertEqual([], in_flight)
+
+    def test_fetch_revalidates_cached_copy_by_etag(self):
+        requests = []
+
+        class Response(object):
+
+            def __init__(self, code, content):
+                self.status_code = code
+                self.headers = {'Content-type': 'text/html', 'ETag': 'v1'}
+                self.content = content
+
+        def fetch(url, headers=None):
+            requests.append(headers)
+            if headers and headers.get('If-None-Match') == 'v1':
+                return Response(304, '')
+            return Response(200, VALID_PAGE)
+
+        self.swap(urlfetch, 'fetch', fetch)
+        parser = resources.get_parser_for_html(
+            VALID_PAGE_URL, ignore_robots=True)
+        self.assertEqual('Test Page', parser.get_title())
+        parser = resources.get_parser_for_html(
+            VALID_PAGE_URL, ignore_robots=True)
+        self.assertEqual('Test Page', parser.get_title())
+        self.assertEqual([None, {'If-None-Match': 'v1'}], requests)
+
+
+class PutDocsTests(actions.TestBase):
+    """Unit tests for putting batches of docs in the search index."""
+
+    def _make_doc(self, doc_id):
+        return gae_search.Document(doc_id=doc_id, fields=[
+            gae_search.TextField(name='type', value='Lesson'),
+            gae_search.DateField(name='date', value=datetime.datetime.now())])
+
+    def test_only_failed_docs_are_retried(self):
+        calls = []
+
+        class FakeIndex(object):
+
+            name = 'test_index'
+
+            def put(self, docs):
+                calls.append([doc.doc_id for doc in docs])
+                codes = {
+                    'ok': gae_search.OperationResult.OK,
+                    'bad': gae_search.OperationResult.INVALID_REQUEST,
+                    'flaky': (gae_search.OperationResult.TRANSIENT_ERROR
+                              if len(calls) == 1
+                              else gae_search.OperationResult.OK),
+                }
+                results = [gae_search.PutResult(code=codes[doc.doc_id])
+                           for doc in docs]
+                if any(result.code != gae_search.OperationResult.OK
+                       for result in results):
+                    raise gae_search.PutError('Failed', results)
+                return results
+
+        manifest = {}
+        search._put_docs(
+            FakeIndex(),
+            [(self._make_doc(doc_id), doc_id + '_hash')
+             for doc_id in ['ok', 'bad', 'flaky']],
+            manifest)
+        self.assertEqual([['ok', 'bad', 'flaky'], ['flaky']], calls)
+        self.assertEqual(['flaky', 'ok'], sorted(manifest))
+        self.assertEqual('flaky_hash', manifest['flaky'].content_hash)
+        self.assertEqual(
+            manifest, search.SearchManifestEntity.get_manifest('test_index'))
+
+
+class ManifestTests(actions.TestBase):
+    """Unit tests for reading and writing search index manifests."""
+
+    def test_manifest_is_written_and_deleted_in_batches(self):
+        self.swap(search, 'MAX_MANIFEST_ENTITIES_PER_RPC', 2)
+        batch_sizes = []
+        original_put = db.put
+        original_delete = db.delete
+
+        def put(entities):
+            batch_sizes.append(len(entities))
+            return original_put(entities)
+
+        def delete(keys):
+            batch_sizes.append(len(keys))
+            return original_delete(keys)
+
+        self.swap(db, 'put', put)
+        self.swap(db, 'delete', delete)
+
+        now = datetime.datetime.now()
+        search.SearchManifestEntity.put_entries([
+            search.SearchManifestEntity.create(
+                'test_index', 'doc_%d' % i, 'hash', 'Lesson', now)
+            for i in xrange(5)])
+        self.assertEqual([2, 2, 1], batch_sizes)
+        self.assertEqual(
+            5, len(search.SearchManifestEntity.get_manifest('test_index')))
+
+        del batch_sizes[:]
+        search.SearchManifestEntity.delete_docs(
+            'test_index', ['doc_0', 'doc_1', 'doc_2'])
+        self.assertEqual([2, 1], batch_sizes)
+
+        del batch_sizes[:]
+        search.SearchManifestEntity.delete_manifest('test_index')
+        self.assertEqual([2], batch_sizes)
+        self.assertEqual(
+            {}, search.SearchManifestEntity.get_manifest('test_index'))
@@ -1648,12 +1648,11 @@ def _add_student_group_to_profile(handler, app_context, student):
     return ret
 
 
-def modify_course_environment(app_context, env):
-    """Callback: Inject overrides into course-level environment settings."""
+def _get_student_group_overriding_course_environment(app_context):
     student_group = StudentGroupMembership.get_student_group_for_current_user(
         app_context)
     if not student_group:
-        return
+        return None
 
     # Consider a user who has been added to a student group.  Now, whenever
     # that user is in session, we override the course-level settings to
@@ -1668,7 +1667,28 @@ def modify_course_environment(app_context, env):
         path = sites.get_path_info()
         if (path.endswith(StudentGroupRestHandler.URL) or
             path.endswith(StudentGroupAvailabilityRestHandler.URL)):
-            return
+            return None
+    return student_group
+
+
+def get_course_environment_cache_key(app_context):
+    """Callback: Identify overrides modify_course_environment() would apply."""
+    student_group = _get_student_group_overriding_course_environment(
+        app_context)
+    if not student_group:
+        return None
+    return (
+        student_group.id,
+        transforms.dumps(student_group.dict, sort_keys=True),
+        users.get_current_user().email())
+
+
+def modify_course_environment(app_context, env):
+    """Callback: Inject overrides into course-level environment settings."""
+    student_group = _get_student_group_overriding_course_environment(
+        app_context)
+    if not student_group:
+        return
 
     # Apply overrides as applicable.
     # pylint: disable=protected-access
@@ -1947,6 +1967,8 @@ def register_module():
         # fetched, we can submit overwrite items.
         courses.Course.COURSE_ENV_POST_COPY_HOOKS.append(
             modify_course_environment)
+        courses.Course.COURSE_ENV_POST_COPY_HOOK_CACHE_KEYS[
+            modify_course_environment] = get_course_environment_cache_key
 
         # Register callbacks that alter course explorer course cards.
         graphql.notify_module_enabled(CourseOverrideTrigger, MODULE_NAME)
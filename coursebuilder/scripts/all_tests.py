@@ -57,11 +57,13 @@ ALL_TEST_CLASSES = {
     'tests.functional.common_crypto.PiiObfuscationHmac': 2,
     'tests.functional.common_crypto.GenCryptoKeyFromHmac': 2,
     'tests.functional.common_crypto.GetExternalUserIdTests': 4,
+    'tests.functional.common_jinja_utils.JinjaEnvironmentPoolTest': 4,
     'tests.functional.common_manifest.ModuleManifestTests': 7,
     'tests.functional.common_users.AppEnginePassthroughUsersServiceTest': 10,
     'tests.functional.common_users.AuthInterceptorAndRequestHooksTest': 2,
     'tests.functional.common_users.PublicExceptionsAndClassesIdentityTests': 2,
     'tests.functional.common_user_routes.TestUserRoutes': 9,
+    'tests.functional.controllers_sites.RoutingTest': 3,
     'tests.functional.controllers_utils.LocalizedGlobalHandlersTest': 4,
     'tests.functional.i18n.I18NCourseSettingsTests': 7,
     'tests.functional.i18n.I18NMultipleChoiceQuestionTests': 6,
@@ -71,7 +73,8 @@ ALL_TEST_CLASSES = {
     'tests.functional.model_analytics.ProgressAnalyticsTest': 9,
     'tests.functional.model_analytics.QuestionAnalyticsTest': 3,
     'tests.functional.model_config.ValueLoadingTests': 2,
-    'tests.functional.model_courses.CourseCachingTest': 5,
+    'tests.functional.model_courses.CourseCachingTest': 10,
+    'tests.functional.model_courses.CourseEnvironCachingTest': 4,
     'tests.functional.model_courses.PermissionsTest': 4,
     'tests.functional.model_data_sources.PaginatedTableTest': 17,
     'tests.functional.model_data_sources.PiiExportTest': 4,
@@ -83,7 +86,7 @@ ALL_TEST_CLASSES = {
     'tests.functional.model_models.BaseJsonDaoTestCase': 1,
     'tests.functional.model_models.ContentChunkTestCase': 16,
     'tests.functional.model_models.EventEntityTestCase': 1,
-    'tests.functional.model_models.MemcacheManagerTestCase': 4,
+    'tests.functional.model_models.MemcacheManagerTestCase': 7,
     'tests.functional.model_models.PersonalProfileTestCase': 1,
     'tests.functional.model_models.QuestionDAOTestCase': 3,
     'tests.functional.model_models.StudentAnswersEntityTestCase': 1,
@@ -97,14 +100,16 @@ ALL_TEST_CLASSES = {
     'tests.functional.model_student_work.ReviewTest': 3,
     'tests.functional.model_student_work.SubmissionTest': 4,
     'tests.functional.model_utils.QueryMapperTest': 4,
+    'tests.functional.model_vfs.VfsDeletionTrackingTest': 3,
     'tests.functional.model_vfs.VfsLargeFileSupportTest': 6,
+    'tests.functional.model_vfs.VfsResyncThrottlingTest': 1,
     'tests.functional.module_config_test.ManipulateAppYamlFileTest': 8,
     'tests.functional.module_config_test.ModuleIncorporationTest': 12,
     'tests.functional.module_config_test.ModuleManifestTest': 7,
     'tests.functional.modules_data_source_providers.CourseElementsTest': 11,
     'tests.functional.modules_data_source_providers.StudentScoresTest': 6,
     'tests.functional.modules_data_source_providers.StudentsTest': 5,
-    'tests.functional.progress_percent.ProgressPercent': 4,
+    'tests.functional.progress_percent.ProgressPercent': 7,
     'tests.functional.student_answers.StudentAnswersAnalyticsTest': 1,
     'tests.functional.student_labels.StudentLabelsTest': 32,
     'tests.functional.student_last_location.NonRootCourse': 9,
@@ -169,7 +174,7 @@ ALL_TEST_CLASSES = {
     'tests.unit.common_safe_dom.ElementTests': 17,
     'tests.unit.common_safe_dom.ScriptElementTests': 3,
     'tests.unit.common_safe_dom.EntityTests': 11,
-    'tests.unit.common_tags.CustomTagTests': 13,
+    'tests.unit.common_tags.CustomTagTests': 15,
     'tests.unit.common_utc.UtcUnitTests': 4,
     'tests.unit.common_utils.CommonUnitTests': 11,
     'tests.unit.common_utils.ParseTimedeltaTests': 8,
@@ -179,6 +184,7 @@ ALL_TEST_CLASSES = {
     'tests.unit.javascript_tests.AllJavaScriptTests': 2,
     'tests.unit.models_analytics.AnalyticsTests': 6,
     'tests.unit.models_config.ValidateIntegerRangeTests': 3,
+    'tests.unit.models_courses.OutlineIndexTests': 4,
     'tests.unit.models_courses.WorkflowValidationTests': 13,
     'tests.unit.models_transforms.JsonToDictTests': 13,
     'tests.unit.models_transforms.JsonParsingTests': 3,
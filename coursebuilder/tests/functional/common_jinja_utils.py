@@ -0,0 +1,89 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the pool of Jinja environments in common/jinja_utils.py."""
+
+import os
+import shutil
+import tempfile
+
+import jinja2
+
+from common import jinja_utils
+from tests.functional import actions
+
+
+class JinjaEnvironmentPoolTest(actions.TestBase):
+
+    def setUp(self):
+        super(JinjaEnvironmentPoolTest, self).setUp()
+        self.templates_dir = tempfile.mkdtemp()
+        self._write('page.html', '{% include "tags.html" %}')
+        self._write('tags.html', '[{{ text|gcb_tags }}]')
+        jinja_utils.ProcessScopedJinjaEnvironmentPool.clear_instance()
+        self.old_get_gcb_tags_filter = jinja_utils.get_gcb_tags_filter
+        jinja_utils.get_gcb_tags_filter = lambda handler: (
+            lambda data: jinja2.utils.Markup('%s:%s' % (handler, data)))
+
+    def tearDown(self):
+        jinja_utils.get_gcb_tags_filter = self.old_get_gcb_tags_filter
+        jinja_utils.ProcessScopedJinjaEnvironmentPool.clear_instance()
+        shutil.rmtree(self.templates_dir)
+        super(JinjaEnvironmentPoolTest, self).tearDown()
+
+    def _write(self, name, text):
+        with open(os.path.join(self.templates_dir, name), 'w') as fp:
+            fp.write(text)
+
+    def _render(self, handler):
+        return jinja_utils.render_partial_template(
+            'page.html', [self.templates_dir], {'text': 'x'}, handler=handler)
+
+    def test_environment_is_reused(self):
+        hits = jinja_utils.JINJA_ENVIRONMENT_CACHE_HIT.value
+        misses = jinja_utils.JINJA_ENVIRONMENT_CACHE_MISS.value
+        compiles = jinja_utils.JINJA_TEMPLATE_COMPILE_COUNT.value
+        for _ in xrange(3):
+            self._render('handler')
+
+        self.assertEquals(
+            hits + 2, jinja_utils.JINJA_ENVIRONMENT_CACHE_HIT.value)
+        self.assertEquals(
+            misses + 1, jinja_utils.JINJA_ENVIRONMENT_CACHE_MISS.value)
+        self.assertLessEqual(
+            jinja_utils.JINJA_TEMPLATE_COMPILE_COUNT.value, compiles + 2)
+
+    def test_environments_are_keyed_by_autoescape(self):
+        misses = jinja_utils.JINJA_ENVIRONMENT_CACHE_MISS.value
+        jinja_utils.get_template('page.html', [self.templates_dir])
+        jinja_utils.get_template(
+            'page.html', [self.templates_dir], autoescape=False)
+        self.assertEquals(
+            misses + 2, jinja_utils.JINJA_ENVIRONMENT_CACHE_MISS.value)
+
+    def test_gcb_tags_are_applied_for_the_rendering_handler(self):
+        self.assertEquals('[first:x]', self._render('first'))
+        self.assertEquals('[second:x]', self._render('second'))
+
+        template = jinja_utils.get_template(
+            'page.html', [self.templates_dir], handler='outer')
+        self.assertEquals('[outer:x]', template.render({'text': 'x'}))
+
+    def test_environments_are_not_pooled_without_template_cache(self):
+        misses = jinja_utils.JINJA_ENVIRONMENT_CACHE_MISS.value
+        with actions.OverriddenConfig(
+                jinja_utils.CAN_USE_JINJA2_TEMPLATE_CACHE.name, False):
+            self.assertEquals('[handler:x]', self._render('handler'))
+        self.assertEquals(
+            misses, jinja_utils.JINJA_ENVIRONMENT_CACHE_MISS.value)
@@ -0,0 +1,81 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for routing of requests to courses and handlers in sites.py."""
+
+from controllers import sites
+from controllers import utils
+from tests.functional import actions
+
+
+class _Course(object):
+
+    def __init__(self, slug):
+        self._slug = slug
+
+    def get_slug(self):
+        return self._slug
+
+    def get_namespace_name(self):
+        return 'ns%s' % self._slug.replace('/', '_')
+
+
+class _StarHandler(utils.ApplicationHandler, utils.StarRouteHandlerMixin):
+    pass
+
+
+class _OtherStarHandler(utils.ApplicationHandler, utils.StarRouteHandlerMixin):
+    pass
+
+
+class _Handler(utils.ApplicationHandler):
+    pass
+
+
+class RoutingTest(actions.TestBase):
+
+    def test_course_for_path(self):
+        root = _Course('/')
+        course_a = _Course('/a')
+        course_ab = _Course('/a/b')
+        index = sites.CourseIndex([root, course_a, course_ab])
+        for path, course in [
+                ('/', root), ('/x', root), ('/a', course_a),
+                ('/a/x', course_a), ('/a/b', course_ab),
+                ('/a/b/c', course_ab), ('a', None)]:
+            self.assertIs(course, index.get_course_for_path(path))
+
+            # Once more, now that the path is remembered.
+            self.assertIs(course, index.get_course_for_path(path))
+
+    def test_handler_for_path(self):
+        urls_map = sites.UrlsMap({
+            '/': _StarHandler, '/a': _Handler, '/a/b': _OtherStarHandler,
+            '/c/': _OtherStarHandler})
+        for path, handler in [
+                ('/', _StarHandler), ('/a', _Handler),
+                ('/a/b', _OtherStarHandler), ('/a/b/c', _OtherStarHandler),
+                ('/a/x', _StarHandler), ('/c/', _OtherStarHandler),
+                ('/c/x', _StarHandler)]:
+            self.assertIs(handler, urls_map.get_handler_for_path(path))
+            self.assertIs(handler, urls_map.get_handler_for_path(path))
+
+    def test_changes_to_urls_map_are_routed(self):
+        urls_map = sites.UrlsMap({'/a': _StarHandler})
+        self.assertIs(_StarHandler, urls_map.get_handler_for_path('/a/x'))
+        urls_map['/a/x'] = _Handler
+        self.assertIs(_Handler, urls_map.get_handler_for_path('/a/x'))
+        del urls_map['/a']
+        self.assertIsNone(urls_map.get_handler_for_path('/a/y'))
+
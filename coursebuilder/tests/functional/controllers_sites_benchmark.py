@@ -0,0 +1,65 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of routing of requests to courses and handlers in sites.py.
+
+This times loops, so it is not part of the regular test suite. Run it with:
+
+    python tests/suite.py --test_class_name \
+        tests.functional.controllers_sites_benchmark.RoutingBenchmark
+"""
+
+import datetime
+import logging
+
+from controllers import sites
+from tests.functional import actions
+from tests.functional import controllers_sites
+
+# pylint: disable=protected-access
+_Course = controllers_sites._Course
+_StarHandler = controllers_sites._StarHandler
+
+
+class RoutingBenchmark(actions.TestBase):
+    """Shows routing time does not grow with the number of routes, courses."""
+
+    NUM_PATHS = 1000
+
+    def _time_routing(self, num_routes, num_courses):
+        index = sites.CourseIndex(
+            [_Course('/')] +
+            [_Course('/course_%s' % i) for i in xrange(num_courses)])
+        urls_map = sites.UrlsMap([
+            ('/route_%s/sub' % i, _StarHandler) for i in xrange(num_routes)])
+
+        # Each path is routed once, so none is served from memory.
+        paths = [
+            '/course_%s/route_%s/sub/page_%s' % (
+                i % num_courses, i % num_routes, i)
+            for i in xrange(self.NUM_PATHS)]
+        start = datetime.datetime.utcnow()
+        for path in paths:
+            course = index.get_course_for_path(path)
+            handler = urls_map.get_handler_for_path(
+                sites.unprefix(path, course.get_slug()))
+            self.assertIs(_StarHandler, handler)
+        return (datetime.datetime.utcnow() - start).total_seconds()
+
+    def test_benchmark(self):
+        for num_routes, num_courses in [(10, 5), (100, 50), (1000, 500)]:
+            logging.info(
+                'Routed %s paths among %s routes and %s courses in %.6fs.',
+                self.NUM_PATHS, num_routes, num_courses,
+                self._time_routing(num_routes, num_courses))
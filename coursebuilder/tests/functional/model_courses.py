@@ -18,6 +18,7 @@ __author__ = [
     'mgainer@google.com (Mike Gainer)',
 ]
 
+from common import tags as common_tags
 from common import utils as common_utils
 from controllers import sites
 from models import config
@@ -26,6 +27,8 @@ from models import models
 from models import vfs
 from tests.functional import actions
 
+from google.appengine.api import memcache
+
 LOREM_IPSUM = """
 Lorem ipsum dolor sit amet, consectetur adipiscing elit. Pellentesque nisl
 libero, interdum vel lectus eget, lacinia vestibulum eros. Maecenas posuere
@@ -72,35 +75,27 @@ class CourseCachingTest(actions.TestBase):
         self.course.save()
         return unit
 
+    def _get_raw(self, key):
+        return memcache.get(key, namespace=self.NAMESPACE)
+
     def test_large_course_is_cached_in_memcache(self):
         num_lessons = models.MEMCACHE_MAX / len(LOREM_IPSUM)
         unit = self._add_large_unit(num_lessons)
 
-        memcache_keys = courses.CachedCourse13._make_keys()
+        memcache_key = courses.CachedCourse13._make_key()
 
         # Verify memcache has no contents upon initial save.
-        memcache_values = models.MemcacheManager.get_multi(
-            memcache_keys, self.NAMESPACE)
-        self.assertEquals({}, memcache_values)
+        self.assertIsNone(self._get_raw(memcache_key))
 
         # Load course.  It won't be in memcache, so Course will fetch it
         # from VFS and save it in memcache.
         course = courses.Course(handler=None, app_context=self.app_context)
 
         # Check that things have gotten into memcache.
-        memcache_values = models.MemcacheManager.get_multi(
-            memcache_keys, self.NAMESPACE)
-        self.assertEquals(
-            memcache_keys[0:2],
-            sorted(memcache_values.keys()),
-            'Only two keys should be present.')
-        self.assertEquals(
-            models.MEMCACHE_MAX,
-            len(memcache_values[memcache_keys[0]]),
-            'Shard #0 should be full of data.')
-        self.assertGreater(
-            len(memcache_values[memcache_keys[1]]), 0,
-            'Shard #1 should have data.')
+        manifest = self._get_raw(memcache_key)
+        self.assertIsInstance(manifest, models.LargeValueManifest)
+        for shard_key in manifest.get_shard_keys(memcache_key):
+            self.assertGreater(len(self._get_raw(shard_key)), 0)
 
         # Destroy the contents of the course from VFS, so that we are
         # absolutely certain that if the next course load succeeds, it has
@@ -113,7 +108,9 @@ class CourseCachingTest(actions.TestBase):
             shard_1 = vfs.FileDataEntity.get_by_key_name(file_key_names[1])
             shard_1.delete()
 
-        # Re-load course to force load from memcache.
+        # Re-load course to force load from memcache rather than from the
+        # in-process cache.
+        sites.ApplicationContext.clear_per_process_cache()
         course = courses.Course(handler=None, app_context=self.app_context)
 
         # Verify contents.
@@ -125,28 +122,37 @@ class CourseCachingTest(actions.TestBase):
         # Delete items from memcache, and verify that loading fails.  This
         # re-verifies that the loaded data was, in fact, coming from memcache.
         courses.CachedCourse13.delete(self.app_context)
+        sites.ApplicationContext.clear_per_process_cache()
         with self.assertRaises(AttributeError):
             course = courses.Course(handler=None, app_context=self.app_context)
 
-    def test_recovery_from_missing_initial_shard(self):
-        self._test_recovery_from_missing_shard(0)
+    def test_recovery_from_missing_manifest(self):
+        self._test_recovery_from_missing_key(
+            lambda memcache_key, manifest: memcache_key)
 
-    def test_recovery_from_missing_trailing_shard(self):
-        self._test_recovery_from_missing_shard(1)
+    def test_recovery_from_missing_shard(self):
+        self._test_recovery_from_missing_key(
+            lambda memcache_key, manifest: manifest.get_shard_keys(
+                memcache_key)[-1])
 
-    def _test_recovery_from_missing_shard(self, shard_index):
+    def _test_recovery_from_missing_key(self, get_key_to_delete):
         num_lessons = models.MEMCACHE_MAX / len(LOREM_IPSUM)
         unit = self._add_large_unit(num_lessons)
-        memcache_keys = courses.CachedCourse13._make_keys()
+        memcache_key = courses.CachedCourse13._make_key()
 
         # Load course.  It won't be in memcache, so Course will fetch it
         # from VFS and save it in memcache.
         course = courses.Course(handler=None, app_context=self.app_context)
 
-        models.MemcacheManager.delete(memcache_keys[shard_index])
+        manifest = self._get_raw(memcache_key)
+        memcache.delete(
+            get_key_to_delete(memcache_key, manifest),
+            namespace=self.NAMESPACE)
 
-        # Re-load course to force load from memcache.  This should fail back
-        # to VFS, and still load successfully.
+        # Re-load course to force load from memcache rather than from the
+        # in-process cache.  This should fail back to VFS, and still load
+        # successfully.
+        sites.ApplicationContext.clear_per_process_cache()
         course = courses.Course(handler=None, app_context=self.app_context)
 
         # Verify contents.
@@ -155,36 +161,245 @@ class CourseCachingTest(actions.TestBase):
         for lesson in lessons:
             self.assertEquals(lesson.objectives, LOREM_IPSUM)
 
-    def test_course_that_is_too_large_to_cache_is_not_cached(self):
-        num_lessons = courses.CachedCourse13._max_size() / len(LOREM_IPSUM)
-        # Fudge factor to get size of course as saved to under the VFS limit
-        # but over the memcache limit.
-        num_lessons -= 19
-        unit = self._add_large_unit(num_lessons)
-        memcache_keys = courses.CachedCourse13._make_keys()
+    def test_large_course_is_compressed(self):
+        num_lessons = models.MEMCACHE_MAX / len(LOREM_IPSUM)
+        self._add_large_unit(num_lessons)
+        raw_bytes = models.CACHE_PUT_LARGE_RAW_BYTES.value
+        compressed_bytes = models.CACHE_PUT_LARGE_COMPRESSED_BYTES.value
 
-        # Load the course, which would normally populate memcache with the
-        # loaded content, but will not have, because the course is too large.
-        # Verify that.
+        # Load the course to get it put into memcache.
         course = courses.Course(handler=None, app_context=self.app_context)
-        memcache_values = models.MemcacheManager.get_multi(
-            memcache_keys, self.NAMESPACE)
-        self.assertEquals(
-            {}, memcache_values,
-            'Memcache for too-large course should be cleared.')
+        raw_bytes = models.CACHE_PUT_LARGE_RAW_BYTES.value - raw_bytes
+        compressed_bytes = (
+            models.CACHE_PUT_LARGE_COMPRESSED_BYTES.value - compressed_bytes)
+        self.assertGreater(raw_bytes, models.MEMCACHE_MAX)
+        self.assertLess(compressed_bytes, raw_bytes / 10)
 
-    def test_small_course_occupies_only_one_shard(self):
+    def test_small_course_is_not_sharded(self):
         self._add_large_unit(num_lessons=1)
-        memcache_keys = courses.CachedCourse13._make_keys()
+        memcache_key = courses.CachedCourse13._make_key()
+
+        # Load course to get it put into memcache.
+        course = courses.Course(handler=None, app_context=self.app_context)
+        value = self._get_raw(memcache_key)
+        self.assertIsInstance(value, basestring)
+
+    def test_course_is_cached_in_process(self):
+        unit = self._add_large_unit(num_lessons=3)
+        courses.Course(handler=None, app_context=self.app_context)
+
+        # Remove the course from memcache; it must still load from the
+        # in-process cache.
+        courses.CachedCourse13.delete(self.app_context)
+        hits = courses.CACHE_HIT_PROCESS.value
+        course = courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(hits + 1, courses.CACHE_HIT_PROCESS.value)
+        self.assertEquals(3, len(course.get_lessons(unit.unit_id)))
+
+    def test_changes_to_loaded_course_are_not_shared(self):
+        unit = self._add_large_unit(num_lessons=1)
+        course = courses.Course(handler=None, app_context=self.app_context)
+        course.find_unit_by_id(unit.unit_id).title = 'Changed'
+        course.find_unit_by_id(unit.unit_id).properties['key'] = 'value'
+        course.add_lesson(course.find_unit_by_id(unit.unit_id))
+
+        course = courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(
+            'New Unit', course.find_unit_by_id(unit.unit_id).title)
+        self.assertNotIn(
+            'key', course.find_unit_by_id(unit.unit_id).properties)
+        self.assertEquals(1, len(course.get_lessons(unit.unit_id)))
 
-        # Load course to get shard put into memcache.
+    def test_save_invalidates_process_cache(self):
+        unit = self._add_large_unit(num_lessons=1)
         course = courses.Course(handler=None, app_context=self.app_context)
-        memcache_values = models.MemcacheManager.get_multi(
-            memcache_keys, self.NAMESPACE)
+        course.add_lesson(course.find_unit_by_id(unit.unit_id))
+        course.save()
+
+        misses = courses.CACHE_MISS_PROCESS.value
+        course = courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(misses + 1, courses.CACHE_MISS_PROCESS.value)
+        self.assertEquals(2, len(course.get_lessons(unit.unit_id)))
+
+    def test_bump_version_invalidates_process_cache(self):
+        courses.Course(handler=None, app_context=self.app_context)
+        courses.CourseModel13.bump_version(
+            self.app_context.get_namespace_name())
+
+        misses = courses.CACHE_MISS_PROCESS.value
+        courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(misses + 1, courses.CACHE_MISS_PROCESS.value)
+
+    def test_process_cache_entries_expire(self):
+        courses.Course(handler=None, app_context=self.app_context)
+        self.swap(models, 'DEFAULT_CACHE_TTL_SECS', 0)
+
+        misses = courses.CACHE_MISS_PROCESS.value
+        courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(misses + 1, courses.CACHE_MISS_PROCESS.value)
+
+    def test_components_are_indexed_and_updated_on_save(self):
+        unit = self.course.add_unit()
+        lesson = self.course.add_lesson(unit)
+        lesson.objectives = '<question quid="1" instanceid="a"></question>'
+        self.course.save()
+
+        parsed = []
+        old_get_components_from_html = common_tags.get_components_from_html
+
+        def get_components_from_html(html, *args, **kwargs):
+            parsed.append(html)
+            return old_get_components_from_html(html, *args, **kwargs)
+
+        common_tags.get_components_from_html = get_components_from_html
+        try:
+            sites.ApplicationContext.clear_per_process_cache()
+            course = courses.Course(handler=None, app_context=self.app_context)
+            self.assertEquals(
+                [{'cpt_name': 'question', 'quid': '1', 'instanceid': 'a'}],
+                course.get_components(unit.unit_id, lesson.lesson_id))
+            self.assertEquals(
+                [1], course.get_component_locations()[0].keys())
+            self.assertEquals([], parsed)
+
+            lesson = course.find_lesson_by_id(unit, lesson.lesson_id)
+            lesson.objectives = (
+                '<question quid="2" instanceid="b"></question>')
+            course.update_lesson(lesson)
+            course.save()
+            self.assertEquals(1, len(parsed))
+
+            course = courses.Course(handler=None, app_context=self.app_context)
+            self.assertEquals(
+                [{'cpt_name': 'question', 'quid': '2', 'instanceid': 'b'}],
+                course.get_components(unit.unit_id, lesson.lesson_id))
+            self.assertEquals(1, len(parsed))
+        finally:
+            common_tags.get_components_from_html = (
+                old_get_components_from_html)
+
+    def test_component_locations_are_indexed_and_updated_on_save(self):
+        unit = self.course.add_unit()
+        lesson_one = self.course.add_lesson(unit)
+        lesson_one.objectives = '<question quid="1" instanceid="a"></question>'
+        lesson_two = self.course.add_lesson(unit)
+        assessment = self.course.add_assessment()
+        assessment.html_content = (
+            '<question-group qgid="5" instanceid="b"></question-group>')
+        self.course.save()
+
+        def get_lesson_locations(locations):
+            return sorted(
+                ((lesson.lesson_id, parent.unit_id), count)
+                for (lesson, parent), count in locations['lessons'].iteritems())
+
+        sites.ApplicationContext.clear_per_process_cache()
+        course = courses.Course(handler=None, app_context=self.app_context)
+        qulocations, qglocations = course.get_component_locations()
+        self.assertEquals(
+            [((lesson_one.lesson_id, unit.unit_id), 1)],
+            get_lesson_locations(qulocations[1]))
+        self.assertEquals(
+            [assessment.unit_id],
+            [u.unit_id for u in qglocations[5]['assessments']])
+
+        lesson = course.find_lesson_by_id(unit, lesson_one.lesson_id)
+        lesson.objectives = ''
+        course.update_lesson(lesson)
+        lesson = course.find_lesson_by_id(unit, lesson_two.lesson_id)
+        lesson.objectives = (
+            '<question quid="1" instanceid="c"></question>'
+            '<question quid="1" instanceid="d"></question>')
+        course.update_lesson(lesson)
+        course.save()
+
+        # The course is not walked again; the saved lessons were re-counted.
+        def get_components(*unused_args, **unused_kwargs):
+            self.fail('Locations should come from the index.')
+
+        self.swap(courses.Course, 'get_components', get_components)
+        self.swap(courses.Course, 'get_assessment_components', get_components)
+        course = courses.Course(handler=None, app_context=self.app_context)
+        qulocations, qglocations = course.get_component_locations()
+        self.assertEquals(
+            [((lesson_two.lesson_id, unit.unit_id), 2)],
+            get_lesson_locations(qulocations[1]))
+        self.assertEquals([5], qglocations.keys())
+
+
+class CourseEnvironCachingTest(actions.TestBase):
+
+    COURSE_NAME = 'test_course'
+    ADMIN_EMAIL = 'admin@foo.com'
+
+    def setUp(self):
+        super(CourseEnvironCachingTest, self).setUp()
+        self.app_context = actions.simple_add_course(
+            self.COURSE_NAME, self.ADMIN_EMAIL, 'Test Course')
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.hook_calls = 0
+        self.hook_key = 'a'
+        courses.Course.COURSE_ENV_POST_COPY_HOOKS.append(self._hook)
+
+    def tearDown(self):
+        courses.Course.COURSE_ENV_POST_COPY_HOOKS.remove(self._hook)
+        courses.Course.COURSE_ENV_POST_COPY_HOOK_CACHE_KEYS.pop(
+            self._hook, None)
+        del config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name]
+        super(CourseEnvironCachingTest, self).tearDown()
+
+    def _hook(self, app_context, env):
+        self.hook_calls += 1
+        env['hook_key'] = self.hook_key
+
+    def _add_cache_key(self):
+        courses.Course.COURSE_ENV_POST_COPY_HOOK_CACHE_KEYS[self._hook] = (
+            lambda app_context: self.hook_key)
+
+    def test_hooks_are_run_every_time_without_cache_key(self):
+        courses.Course.get_environ(self.app_context)
+        courses.Course.get_environ(self.app_context)
+        self.assertEquals(2, self.hook_calls)
+
+    def test_hooks_are_run_once_per_cache_key(self):
+        self._add_cache_key()
+        env = courses.Course.get_environ(self.app_context)
+        env['course']['title'] = 'Changed'
+        env = courses.Course.get_environ(self.app_context)
+        self.assertEquals(1, self.hook_calls)
+        self.assertEquals('a', env['hook_key'])
+        self.assertEquals('Test Course', env['course']['title'])
+
+        # Cached in-process as well as for this request.
+        self.app_context.clear_per_request_cache()
+        courses.Course.get_environ(self.app_context)
+        self.assertEquals(1, self.hook_calls)
+
+        self.hook_key = 'b'
+        env = courses.Course.get_environ(self.app_context)
+        self.assertEquals(2, self.hook_calls)
+        self.assertEquals('b', env['hook_key'])
+
+    def test_save_settings_invalidates_cached_environ(self):
+        self._add_cache_key()
+        course = courses.Course(None, app_context=self.app_context)
+        env = courses.Course.get_environ(self.app_context)
+        env['course']['title'] = 'Changed'
+        course.save_settings(env)
+
+        env = courses.Course.get_environ(self.app_context)
+        self.assertEquals(2, self.hook_calls)
+        self.assertEquals('Changed', env['course']['title'])
+
+    def test_settings_version_is_not_kept_after_global_route_request(self):
+        self._add_cache_key()
+        courses.Course.get_environ(self.app_context)
+        self.assertTrue(courses.RequestScopedEnvironCache.instance().versions)
+
+        # Global routes are served without path info.
+        self.get(sites.ClearCookiesHandler.URL, expect_errors=True)
         self.assertEquals(
-            memcache_keys[0:1],
-            memcache_values.keys(),
-            'Only shard zero should be present in memcache.')
+            {}, courses.RequestScopedEnvironCache.instance().versions)
 
 
 class PermissionsTest(actions.TestBase):
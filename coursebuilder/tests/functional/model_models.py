@@ -371,6 +371,17 @@ class MemcacheManagerTestCase(actions.TestBase):
         self.assertEquals(None, models.MemcacheManager.get('a'))
         self.assertEquals(None, models.MemcacheManager.get('b'))
 
+    def test_get_multi_from_request_local_cache(self):
+        models.MemcacheManager.begin_readonly()
+        try:
+            models.MemcacheManager.set('a', 'A')
+            models.MemcacheManager.set('b', 'B')
+
+            data = models.MemcacheManager.get_multi(['a', 'b'])
+            self.assertEquals({'a': 'A', 'b': 'B'}, data)
+        finally:
+            models.MemcacheManager.end_readonly()
+
     def test_get_multi_no_memcache(self):
         config.Registry.test_overrides = {}
         models.MemcacheManager.set('a', 'A')
@@ -379,6 +390,32 @@ class MemcacheManagerTestCase(actions.TestBase):
         data = models.MemcacheManager.get_multi(['a', 'b', 'c'])
         self.assertEquals(0, len(data.keys()))
 
+    def test_get_returns_private_copy_in_readonly(self):
+        models.MemcacheManager.begin_readonly()
+        try:
+            value = {'a': ['A']}
+            models.MemcacheManager.set('a', value)
+            value['a'].append('B')
+
+            first = models.MemcacheManager.get('a')
+            self.assertEquals({'a': ['A']}, first)
+            first['a'].append('C')
+            self.assertEquals({'a': ['A']}, models.MemcacheManager.get('a'))
+        finally:
+            models.MemcacheManager.end_readonly()
+
+    def test_frozen_get_shares_value_in_readonly(self):
+        models.MemcacheManager.begin_readonly()
+        try:
+            value = {'a': ['A']}
+            models.MemcacheManager.set('a', value, frozen=True)
+            self.assertIs(value, models.MemcacheManager.get('a', frozen=True))
+            self.assertIs(value, models.MemcacheManager.get('a', frozen=True))
+            self.assertIsNot(value, models.MemcacheManager.get('a'))
+            self.assertEquals(value, models.MemcacheManager.get('a'))
+        finally:
+            models.MemcacheManager.end_readonly()
+
 
 class TestEntity(entities.BaseEntity):
     data = db.TextProperty(indexed=False)
@@ -812,6 +849,7 @@ class StudentPropertyEntityTestCase(actions.ExportTestBase):
             models.StudentPropertyEntity.safe_key(
                 student_property_key, self.transform).name())
 
+
 class StudentLifecycleObserverTestCase(actions.TestBase):
 
     COURSE = 'lifecycle_test'
@@ -18,12 +18,16 @@ __author__ = [
     'mgainer@google.com (Mike Gainer)',
 ]
 
+import datetime
 import os
 import random
 import StringIO
 import tempfile
 
+import appengine_config
 from common import utils as common_utils
+from models import config
+from models import models
 from models import vfs
 from models import courses
 from tests.functional import actions
@@ -199,3 +203,83 @@ class VfsLargeFileSupportTest(actions.TestBase):
         # from AppEngine about cross-group transaction having too many
         # entities involved.
         self.course.save()
+
+
+class VfsDeletionTrackingTest(actions.TestBase):
+
+    NAMESPACE = 'ns_foo'
+
+    def setUp(self):
+        super(VfsDeletionTrackingTest, self).setUp()
+        self.fs = vfs.DatastoreBackedFileSystem(self.NAMESPACE, '/')
+
+    def _get_tombstone(self, filename):
+        with common_utils.Namespace(self.NAMESPACE):
+            return vfs.FileTombstoneEntity.get_by_key_name(filename)
+
+    def test_tombstone_is_written_on_delete_and_removed_on_put(self):
+        self.fs.put('/file.txt', StringIO.StringIO('file contents'))
+        self.assertIsNone(self._get_tombstone('/file.txt'))
+
+        self.fs.delete('/file.txt')
+        self.assertIsNotNone(self._get_tombstone('/file.txt'))
+
+        self.fs.put('/file.txt', StringIO.StringIO('new contents'))
+        self.assertIsNone(self._get_tombstone('/file.txt'))
+        self.assertEquals('new contents', self.fs.get('/file.txt').read())
+
+    def test_expired_tombstones_are_deleted(self):
+        with common_utils.Namespace(self.NAMESPACE):
+            vfs.FileTombstoneEntity(
+                key_name='/old.txt',
+                updated_on=datetime.datetime.utcnow() - datetime.timedelta(
+                    seconds=vfs.CacheFileEntry.CACHE_ENTRY_TTL_SEC + 1)).put()
+        self.fs.put('/file.txt', StringIO.StringIO('file contents'))
+
+        self.fs.delete('/file.txt')
+        self.assertIsNone(self._get_tombstone('/old.txt'))
+        self.assertIsNotNone(self._get_tombstone('/file.txt'))
+
+    def test_deletion_on_other_instance_evicts_cached_file(self):
+        self.fs.put('/file.txt', StringIO.StringIO('file contents'))
+        metadata = self.fs.get('/file.txt').metadata
+        self.fs.delete('/file.txt')
+
+        # Put the file back into the process cache, as if the deletion
+        # happened on some other instance.
+        conn = vfs.VfsCacheConnection(self.NAMESPACE)
+        conn.put('/file.txt', metadata, 'file contents')
+        self.assertTrue(conn.get('/file.txt')[0])
+
+        conn = vfs.VfsCacheConnection.new_connection(self.NAMESPACE)
+        self.assertEquals((False, None), conn.get('/file.txt'))
+
+
+class VfsResyncThrottlingTest(actions.TestBase):
+
+    NAMESPACE = 'ns_foo'
+
+    def setUp(self):
+        super(VfsResyncThrottlingTest, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        vfs.VfsCacheConnection._LAST_RESYNC.clear()
+
+    def tearDown(self):
+        del config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name]
+        vfs.VfsCacheConnection._LAST_RESYNC.clear()
+        super(VfsResyncThrottlingTest, self).tearDown()
+
+    def test_missing_generation_is_created_and_resync_is_skipped(self):
+        key = vfs.VfsCacheConnection._make_generation_key(self.NAMESPACE)
+        models.MemcacheManager.delete(
+            key, namespace=appengine_config.DEFAULT_NAMESPACE_NAME)
+
+        conn = vfs.VfsCacheConnection(self.NAMESPACE)
+        skipped = conn.CACHE_RESYNC_SKIPPED.value
+        conn._get_incremental_updates()
+        self.assertIsNotNone(models.MemcacheManager.get(
+            key, namespace=appengine_config.DEFAULT_NAMESPACE_NAME))
+        self.assertEquals(skipped, conn.CACHE_RESYNC_SKIPPED.value)
+
+        conn._get_incremental_updates()
+        self.assertEquals(skipped + 1, conn.CACHE_RESYNC_SKIPPED.value)
@@ -23,6 +23,8 @@ from common import users
 from common.utils import Namespace
 from models import courses
 from models import models
+from models import progress
+from models import transforms
 from modules.analytics import analytics
 from tests.functional import actions
 
@@ -234,3 +236,63 @@ class ProgressPercent(actions.TestBase):
         with Namespace(NAMESPACE):
             self.assertEquals(1.000, self.tracker.get_unit_percent_complete(
                 self.student)[self.unit.unit_id])
+
+    def test_progress_is_decoded_and_encoded_once_per_update(self):
+        decoded = []
+        encoded = []
+        parsed_progress_class = progress._ParsedProgress
+        original_init = parsed_progress_class.__init__
+        original_encode = parsed_progress_class.encode
+
+        def init(parsed, value):
+            decoded.append(value)
+            original_init(parsed, value)
+
+        def encode(parsed, student_property):
+            encoded.append(parsed.dirty)
+            original_encode(parsed, student_property)
+
+        self.swap(parsed_progress_class, '__init__', init)
+        self.swap(parsed_progress_class, 'encode', encode)
+        self.swap(
+            progress.UnitLessonCompletionTracker, 'POST_UPDATE_PROGRESS_HOOK',
+            [])
+
+        # Completing the lesson also updates the unit and the course.
+        with Namespace(NAMESPACE):
+            self.tracker.put_html_completed(
+                self.student, self.unit.unit_id, self.lesson_one.lesson_id)
+        self.assertEquals(1, len(decoded))
+        self.assertEquals([True], encoded)
+
+        self.tracker._progress_by_user_id.clear()
+        with Namespace(NAMESPACE):
+            self.assertEquals(0.333, self.tracker.get_unit_percent_complete(
+                self.student)[self.unit.unit_id])
+
+    def test_progress_value_set_directly_is_decoded_again(self):
+        with Namespace(NAMESPACE):
+            self.tracker.put_html_completed(
+                self.student, self.unit.unit_id, self.lesson_one.lesson_id)
+            student_progress = self.tracker.get_or_create_progress(
+                self.student)
+            self.assertEquals(
+                self.tracker.COMPLETED_STATE,
+                self.tracker.get_html_status(
+                    student_progress, self.unit.unit_id,
+                    self.lesson_one.lesson_id))
+
+            student_progress.value = transforms.dumps({})
+            self.assertIsNone(self.tracker.get_html_status(
+                student_progress, self.unit.unit_id,
+                self.lesson_one.lesson_id))
+
+    def test_decoded_progress_is_not_attached_to_entity(self):
+        with Namespace(NAMESPACE):
+            self.tracker.put_html_completed(
+                self.student, self.unit.unit_id, self.lesson_one.lesson_id)
+            student_progress = self.tracker.get_or_create_progress(
+                self.student)
+            self.assertFalse([
+                value for value in vars(student_progress).itervalues()
+                if isinstance(value, progress._ParsedProgress)])
@@ -0,0 +1,73 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of resync lookups in the cache of a large deployment.
+
+This times loops, so it is not part of the regular test suite. Run it with:
+
+    python tests/suite.py --test_class_name \
+        tests.unit.common_caching_benchmark.UpdatedOnIndexBenchmark
+"""
+
+import datetime
+import logging
+import unittest
+
+from common import caching
+
+# pylint: disable=protected-access
+_TestCacheConnection = caching._TestCacheConnection
+_TestCacheEntry = caching._TestCacheEntry
+
+
+class UpdatedOnIndexBenchmark(unittest.TestCase):
+    """Compares resync lookups with and without the index."""
+
+    FILES_PER_COURSE = 50
+    LOOKUPS = 10
+
+    def _populate(self, cache, num_courses):
+        when = datetime.datetime(2016, 1, 1)
+        for course in xrange(num_courses):
+            for i in xrange(self.FILES_PER_COURSE):
+                cache.put(
+                    _TestCacheConnection.make_key(
+                        'ns_%s' % course, '/file_%s' % i),
+                    _TestCacheEntry(when + datetime.timedelta(seconds=i)))
+
+    def _time_lookups(self, conn, method):
+        start = datetime.datetime.utcnow()
+        for _ in xrange(self.LOOKUPS):
+            method(conn)
+        return (datetime.datetime.utcnow() - start).total_seconds()
+
+    def test_benchmark(self):
+        # pylint: disable=protected-access
+        for num_courses in [10, 100, 1000]:
+            cache = caching.LRUCache(
+                max_item_count=num_courses * self.FILES_PER_COURSE,
+                index=caching.UpdatedOnIndex())
+            self._populate(cache, num_courses)
+            conn = _TestCacheConnection('ns_0', cache)
+            scan_sec = self._time_lookups(
+                conn, _TestCacheConnection._scan_most_recent_updated_on)
+            index_sec = self._time_lookups(
+                conn, _TestCacheConnection._get_most_recent_updated_on)
+            self.assertEquals(
+                conn._scan_most_recent_updated_on(),
+                conn._get_most_recent_updated_on())
+            logging.info(
+                'Resync lookup over %s courses: scan %.6fs, index %.6fs '
+                '(%s lookups).', num_courses, scan_sec, index_sec,
+                self.LOOKUPS)
@@ -62,19 +62,39 @@ class CustomTagTests(unittest.TestCase):
                         '<div>%s</div>' % context.env.get('count', 0)),
                     cElementTree.XML('<div>foot</div>'))
 
+        class CacheableTag(tags.BaseTag):
+            """A tag which counts how many times it was rendered."""
+
+            renders = 0
+
+            @classmethod
+            def is_cacheable(cls):
+                return True
+
+            def render(self, node, unused_handler):
+                CacheableTag.renders += 1
+                elt = cElementTree.Element('Cached')
+                elt.text = node.attrib.get('value')
+                return elt
+
+        self.cacheable_tag = CacheableTag
+
         def new_get_tag_bindings():
             return {
                 'simple': SimpleTag,
                 'complex': ComplexTag,
                 'reroot': ReRootTag,
-                'count': CounterTag}
+                'count': CounterTag,
+                'cacheable': CacheableTag}
 
         self.old_get_tag_bindings = tags.get_tag_bindings
         tags.get_tag_bindings = new_get_tag_bindings
 
         self.mock_handler = object()
+        tags.ProcessScopedFragmentCache.clear_instance()
 
     def tearDown(self):
+        tags.ProcessScopedFragmentCache.clear_instance()
         tags.get_tag_bindings = self.old_get_tag_bindings
 
     def test_empty_text_is_passed(self):
@@ -151,3 +171,30 @@ class CustomTagTests(unittest.TestCase):
                 '<Count>2</Count></div><div>foot</div>'
             ),
             str(safe_dom))
+
+    def test_cacheable_tags_are_rendered_once(self):
+        html = '<p><cacheable value="a"></cacheable>tail</p>'
+        for _ in xrange(3):
+            safe_dom = tags.html_to_safe_dom(html, self.mock_handler)
+            self.assertEquals(
+                '<p><Cached>a</Cached>tail</p>', str(safe_dom))
+        self.assertEquals(1, self.cacheable_tag.renders)
+
+        html = '<p><cacheable value="b"></cacheable>tail</p>'
+        safe_dom = tags.html_to_safe_dom(html, self.mock_handler)
+        self.assertEquals('<p><Cached>b</Cached>tail</p>', str(safe_dom))
+        self.assertEquals(2, self.cacheable_tag.renders)
+
+    def test_live_tags_are_rendered_on_every_view(self):
+        html = (
+            '<div><count></count><cacheable value="x"></cacheable>'
+            '<count></count> tail</div>')
+        for _ in xrange(2):
+            safe_dom = tags.html_to_safe_dom(html, self.mock_handler)
+            self.assertEqual(
+                (
+                    '<div>2</div><div><Count>1</Count><Cached>x</Cached>'
+                    '<Count>2</Count> tail</div><div>foot</div>'
+                ),
+                str(safe_dom))
+        self.assertEquals(1, self.cacheable_tag.renders)
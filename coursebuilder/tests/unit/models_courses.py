@@ -13,7 +13,7 @@
 # limitations under the License.
 
 
-"""Unit tests for the Workflow class in models.courses."""
+"""Unit tests for models.courses."""
 
 __author__ = 'Sean Lip (sll@google.com)'
 
@@ -21,8 +21,12 @@ import unittest
 
 import yaml
 
+from models.courses import CourseModel13
 from models.courses import LEGACY_HUMAN_GRADER_WORKFLOW
+from models.courses import Lesson13
+from models.courses import Unit13
 from models.courses import Workflow
+from tools import verify
 
 DATE_FORMAT_ERROR = (
     'dates should be formatted as YYYY-MM-DD hh:mm (e.g. 1997-07-16 19:20) and '
@@ -234,3 +238,80 @@ class WorkflowValidationTests(unittest.TestCase):
         workflow = Workflow(self.to_yaml(workflow_dict))
         workflow.validate(self.errors)
         self.assertFalse(self.errors)
+
+
+def _make_course(num_units, lessons_per_unit):
+    """Makes a course of units, each with lessons and a post assessment."""
+    units = []
+    lessons = []
+    next_id = 1
+    for _ in xrange(num_units):
+        unit = Unit13()
+        unit.type = verify.UNIT_TYPE_UNIT
+        unit.unit_id = next_id
+        assessment = Unit13()
+        assessment.type = verify.UNIT_TYPE_ASSESSMENT
+        assessment.unit_id = next_id + 1
+        unit.post_assessment = assessment.unit_id
+        units.extend([unit, assessment])
+        next_id += 2
+        for _ in xrange(lessons_per_unit):
+            lesson = Lesson13()
+            lesson.unit_id = unit.unit_id
+            lesson.lesson_id = next_id
+            lessons.append(lesson)
+            next_id += 1
+    return CourseModel13(None, next_id=next_id, units=units, lessons=lessons)
+
+
+class OutlineIndexTests(unittest.TestCase):
+    """Unit tests for lookups in CourseModel13 served by OutlineIndex13."""
+
+    def setUp(self):
+        self.course = _make_course(3, 2)
+        self.unit, self.assessment = self.course.get_units()[2:4]
+
+    def test_find_by_id(self):
+        self.assertIs(self.unit, self.course.find_unit_by_id(5))
+        self.assertIs(self.unit, self.course.find_unit_by_id('5'))
+        self.assertIsNone(self.course.find_unit_by_id(1000))
+        lesson = self.course.get_lessons(5)[1]
+        self.assertIs(
+            lesson, self.course.find_lesson_by_id(None, lesson.lesson_id))
+        self.assertIsNone(self.course.find_lesson_by_id(None, 1000))
+
+    def test_get_parent_unit(self):
+        self.assertIs(
+            self.unit, self.course.get_parent_unit(self.assessment.unit_id))
+        self.assertIsNone(self.course.get_parent_unit(self.unit.unit_id))
+
+        self.unit.post_assessment = None
+        self.course.update_unit(self.unit)
+        self.assertIsNone(
+            self.course.get_parent_unit(self.assessment.unit_id))
+
+    def test_lessons_in_syllabus_order(self):
+        self.assertEquals(
+            [7, 8], [l.lesson_id for l in self.course.get_lessons(5)])
+        self.assertEquals(
+            [3, 4, 7, 8, 11, 12],
+            [l.lesson_id for l in self.course.get_lessons_for_all_units()])
+
+    def test_index_follows_changes(self):
+        lesson = self.course.add_lesson(self.unit, 'New Lesson')
+        self.assertIs(
+            lesson, self.course.find_lesson_by_id(None, lesson.lesson_id))
+        self.assertEquals(lesson, self.course.get_lessons(5)[-1])
+
+        self.course.move_lesson_to(lesson, self.course.find_unit_by_id(1))
+        self.assertEquals(lesson, self.course.get_lessons(1)[-1])
+        self.assertNotIn(lesson, self.course.get_lessons(5))
+
+        self.course.delete_unit(self.unit)
+        self.assertIsNone(self.course.find_unit_by_id(self.unit.unit_id))
+        self.assertIsNone(
+            self.course.get_parent_unit(self.assessment.unit_id))
+        self.assertIs(
+            self.assessment,
+            self.course.find_unit_by_id(self.assessment.unit_id))
+
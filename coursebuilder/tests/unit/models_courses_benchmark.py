@@ -0,0 +1,76 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of unit and lesson lookups in the outline of a large course.
+
+This times loops, so it is not part of the regular test suite. Run it with:
+
+    python tests/suite.py --test_class_name \
+        tests.unit.models_courses_benchmark.OutlineIndexBenchmark
+"""
+
+import datetime
+import logging
+import unittest
+
+from models.courses import CourseModel13
+from tests.unit import models_courses
+
+# pylint: disable=protected-access
+_make_course = models_courses._make_course
+
+
+class OutlineIndexBenchmark(unittest.TestCase):
+    """Compares outline lookups with and without the index."""
+
+    NUM_UNITS = 500
+    LESSONS_PER_UNIT = 10
+
+    def _scan_unit(self, course, unit_id):
+        for unit in course.get_units():
+            if str(unit.unit_id) == str(unit_id):
+                return unit
+        return None
+
+    def _scan_parent_unit(self, course, unit_id):
+        for unit in course.get_units():
+            if (str(unit.pre_assessment) == str(unit_id) or
+                str(unit.post_assessment) == str(unit_id)):
+                return unit
+        return None
+
+    def _walk(self, course, find_unit, get_parent_unit):
+        start = datetime.datetime.utcnow()
+        for unit in course.get_units():
+            self.assertIs(unit, find_unit(course, unit.unit_id))
+            get_parent_unit(course, unit.unit_id)
+        return (datetime.datetime.utcnow() - start).total_seconds()
+
+    def test_benchmark(self):
+        course = _make_course(self.NUM_UNITS, self.LESSONS_PER_UNIT)
+        scan_sec = self._walk(course, self._scan_unit, self._scan_parent_unit)
+        index_sec = self._walk(
+            course, CourseModel13.find_unit_by_id,
+            CourseModel13.get_parent_unit)
+        for unit in course.get_units():
+            self.assertIs(
+                self._scan_parent_unit(course, unit.unit_id),
+                course.get_parent_unit(unit.unit_id))
+        self.assertEquals(
+            self.NUM_UNITS * self.LESSONS_PER_UNIT,
+            len(course.get_lessons_for_all_units()))
+        logging.info(
+            'Outline walk over %s units and %s lessons: scan %.6fs, '
+            'index %.6fs.', len(course.get_units()),
+            len(course.get_lessons_for_all_units()), scan_sec, index_sec)